@@ -9,6 +9,13 @@ import json
 from datetime import datetime
 import hashlib
 import zlib
+import struct
+from array import array
+import time
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import G2Paths
 from G2Database import G2Database
@@ -18,6 +25,184 @@ from G2IniParams import G2IniParams
 from G2ConfigMgr import G2ConfigMgr
 from G2Exception import G2Exception
 
+#--zstd compression of resume hashes is optional
+try: import zstandard
+except ImportError: zstandard = None
+
+#--sqlite pragmas for each datamart profile, the maintenance interval is how often to checkpoint and optimize
+#--wal syncs every commit so a message acked after its commit survives a power failure
+#--bulk skips syncing, an os crash or power failure can corrupt the datamart so only use it for a rebuild that can be redone
+datamart_profiles = {'default': {'pragmas': [], 'maintenance_seconds': 0},
+                     'wal': {'pragmas': ['journal_mode = WAL', 
+                                         'synchronous = FULL', 
+                                         'cache_size = -262144', #--256mb 
+                                         'mmap_size = 1073741824', 
+                                         'temp_store = MEMORY', 
+                                         'busy_timeout = 30000'],
+                             'maintenance_seconds': 300},
+                     'bulk': {'pragmas': ['journal_mode = WAL', 
+                                          'synchronous = OFF', 
+                                          'cache_size = -1048576', #--1gb
+                                          'mmap_size = 4294967296', 
+                                          'temp_store = MEMORY', 
+                                          'busy_timeout = 60000'],
+                              'maintenance_seconds': 60}}
+
+class DatamartConnectionPool():
+
+    #---------------------------------------
+    def __init__(self, datamartConnectionStr, **kwargs):
+        self.datamartConnectionStr = datamartConnectionStr
+
+        #--at most this many connections are open, callers wait for one to be returned
+        self.pool_size = kwargs['pool_size'] if 'pool_size' in kwargs else 4
+        self.acquire_timeout = kwargs['acquire_timeout'] if 'acquire_timeout' in kwargs else None
+
+        #--connections idle this long are closed, ones idle this long are checked before being handed out
+        self.idle_seconds = kwargs['idle_seconds'] if 'idle_seconds' in kwargs else 300
+        self.health_check_seconds = kwargs['health_check_seconds'] if 'health_check_seconds' in kwargs else 30
+
+        #--run on every new sqlite connection after the profile's, ie: ['journal_mode = WAL', 'synchronous = NORMAL']
+        self.datamart_profile = kwargs['datamart_profile'] if 'datamart_profile' in kwargs and kwargs['datamart_profile'] else 'default'
+        if self.datamart_profile not in datamart_profiles:
+            raise Exception(f'unknown datamart profile {self.datamart_profile}')
+        self.sqlite_pragmas = datamart_profiles[self.datamart_profile]['pragmas'] + (kwargs['sqlite_pragmas'] if 'sqlite_pragmas' in kwargs else [])
+
+        self.idle_list = [] #--[dbo, time returned], the most recently returned is handed out first
+        self.open_count = 0
+        self.pool_lock = threading.Condition()
+
+    #---------------------------------------
+    def acquire(self):
+        with self.pool_lock:
+            while True:
+                self.evict_idle()
+                while self.idle_list:
+                    dbo, returned_time = self.idle_list.pop()
+                    if time.time() - returned_time < self.health_check_seconds or self.check_connection(dbo):
+                        return dbo
+                    self.close_connection(dbo)
+                if self.open_count < self.pool_size:
+                    self.open_count += 1
+                    break
+                if not self.pool_lock.wait(self.acquire_timeout):
+                    raise Exception(f'no datamart connection available after {self.acquire_timeout} seconds')
+
+        #--opened outside the lock so a slow connect doesn't hold up returns
+        try: return self.open_connection()
+        except:
+            with self.pool_lock:
+                self.open_count -= 1
+                self.pool_lock.notify()
+            raise
+
+    #---------------------------------------
+    def release(self, dbo, suspect=False):
+        #--a connection that just had an error is checked so a dead one isn't handed out again
+        healthy = self.check_connection(dbo) if suspect else True
+        with self.pool_lock:
+            if healthy:
+                self.idle_list.append([dbo, time.time()])
+            else:
+                self.close_connection(dbo)
+            self.evict_idle()
+            self.pool_lock.notify()
+
+    #---------------------------------------
+    def open_connection(self):
+        dbo = G2Database(self.datamartConnectionStr)
+        if dbo.dbType == 'SQLITE3':
+            for pragma in self.sqlite_pragmas:
+                dbo.sqlExec('pragma ' + pragma)
+        return dbo
+
+    #---------------------------------------
+    def check_connection(self, dbo):
+        if dbo.dbType == 'DB2':
+            sql_stmt = 'select 1 from sysibm.sysdummy1'
+        elif dbo.dbType == 'ORACLE':
+            sql_stmt = 'select 1 from dual'
+        else:
+            sql_stmt = 'select 1'
+        try: dbo.fetchRow(dbo.sqlExec(sql_stmt))
+        except: return False
+        return True
+
+    #---------------------------------------
+    def close_connection(self, dbo):
+        #--only called with the pool lock held
+        self.open_count -= 1
+        try: dbo.close()
+        except: pass
+
+    #---------------------------------------
+    def evict_idle(self):
+        #--only called with the pool lock held, the oldest are at the front
+        while self.idle_list and time.time() - self.idle_list[0][1] >= self.idle_seconds:
+            self.close_connection(self.idle_list.pop(0)[0])
+
+    #---------------------------------------
+    def close(self):
+        with self.pool_lock:
+            while self.idle_list:
+                self.close_connection(self.idle_list.pop()[0])
+
+class EntityLocks():
+
+    #---------------------------------------
+    def __init__(self):
+        #--the entities each replicator sharing these locks is syncing, held until its transaction ends
+        self.owner_list = {} #--entity_id: owner
+        self.held_list = {} #--owner: set of entity_ids
+        self.wanted_list = set() #--owners another is waiting on
+        self.lock_condition = threading.Condition()
+
+    #---------------------------------------
+    def acquire(self, owner, entity_id_list, before_wait=None):
+        #--all or nothing, before_wait is called once outside the lock so the owner can give up its own locks first
+        while True:
+            with self.lock_condition:
+                busy_list = [x for x in entity_id_list if self.owner_list.get(x, owner) is not owner]
+                if not busy_list:
+                    self.take(owner, entity_id_list)
+                    return
+                if not before_wait:
+                    self.wanted_list.update(self.owner_list[x] for x in busy_list)
+                    self.lock_condition.wait()
+                    continue
+            before_wait()
+            before_wait = None
+
+    #---------------------------------------
+    def try_acquire(self, owner, entity_id_list):
+        #--takes the entities that are free and returns the ones another owner is syncing
+        with self.lock_condition:
+            busy_list = [x for x in entity_id_list if self.owner_list.get(x, owner) is not owner]
+            self.take(owner, [x for x in entity_id_list if x not in busy_list])
+        return busy_list
+
+    #---------------------------------------
+    def take(self, owner, entity_id_list):
+        if owner not in self.held_list:
+            self.held_list[owner] = set()
+        for entity_id in entity_id_list:
+            self.owner_list[entity_id] = owner
+            self.held_list[owner].add(entity_id)
+
+    #---------------------------------------
+    def is_wanted(self, owner):
+        #--so an owner holding locks in an open transaction knows to commit
+        return owner in self.wanted_list
+
+    #---------------------------------------
+    def release(self, owner):
+        with self.lock_condition:
+            self.wanted_list.discard(owner)
+            if self.held_list.get(owner):
+                for entity_id in self.held_list.pop(owner):
+                    del self.owner_list[entity_id]
+                self.lock_condition.notify_all()
+
 class Replicator():
 
     #---------------------------------------
@@ -27,8 +212,65 @@ class Replicator():
         self.calculate_reports = kwargs['calculate_reports'] if 'calculate_reports' in kwargs else True
 
         self.stat_log = {}
+        self.stat_lock = threading.Lock()
         self.max_resume_hash_len = 250
 
+        #--resume hashes are written as binary (default on sqlite) or csv (default elsewhere), either can always be read
+        #--long binary hashes are compressed with zlib (default) or zstd if the zstandard module is installed
+        self.resume_hash_format = kwargs['resume_hash_format'] if 'resume_hash_format' in kwargs else None
+        self.resume_hash_compression = kwargs['resume_hash_compression'] if 'resume_hash_compression' in kwargs else 'zlib'
+        if self.resume_hash_compression == 'zstd' and not zstandard:
+            print('\nzstandard module not installed, using zlib for resume hashes\n')
+            self.resume_hash_compression = 'zlib'
+        self.binary_hash_version = b'\x02' #--never the first byte of a legacy zlib hash
+        self.binary_hash_compression = {'none': b'\x00', 'zlib': b'\x01', 'zstd': b'\x02'}
+        self.max_in_list_size = 500 #--ids per "where ... in (...)" query
+        self.sql_stmt_cache = {} #--statements built from field lists, keyed by table, operation and fields
+
+        #--group commit: wrap this many messages or milliseconds of work in one transaction (0 = autocommit)
+        self.commit_message_count = kwargs['commit_message_count'] if 'commit_message_count' in kwargs else 0
+        self.commit_interval_ms = kwargs['commit_interval_ms'] if 'commit_interval_ms' in kwargs else 0
+        self.group_commit = self.commit_message_count > 0 or self.commit_interval_ms > 0
+        self.transaction_open = False
+        self.transaction_start = 0
+        self.pending_message_count = 0
+        self.pending_commit_list = []
+
+        #--sum DM_REPORT deltas in memory and flush them every this many messages or milliseconds (0 = write through)
+        #--they are also flushed just before each group commit
+        self.report_flush_message_count = kwargs['report_flush_message_count'] if 'report_flush_message_count' in kwargs else 0
+        self.report_flush_interval_ms = kwargs['report_flush_interval_ms'] if 'report_flush_interval_ms' in kwargs else 0
+        self.buffer_reports = self.report_flush_message_count > 0 or self.report_flush_interval_ms > 0
+
+        #--buffered report deltas must commit with the entity changes they came from, so they need a group commit
+        if self.buffer_reports and not self.group_commit:
+            print('\nbuffered reports need group commit, committing at the report flush interval\n')
+            self.commit_message_count = self.report_flush_message_count
+            self.commit_interval_ms = self.report_flush_interval_ms
+            self.group_commit = True
+        self.report_deltas = {}
+        self.report_message_count = 0
+        self.report_flush_start = time.time()
+
+        #--lru cache of datamart entity resumes, only safe when this replicator owns its entities (0 = off)
+        self.resume_cache_size = kwargs['resume_cache_size'] if 'resume_cache_size' in kwargs else 0
+        self.resume_cache = OrderedDict()
+
+        #--threads to fetch entity resumes from the engine in parallel (0 or 1 = one at a time)
+        self.fetch_threads = kwargs['fetch_threads'] if 'fetch_threads' in kwargs else 0
+        self.fetch_executor = None
+
+        #--engine resumes already fetched for the batch being replicated (None = not replicating)
+        self.g2_resume_memo = None
+
+        #--how many levels of newly related entities to resync per message, the rest go to DM_RESYNC_QUEUE
+        #--the budget caps the related entities resynced per message (0 = no limit)
+        self.resync_max_depth = kwargs['resync_max_depth'] if 'resync_max_depth' in kwargs else 1
+        self.resync_entity_budget = kwargs['resync_entity_budget'] if 'resync_entity_budget' in kwargs else 0
+
+        #--shared by replicators on other threads so two of them never sync the same entity at once (None = not shared)
+        self.entity_locks = kwargs['entity_locks'] if 'entity_locks' in kwargs else None
+
         self.custom_entity_fields = False
         self.custom_record_fields = False
         self.custom_relation_fields = False
@@ -50,10 +292,44 @@ class Replicator():
             except Exception as err:
                 raise Exception(err) 
 
-        #--each thread needs its own database connection
-        try: self.dbo = G2Database(datamartConnectionStr)
-        except Exception as err:
-            raise Exception(err)
+        #--sqlite performance profile, a pool applies its own profile to the connections it opens
+        self.datamart_profile = kwargs['datamart_profile'] if 'datamart_profile' in kwargs and kwargs['datamart_profile'] else 'default'
+        if self.datamart_profile not in datamart_profiles:
+            raise Exception(f'unknown datamart profile {self.datamart_profile}')
+        self.maintenance_seconds = datamart_profiles[self.datamart_profile]['maintenance_seconds']
+        self.maintenance_time = time.time()
+
+        #--run on the replicator's own sqlite connection after the profile's, ie: ['journal_mode = WAL', 'synchronous = NORMAL']
+        self.sqlite_pragmas = datamart_profiles[self.datamart_profile]['pragmas'] + (kwargs['sqlite_pragmas'] if 'sqlite_pragmas' in kwargs else [])
+
+        #--each thread needs its own database connection, borrowed from the pool if there is one
+        #--a connection supplied by the caller is used as is and left open on close
+        self.connection_pool = kwargs['connection_pool'] if 'connection_pool' in kwargs else None
+        self.datamart_dbo = kwargs['datamart_dbo'] if 'datamart_dbo' in kwargs else None
+        self.close_datamart_dbo = not self.datamart_dbo
+        if not self.connection_pool and not self.datamart_dbo:
+            try: 
+                self.datamart_dbo = G2Database(datamartConnectionStr)
+                if self.datamart_dbo.dbType == 'SQLITE3':
+                    for pragma in self.sqlite_pragmas:
+                        self.datamart_dbo.sqlExec('pragma ' + pragma)
+            except Exception as err:
+                raise Exception(err)
+
+        #--datamarts created before the resync queue or resume table get them here, each is left unused if it can't be created
+        self.replication_status = 0
+        self.resync_queue_enabled = self.check_dm_resync_queue()
+        self.entity_resume_enabled = self.check_dm_entity_resume()
+
+        #--binary hashes are raw bytes which only sqlite's RESUME_HASH columns take, the other schemas declare them VARCHAR(500)
+        datamart_db_type = self.dbo.dbType
+        self.release_dm_connection()
+        if datamart_db_type != 'SQLITE3':
+            if self.resume_hash_format == 'binary':
+                print(f'\nbinary resume hashes are only supported on sqlite, using csv for {datamart_db_type}\n')
+            self.resume_hash_format = 'csv'
+        elif not self.resume_hash_format:
+            self.resume_hash_format = 'binary'
 
         self.get_entity_flags = 0
         self.get_entity_flags = self.get_entity_flags | self.g2Engine.G2_ENTITY_INCLUDE_ENTITY_NAME
@@ -76,73 +352,634 @@ class Replicator():
                                       'PR': 'POSSIBLY_RELATED'}
 
     #---------------------------------------
-    def replicate(self, response_str):
+    @property
+    def dbo(self):
+        #--a pooled connection is borrowed on first use and kept until release_dm_connection
+        if not self.datamart_dbo:
+            self.datamart_dbo = self.connection_pool.acquire()
+        return self.datamart_dbo
+
+    #---------------------------------------
+    def release_dm_connection(self):
+        #--an open group commit transaction keeps its connection and its entity locks
+        if self.transaction_open:
+            return
+        if self.entity_locks:
+            self.entity_locks.release(self)
+        if self.connection_pool and self.datamart_dbo:
+            self.connection_pool.release(self.datamart_dbo, self.replication_status == 2)
+            self.datamart_dbo = None
+
+    #---------------------------------------
+    def lock_entities(self, entity_id_list):
+        #--waits for the ones another replicator is syncing, committing first so it never waits holding locks of its own
+        if self.entity_locks:
+            self.entity_locks.acquire(self, [int(x) for x in entity_id_list], self.unlock_entities)
+
+    #---------------------------------------
+    def try_lock_entities(self, entity_id_list):
+        #--returns the ones another replicator is syncing
+        if not self.entity_locks:
+            return []
+        return self.entity_locks.try_acquire(self, [int(x) for x in entity_id_list])
+
+    #---------------------------------------
+    def unlock_entities(self):
+        if self.transaction_open:
+            self.commit_dm_transaction()
+        self.release_dm_connection()
+
+    #---------------------------------------
+    def replicate(self, response_str, on_commit=None, g2_resume_list=None):
+        return self.replicate_batch([response_str], on_commit, g2_resume_list)[0]
+
+    #---------------------------------------
+    def replicate_batch(self, response_str_list, on_commit=None, g2_resume_list=None):
         self.replication_status = 0
         self.replication_dt = datetime.strftime(datetime.now(), '%Y-%m-%d %H:%M:%S')
 
-        response_json = json.loads(response_str)
-        # {
-        #   "DATA_SOURCE": "CUSTOMER",
-        #   "RECORD_ID": "1001",
-        #   "AFFECTED_ENTITIES": [
-        #     {
-        #       "ENTITY_ID": 1,
-        #       "LENS_CODE": "DEFAULT"
-        #     }
-        #   ],
-        #   "INTERESTING_ENTITIES": []
-        # }
+        #--engine resumes fetched after the messages arrived, ie: by a fetch stage ahead of this one, are checked once the entities are locked
+        prefetch_resume_list = g2_resume_list
+        self.g2_resume_memo = {}
+
+        #--a batch that raises is undone so a later commit of the group can't write half of it
+        savepoint_open = False
+        try:
+            #--each message gets its own status so the caller can still ack or fail each one
+            #--0=success, 1=api error, 2=sql error, 3=invalid message
+            batch_status = [0] * len(response_str_list)
+            response_json_list = []
+
+            #--records and entities are de-duped across the batch and track which messages they came from
+            record_list = {}
+            affected_entity_list = {}
+
+            for message_index in range(len(response_str_list)):
+                try: response_json = json.loads(response_str_list[message_index])
+                except Exception as err:
+                    self.log_stat('replicate', 'invalid_message', str(err))
+                    batch_status[message_index] = 3
+                    response_json_list.append(None)
+                    continue
+                #--well formed json that is not a withinfo message would otherwise fail the whole batch
+                if not isinstance(response_json, dict) or 'DATA_SOURCE' not in response_json or 'RECORD_ID' not in response_json:
+                    self.log_stat('replicate', 'invalid_message', 'missing DATA_SOURCE or RECORD_ID')
+                    batch_status[message_index] = 3
+                    response_json_list.append(None)
+                    continue
+                response_json_list.append(response_json)
+                # {
+                #   "DATA_SOURCE": "CUSTOMER",
+                #   "RECORD_ID": "1001",
+                #   "AFFECTED_ENTITIES": [
+                #     {
+                #       "ENTITY_ID": 1,
+                #       "LENS_CODE": "DEFAULT"
+                #     }
+                #   ],
+                #   "INTERESTING_ENTITIES": []
+                # }
+
+                in_data_source = response_json['DATA_SOURCE']
+                in_record_id = response_json['RECORD_ID']
+
+                self.debug_print()
+                self.debug_print('-' * 50)
+                self.debug_print('incoming', 'record', f'{in_data_source}: {in_record_id}')
+                self.debug_print('withinfo-message', response_json)
+
+                #--hopefully the only time a record needs to be added is here!
+                #--however, the only time you really know what entity_id was assigned to the incoming record
+                #--is if there is only one affected entity, otherwise set it to 0 and the correct
+                #--affected entity will update it
+                #--note: the last message in the batch for a record wins
+                affected_entity_data = response_json.get('AFFECTED_ENTITIES', [])
+                if len(affected_entity_data) == 1:
+                    entity_id = affected_entity_data[0]['ENTITY_ID']
+                else:
+                    entity_id = 0
+                record_key = (in_data_source, in_record_id)
+                if record_key not in record_list:
+                    record_list[record_key] = [entity_id, []]
+                else:
+                    self.log_stat('replicate', 'duplicate record', f'{in_data_source}: {in_record_id}')
+                record_list[record_key][0] = entity_id
+                record_list[record_key][1].append(message_index)
+
+                #--the lowest level an entity was affected at decides how it is synced
+                entity_level = 0
+                for affected_entity in affected_entity_data:
+                    entity_id = affected_entity['ENTITY_ID']
+                    if entity_id not in affected_entity_list:
+                        affected_entity_list[entity_id] = [entity_level, []]
+                    else:
+                        self.log_stat('replicate', 'duplicate entity', f'entity_id: {entity_id}')
+                        affected_entity_list[entity_id][0] = min(entity_level, affected_entity_list[entity_id][0])
+                    affected_entity_list[entity_id][1].append(message_index)
+                    entity_level += 1
+
+            #--locked before the transaction starts as waiting for them may commit it
+            self.lock_entities(list(affected_entity_list))
+
+            #--in group commit mode the batch joins the open transaction and can be undone on its own
+            if self.group_commit:
+                self.begin_dm_transaction()
+                report_deltas = self.copy_report_deltas()
+                self.dbo.sqlExec('savepoint replicate_batch')
+                savepoint_open = True
+
+            #--sync each distinct record once
+            for record_key in record_list:
+                self.replication_status = 0
+                self.sync_dm_record(record_key[0], record_key[1], record_list[record_key][0])
+                self.set_batch_status(batch_status, record_list[record_key][1])
+            self.debug_print('-' * 50)
+
+            #--sync each distinct affected entity once
+            dm_resume_list = self.get_resume_dm_many(list(affected_entity_list))
+            if prefetch_resume_list:
+                self.use_prefetch_resumes(prefetch_resume_list, dm_resume_list)
+            g2_resume_list = self.get_resume_g2_api_many(list(affected_entity_list))
+            full_resync_list = {}
+            for entity_id in affected_entity_list:
+                entity_level, message_index_list = affected_entity_list[entity_id]
+                self.replication_status = 0
+                resync_entity_list = self.replicate_entity(entity_id, f'affected entity {entity_level}', dm_resume_list[entity_id], g2_resume_list[entity_id], in_batch=True)
+                self.set_batch_status(batch_status, message_index_list)
+                for related_id in resync_entity_list:
+                    if related_id not in full_resync_list:
+                        full_resync_list[related_id] = []
+                    full_resync_list[related_id].extend(message_index_list)
+
+            #--must also sync any newly related entities, and theirs in turn, up to the depth and entity budget
+            self.resync_related_entities(full_resync_list, batch_status, set(affected_entity_list), self.resync_max_depth, self.resync_entity_budget * len(response_str_list))
+
+            if self.custom_alert_processor:
+                for message_index in range(len(response_json_list)):
+                    response_json = response_json_list[message_index]
+                    if not response_json:
+                        continue
+                    self.replication_status = 0
+                    for interesting_entity_data in response_json.get('INTERESTING_ENTITIES', []):
+                        self.process_interesting_entity(response_json['DATA_SOURCE'], response_json['RECORD_ID'], interesting_entity_data)
+                    self.set_batch_status(batch_status, [message_index])
+
+            self.replication_status = max(batch_status) if batch_status else 0
+
+            #--the on_commit callback gets the batch status list once the changes are durable
+            #--so the caller only acknowledges the source messages after the commit
+            if self.group_commit:
+                if 2 in batch_status:
+                    #--undo just this batch so the rest of the group can still commit
+                    self.rollback_dm_savepoint('replicate_batch', report_deltas)
+                    batch_status = [2 if x == 0 else x for x in batch_status]
+                else:
+                    self.dbo.sqlExec('release savepoint replicate_batch')
+                savepoint_open = False
+                self.report_message_count += len(response_str_list)
+                if not self.transaction_open:
+                    if on_commit:
+                        on_commit(batch_status)
+                else:
+                    self.pending_message_count += len(response_str_list)
+                    self.pending_commit_list.append([on_commit, batch_status])
+                    if not self.check_dm_commit():
+                        self.check_dm_report_flush()
+            else:
+                self.report_message_count += len(response_str_list)
+                self.check_dm_report_flush()
+                if on_commit:
+                    on_commit(batch_status)
+        except:
+            if savepoint_open:
+                self.rollback_dm_savepoint('replicate_batch', report_deltas)
+            self.release_dm_connection()
+            raise
+        finally:
+            self.g2_resume_memo = None
+
+        self.check_dm_maintenance()
+        self.release_dm_connection()
+        return batch_status
+
+    #---------------------------------------
+    def resync_related_entities(self, full_resync_list, batch_status, visited_list, max_depth, resync_budget):
+        #--full_resync_list maps each entity to resync to the messages that caused it
+        #--visited entities were already synced in this batch so relationship cycles stop here
+        resync_count = 0
+        resync_depth = 1
+        while full_resync_list:
+            work_list = {}
+            for related_id in full_resync_list:
+                if related_id not in visited_list:
+                    work_list[related_id] = full_resync_list[related_id]
+            if not work_list:
+                break
+
+            #--entities another replicator is syncing are left for it or for the resync queue
+            busy_list = self.try_lock_entities(list(work_list))
+            if busy_list:
+                self.defer_resync(busy_list, 'entity_locked')
+                work_list = {x: work_list[x] for x in work_list if x not in busy_list}
+                if not work_list:
+                    break
 
-        in_data_source = response_json['DATA_SOURCE'] 
-        in_record_id = response_json['RECORD_ID']
+            #--anything past the depth or budget is deferred rather than dropped
+            if resync_depth > max_depth:
+                self.defer_resync(list(work_list), 'max_depth')
+                break
+            if resync_budget:
+                if resync_count + len(work_list) > resync_budget:
+                    keep_count = max(resync_budget - resync_count, 0)
+                    self.defer_resync(list(work_list)[keep_count:], 'entity_budget')
+                    work_list = {x: work_list[x] for x in list(work_list)[:keep_count]}
+                if not work_list:
+                    break
 
-        self.debug_print()
-        self.debug_print('-' * 50)
-        self.debug_print('incoming', 'record', f'{in_data_source}: {in_record_id}')
-        self.debug_print('withinfo-message', response_json)
+            #--note: prefetched level by level as the prior level may have just updated some of them
+            visited_list.update(work_list)
+            g2_resume_list = self.get_resume_g2_api_many(list(work_list))
+            dm_resume_list = self.get_resume_dm_many(list(work_list))
+            full_resync_list = {}
+            for related_id in work_list:
+                self.replication_status = 0
+                resync_entity_list = self.replicate_entity(related_id, f'related cycle {resync_depth}', dm_resume_list[related_id], g2_resume_list[related_id], in_batch=True)
+                self.set_batch_status(batch_status, work_list[related_id])
+                for new_related_id in resync_entity_list:
+                    if new_related_id not in full_resync_list:
+                        full_resync_list[new_related_id] = []
+                    full_resync_list[new_related_id].extend(work_list[related_id])
+            resync_count += len(work_list)
+            resync_depth += 1
+
+        return resync_count
 
-        #--hopefully the only time a record needs to be added is here!
-        #--however, the only time you really know what entity_id was assigned to the incoming record
-        #--is if there is only one affected entity, otherwise set it to 0 and the correct
-        #--affected entity will update it
-        if len(response_json['AFFECTED_ENTITIES']) == 1: 
-            entity_id = response_json['AFFECTED_ENTITIES'][0]['ENTITY_ID']
+    #---------------------------------------
+    def rebuild_entities(self, entity_id_list):
+        #--a full rebuild syncs every entity anyway so newly related entities are not followed
+        #--returns the number of entities that failed
+        self.replication_dt = datetime.strftime(datetime.now(), '%Y-%m-%d %H:%M:%S')
+        if self.group_commit:
+            self.begin_dm_transaction()
+
+        g2_resume_list = self.get_resume_g2_api_many(entity_id_list)
+        dm_resume_list = self.get_resume_dm_many(entity_id_list)
+        error_count = 0
+        for entity_id in entity_id_list:
+            self.replication_status = 0
+            self.replicate_entity(entity_id, 'rebuild', dm_resume_list[entity_id], g2_resume_list[entity_id], in_batch=True)
+            if self.replication_status:
+                error_count += 1
+
+        if self.group_commit:
+            self.pending_message_count += len(entity_id_list)
+            self.check_dm_commit()
         else:
-            entity_id = 0
-        self.sync_dm_record(in_data_source, in_record_id, entity_id)
-        self.debug_print('-' * 50)
+            self.check_dm_report_flush()
+        self.release_dm_connection()
+        return error_count
+
+    #---------------------------------------
+    def audit_entities(self, entity_id_list):
+        #--read only, the engine resume hash is encoded just as replicate_entity would store it
+        #--returns the entity ids replicate_entity would change, including ones only left in the datamart
+        g2_resume_list = self.get_resume_g2_api_many(entity_id_list)
+        dm_resume_list = self.get_resume_dm_many(entity_id_list)
+        mismatch_list = []
+        for entity_id in entity_id_list:
+            if dm_resume_list[entity_id]['RESUME_HASH'] == g2_resume_list[entity_id]['RESUME_HASH']:
+                self.log_stat('audit', 'match')
+            elif not dm_resume_list[entity_id]['RESUME_HASH']:
+                self.log_stat('audit', 'missing_from_datamart', entity_id)
+                mismatch_list.append(entity_id)
+            elif not g2_resume_list[entity_id]['RESUME_HASH']:
+                self.log_stat('audit', 'missing_from_g2', entity_id)
+                mismatch_list.append(entity_id)
+            elif self.audit_resume_data(dm_resume_list[entity_id], g2_resume_list[entity_id]):
+                #--a hash written in another format, such as a legacy csv one, is left for the next replication to rewrite
+                self.log_stat('audit', 'format_only', entity_id)
+            else:
+                self.log_stat('audit', 'mismatch', entity_id)
+                mismatch_list.append(entity_id)
+        self.release_dm_connection()
+        return mismatch_list
 
-        #--sync each affected entity
-        full_resync_list = []
-        entity_level = 0
-        for affected_entity in response_json['AFFECTED_ENTITIES']:
-            entity_id = affected_entity['ENTITY_ID']
-            resync_entity_list = self.replicate_entity(entity_id, f'affected entity {entity_level}')
-            full_resync_list.extend(resync_entity_list)
-            entity_level += 1
+    #---------------------------------------
+    def audit_resume_data(self, dm_entity_resume, g2_entity_resume):
+        #--true if the datamart hash decodes to the engine's records and relationships, a damaged one never matches
+        resume_hash = dm_entity_resume['RESUME_HASH']
+        try: 
+            if resume_hash[0:5] == '~sha~':
+                resume_data = self.get_resume_data_dm(dm_entity_resume['ENTITY_ID'], resume_hash)
+            else:
+                resume_data = self.resume_hash_decode(resume_hash)
+        except Exception:
+            return False
+        return resume_data is not None and self.resume_summary_key(resume_data) == self.resume_summary_key(g2_entity_resume)
 
-        #--must also sync any newly related entities
-        new_resync_list = []
-        for related_id in set(full_resync_list):
-            resync_entity_list = self.replicate_entity(related_id, 'related cycle 1')
-            new_resync_list.extend(resync_entity_list)
+    #---------------------------------------
+    def resume_summary_key(self, entity_resume):
+        #--the records and relationships of a resume in the same order and types whatever format it came from
+        record_summary = {x: sorted(str(y) for y in entity_resume['RECORD_SUMMARY'][x]) for x in entity_resume['RECORD_SUMMARY']}
+        relation_summary = {str(x): (int(y['MATCH_LEVEL']), y['MATCH_KEY'] or '', y['MATCH_CATEGORY'] or '', sorted(y['DATA_SOURCES'])) 
+                            for x, y in entity_resume['RELATION_SUMMARY'].items()}
+        return record_summary, relation_summary
 
-        #--capture any leftover related entities for possible recursive process
-        if new_resync_list: 
-            self.log_stat('replicate', 'leftover entities', ', '.join([str(x) for x in new_resync_list]))
+    #---------------------------------------
+    def check_dm_table(self, table_name, create_stmt_list, disabled_reason):
+        #--datamarts created before a table was added get it here, returns False if it can't be created
+        try: 
+            self.dbo.fetchRow(self.dbo.sqlExec(f'select count(*) from {table_name} where 1 = 0'))
+            return True
+        except: 
+            pass
 
-        if self.custom_alert_processor:
-            for interesting_entity_data in response_json['INTERESTING_ENTITIES']:
-                self.process_interesting_entity(in_data_source, in_record_id, interesting_entity_data)
+        #--a failed statement can leave the connection in an aborted transaction
+        try: self.dbo.sqlExec('rollback')
+        except: pass
 
-        return self.replication_status
+        try:
+            for sql_stmt in create_stmt_list:
+                self.dbo.sqlExec(sql_stmt)
+        except Exception as err:
+            print(f'\n{table_name} could not be created, {disabled_reason}: {err}\n')
+            return False
+        finally:
+            self.release_dm_connection()
+        self.log_stat('table_created', table_name)
+        return True
 
     #---------------------------------------
-    def replicate_entity(self, entity_id, sync_type):
+    def id_column_type(self):
+        return 'NUMBER(19)' if self.dbo.dbType == 'ORACLE' else 'BIGINT'
+
+    #---------------------------------------
+    def check_dm_resync_queue(self):
+        return self.check_dm_table('DM_RESYNC_QUEUE',
+                                   [f'create table DM_RESYNC_QUEUE (ENTITY_ID {self.id_column_type()} NOT NULL, QUEUED_DT TIMESTAMP, PRIMARY KEY(ENTITY_ID))',
+                                    'create index IX_DM_RESYNC_QUEUE on DM_RESYNC_QUEUE (QUEUED_DT)'],
+                                   'related entities past the resync depth or budget are not resynced until an audit finds them')
+
+    #---------------------------------------
+    def check_dm_entity_resume(self):
+        blob_type = 'BYTEA' if self.dbo.dbType == 'POSTGRESQL' else 'LONGBLOB' if self.dbo.dbType == 'MYSQL' else 'BLOB'
+        return self.check_dm_table('DM_ENTITY_RESUME',
+                                   [f'create table DM_ENTITY_RESUME (ENTITY_ID {self.id_column_type()} NOT NULL, RESUME_HASH VARCHAR(500), RESUME_DATA {blob_type}, PRIMARY KEY(ENTITY_ID))'],
+                                   'entities too large for their resume hash are read back from the datamart tables instead')
+
+    #---------------------------------------
+    def check_dm_rebuild_range(self):
+        text_type = 'CLOB' if self.dbo.dbType in ('ORACLE', 'DB2') else 'TEXT'
+        return self.check_dm_table('DM_REBUILD_RANGE',
+                                   [f'create table DM_REBUILD_RANGE (RANGE_START {self.id_column_type()} NOT NULL, RANGE_END {self.id_column_type()} NOT NULL, '
+                                    f'ENTITY_COUNT {self.id_column_type()}, STAT_LOG {text_type}, COMPLETED_DT TIMESTAMP, PRIMARY KEY(RANGE_START))'],
+                                   'the rebuild cannot be checkpointed')
+
+    #---------------------------------------
+    def defer_resync(self, entity_id_list, reason):
+        #--a failure here is only logged as the entities are still consistent up to the last replicated message
+        self.log_stat('resync_queue', reason, f'{len(entity_id_list)} entities')
+        if not self.resync_queue_enabled:
+            self.log_stat('resync_queue', 'not_queued', f'{len(entity_id_list)} entities')
+            return
+        try: self.insert_skip_dm_rows('DM_RESYNC_QUEUE', ['ENTITY_ID'], ['ENTITY_ID', 'QUEUED_DT'], [[int(x), self.replication_dt] for x in entity_id_list])
+        except Exception as err:
+            self.log_stat('sql_error', 'defer_resync', str(err))
+
+    #---------------------------------------
+    def drain_resync_queue(self, max_entities=100):
+        #--call when idle, each drained entity gets a fresh depth and budget
+        if not self.resync_queue_enabled:
+            return 0
+        self.replication_status = 0
+        self.replication_dt = datetime.strftime(datetime.now(), '%Y-%m-%d %H:%M:%S')
+        try: 
+            sql_stmt = 'select ENTITY_ID from DM_RESYNC_QUEUE order by QUEUED_DT, ENTITY_ID'
+            if self.dbo.dbType in ('DB2', 'ORACLE'):
+                sql_stmt += f' fetch first {int(max_entities)} rows only'
+            else:
+                sql_stmt += f' limit {int(max_entities)}'
+            entity_id_list = [x[0] for x in self.dbo.fetchAllRows(self.dbo.sqlExec(sql_stmt))]
+        except Exception as err:
+            self.log_stat('sql_error', 'drain_resync_queue', str(err))
+            self.replication_status = 2
+            self.release_dm_connection()
+            return 0
+        if not entity_id_list:
+            self.release_dm_connection()
+            return 0
+
+        #--entities another replicator is syncing stay queued
+        busy_list = self.try_lock_entities(entity_id_list)
+        if busy_list:
+            entity_id_list = [x for x in entity_id_list if x not in busy_list]
+            if not entity_id_list:
+                self.release_dm_connection()
+                return 0
+
+        #--an exception is undone just like a failed batch
+        savepoint_open = False
+        try:
+            if self.group_commit:
+                self.begin_dm_transaction()
+                report_deltas = self.copy_report_deltas()
+                self.dbo.sqlExec('savepoint drain_resync_queue')
+                savepoint_open = True
+
+            #--the drained entities themselves are always resynced, only what they lead to can be deferred again
+            batch_status = [0]
+            self.g2_resume_memo = {}
+            self.resync_related_entities({x: [0] for x in entity_id_list}, batch_status, set(), max(self.resync_max_depth, 1), self.resync_entity_budget * len(entity_id_list))
+            if batch_status[0] != 2:
+                sql_stmt = 'delete from DM_RESYNC_QUEUE where ENTITY_ID = ?'
+                try: self.exec_many_dm(sql_stmt, [[int(x)] for x in entity_id_list])
+                except Exception as err:
+                    self.log_stat('sql_error', 'drain_resync_queue', str(err))
+                    batch_status[0] = 2
+            self.replication_status = batch_status[0]
+
+            if self.group_commit:
+                if batch_status[0] == 2:
+                    self.rollback_dm_savepoint('drain_resync_queue', report_deltas)
+                else:
+                    self.dbo.sqlExec('release savepoint drain_resync_queue')
+                savepoint_open = False
+                if not self.check_dm_commit():
+                    self.check_dm_report_flush()
+            else:
+                self.check_dm_report_flush()
+        except:
+            if savepoint_open:
+                self.rollback_dm_savepoint('drain_resync_queue', report_deltas)
+            self.release_dm_connection()
+            raise
+        finally:
+            self.g2_resume_memo = None
+        self.log_stat('resync_queue', 'drained' if batch_status[0] != 2 else 'drain_failed', f'{len(entity_id_list)} entities')
+        self.check_dm_maintenance()
+        self.release_dm_connection()
+        return len(entity_id_list)
+
+    #---------------------------------------
+    def exec_many_dm(self, sql_stmt, values_list):
+        if hasattr(self.dbo, 'execMany'):
+            return self.dbo.execMany(sql_stmt, values_list)
+        for values in values_list:
+            self.dbo.sqlExec(sql_stmt, values)
+
+    #---------------------------------------
+    def set_batch_status(self, batch_status, message_index_list):
+        #--a message keeps the worst status of any record or entity it touched
+        for message_index in message_index_list:
+            batch_status[message_index] = max(batch_status[message_index], self.replication_status)
+
+    #---------------------------------------
+    #--transaction handling
+    #---------------------------------------
+
+    #---------------------------------------
+    def begin_dm_transaction(self):
+        if not self.transaction_open:
+            self.dbo.sqlExec(self.begin_stmt())
+            self.transaction_open = True
+            self.transaction_start = time.time()
+
+    #---------------------------------------
+    def begin_stmt(self):
+        #--sqlite takes the write lock up front so a transaction that started with a read 
+        #--waits out the busy timeout instead of failing when another writer got there first
+        return 'begin immediate' if self.dbo.dbType == 'SQLITE3' else 'begin'
+
+    #---------------------------------------
+    def check_dm_commit(self):
+        #--also call this when idle so the interval is honored without new messages
+        if not self.transaction_open:
+            return False
+        elapsed_ms = (time.time() - self.transaction_start) * 1000
+        if (self.commit_message_count and self.pending_message_count >= self.commit_message_count) or \
+           (self.commit_interval_ms and elapsed_ms >= self.commit_interval_ms) or \
+           (self.entity_locks and self.entity_locks.is_wanted(self)):
+            self.commit_dm_transaction()
+            self.release_dm_connection()
+            return True
+        return False
+
+    #---------------------------------------
+    def commit_dm_transaction(self):
+        if not self.transaction_open:
+            return 0
+
+        #--the report deltas go in the same transaction as the entity changes they came from
+        commit_status = self.flush_dm_report()
+        if commit_status == 0:
+            try: self.dbo.sqlExec('commit')
+            except Exception as err:
+                self.log_stat('sql_error', 'commit', str(err))
+                commit_status = 2
+            else:
+                self.log_stat('transaction', 'commit', f'{self.pending_message_count} messages')
+        if commit_status:
+            self.rollback_dm_transaction()
+        self.transaction_open = False
+        self.notify_dm_commit(commit_status)
+        return commit_status
+
+    #---------------------------------------
+    def notify_dm_commit(self, commit_status):
+        pending_commit_list = self.pending_commit_list
+        self.pending_commit_list = []
+        self.pending_message_count = 0
+
+        #--only now is it safe for the caller to acknowledge the messages
+        for on_commit, batch_status in pending_commit_list:
+            if commit_status:
+                batch_status = [max(x, commit_status) for x in batch_status]
+            if on_commit:
+                on_commit(batch_status)
+
+    #---------------------------------------
+    def rollback_dm_savepoint(self, savepoint_name, report_deltas):
+        #--undoes one batch of an open group commit, the rest of the group can still commit
+        #--if even that fails the whole group is rolled back and its messages failed
+        try: 
+            self.dbo.sqlExec(f'rollback to savepoint {savepoint_name}')
+            self.dbo.sqlExec(f'release savepoint {savepoint_name}')
+        except Exception as err:
+            self.log_stat('sql_error', 'rollback_savepoint', str(err))
+            self.rollback_dm_transaction()
+            self.notify_dm_commit(2)
+        self.clear_resume_cache()
+        self.report_deltas = report_deltas
+        self.log_stat('transaction', 'batch_rollback')
+
+    #---------------------------------------
+    def rollback_dm_transaction(self):
+        try: self.dbo.sqlExec('rollback')
+        except Exception as err:
+            self.log_stat('sql_error', 'rollback', str(err))
+        self.transaction_open = False
+        self.clear_resume_cache()
+        self.report_deltas = {}
+
+    #---------------------------------------
+    def copy_report_deltas(self):
+        #--so a batch undone to its savepoint can also undo its report deltas
+        return {x: list(self.report_deltas[x]) for x in self.report_deltas}
+
+    #---------------------------------------
+    def check_dm_report_flush(self):
+        #--also call this when idle so the interval is honored without new messages
+        if not self.report_deltas:
+            return False
+        elapsed_ms = (time.time() - self.report_flush_start) * 1000
+        if (self.report_flush_message_count and self.report_message_count >= self.report_flush_message_count) or \
+           (self.report_flush_interval_ms and elapsed_ms >= self.report_flush_interval_ms):
+            if self.transaction_open:
+                self.commit_dm_transaction()
+            else:
+                self.flush_dm_report()
+            self.release_dm_connection()
+            return True
+        return False
+
+    #---------------------------------------
+    def check_dm_maintenance(self, force=False):
+        #--keeps the sqlite wal file from growing without bound and the query planner statistics current
+        #--also call this when idle, it waits for any open group commit transaction
+        if self.transaction_open or not (self.maintenance_seconds or force):
+            return False
+        if not force and time.time() - self.maintenance_time < self.maintenance_seconds:
+            return False
+        self.maintenance_time = time.time()
+        if self.dbo.dbType != 'SQLITE3':
+            return False
+        try: 
+            self.dbo.fetchAllRows(self.dbo.sqlExec('pragma wal_checkpoint(PASSIVE)'))
+            self.dbo.fetchAllRows(self.dbo.sqlExec('pragma optimize'))
+        except Exception as err:
+            self.log_stat('sql_error', 'maintenance', str(err))
+            return False
+        self.log_stat('maintenance', 'checkpoint')
+        return True
+
+    #---------------------------------------
+    def close(self):
+        self.commit_dm_transaction()
+        self.flush_dm_report()
+        if self.maintenance_seconds:
+            self.check_dm_maintenance(True)
+        self.release_dm_connection()
+        if not self.connection_pool and self.close_datamart_dbo:
+            self.dbo.close()
+        if self.fetch_executor:
+            self.fetch_executor.shutdown()
+
+    #---------------------------------------
+    def replicate_entity(self, entity_id, sync_type, dm_entity_resume=None, g2_entity_resume=None, in_batch=False):
 
         #--setting this again as process may  be called directly to resync an entire entity
-        called_by = sys._getframe().f_back.f_code.co_name
-        if called_by != 'replicate':
+        #--a batch or rebuild has already set it for all of its entities
+        if not in_batch:
             self.replication_dt = datetime.strftime(datetime.now(), '%Y-%m-%d %H:%M:%S')
 
         current_entity_reference = f'entity_id: {entity_id}'
@@ -150,12 +987,14 @@ class Replicator():
             print()
         self.log_stat('request', sync_type, current_entity_reference)
 
-        #--get current entity summary
-        g2_entity_resume = self.get_resume_g2_api(entity_id)
+        #--get current entity summary (unless prefetched)
+        if not g2_entity_resume:
+            g2_entity_resume = self.get_resume_g2_api(entity_id)
         self.debug_print('g2_resume', g2_entity_resume)
 
-        #--get prior entity summary and bypass if no changes
-        dm_entity_resume = self.get_resume_dm(entity_id)
+        #--get prior entity summary (unless prefetched) and bypass if no changes
+        if not dm_entity_resume:
+            dm_entity_resume = self.get_resume_dm(entity_id)
         if dm_entity_resume['RESUME_HASH'] == g2_entity_resume['RESUME_HASH']:
             self.log_stat(sync_type, 'no_change', entity_id)
             return [] #--is expecting a list of related entities to sync
@@ -169,6 +1008,7 @@ class Replicator():
 
         #--note the resume contains entity size which should be zero if deleted
         self.sync_dm_entity(entity_id, sync_type, g2_entity_resume)
+        self.sync_dm_entity_resume(entity_id, g2_entity_resume, dm_entity_resume)
 
         #--perform a net change to see what records and relationships to add/delete
         nc_entity_resume = self.net_change_resume(entity_id, g2_entity_resume, dm_entity_resume)
@@ -198,13 +1038,16 @@ class Replicator():
         nc_entity_resume['G2_REPORT_SUMMARY'] = {'RESOLVED': g2_entity_resume['RECORD_SUMMARY']}
         nc_entity_resume['DM_REPORT_SUMMARY'] = {'RESOLVED': dm_entity_resume['RECORD_SUMMARY']}
 
+        #--sets for the membership checks so very large entities diff in linear time
+        g2_record_ids = {x: set(g2_entity_resume['RECORD_SUMMARY'][x]) for x in g2_entity_resume['RECORD_SUMMARY']}
+        dm_record_ids = {x: set(dm_entity_resume['RECORD_SUMMARY'][x]) for x in dm_entity_resume['RECORD_SUMMARY']}
+
         #--new records to add
         for data_source in g2_entity_resume['RECORD_SUMMARY']:
             for record_id in g2_entity_resume['RECORD_SUMMARY'][data_source]:
-                current_record_reference = f"{data_source}: {record_id}"
-                record = {'DATA_SOURCE': data_source, 'RECORD_ID': record_id}
-                if not (data_source in dm_entity_resume['RECORD_SUMMARY'] and \
-                        record_id in dm_entity_resume['RECORD_SUMMARY'][data_source]):
+                if not (data_source in dm_record_ids and record_id in dm_record_ids[data_source]):
+                    current_record_reference = f"{data_source}: {record_id}"
+                    record = {'DATA_SOURCE': data_source, 'RECORD_ID': record_id}
 
                     if data_source not in dm_entity_resume['RECORD_SUMMARY']:
                         data_source_list_changed = True
@@ -226,10 +1069,9 @@ class Replicator():
         for data_source in dm_entity_resume['RECORD_SUMMARY']:
             deleted_cnt = 0
             for record_id in dm_entity_resume['RECORD_SUMMARY'][data_source]:
-                current_record_reference = f"{data_source}: {record_id}"
-                record = {'DATA_SOURCE': data_source, 'RECORD_ID': record_id}
-                if not (data_source in g2_entity_resume['RECORD_SUMMARY'] and \
-                        record_id in g2_entity_resume['RECORD_SUMMARY'][data_source]):
+                if not (data_source in g2_record_ids and record_id in g2_record_ids[data_source]):
+                    current_record_reference = f"{data_source}: {record_id}"
+                    record = {'DATA_SOURCE': data_source, 'RECORD_ID': record_id}
                     deleted_cnt += 1
                     db_response = self.detach_dm_record(current_record_reference, record['DATA_SOURCE'], record['RECORD_ID'], entity_id)
                     if db_response == 0:
@@ -343,11 +1185,13 @@ class Replicator():
                 report_data['ADD_RELATED_IDS'] = []
                 report_data['DELETE_RELATED_IDS'] = []
                 if 'RELATED_IDS' in g2_report_stats[report_key]:
+                    g2_related_ids = set(map(str, g2_report_stats[report_key]['RELATED_IDS']))
+                    dm_related_ids = set(map(str, dm_report_stats[report_key]['RELATED_IDS']))
                     for related_id in g2_report_stats[report_key]['RELATED_IDS']:
-                        if str(related_id) not in dm_report_stats[report_key]['RELATED_IDS']:
+                        if str(related_id) not in dm_related_ids:
                             report_data['ADD_RELATED_IDS'].append(related_id)
                     for related_id in dm_report_stats[report_key]['RELATED_IDS']:
-                        if str(related_id) not in g2_report_stats[report_key]['RELATED_IDS']:
+                        if str(related_id) not in g2_related_ids:
                             report_data['DELETE_RELATED_IDS'].append(related_id)
                 self.log_stat('report_key', 'updated', report_key)
                 self.debug_print('report_key', report_key, report_data)
@@ -365,7 +1209,7 @@ class Replicator():
                 self.debug_print('g2 stat record', g2_report_stats[report_key])
                 self.debug_print('dm stat record', dm_report_stats[report_key] if report_key in dm_report_stats else 'not found')
                 self.debug_print('diff record', report_data)
-                input('press any key ..')
+                self.debug_pause()
 
         #--undo prior stats that are no longer valid
         for report_key in dm_report_stats:
@@ -383,7 +1227,7 @@ class Replicator():
                 response = self.sync_dm_report(report_data)
                 if response != 0:
                     self.debug_print('diff record', report_data)
-                    input('press any key ..')
+                    self.debug_pause()
 
 
     #---------------------------------------
@@ -466,6 +1310,158 @@ class Replicator():
                ('|' + report_data['DATA_SOURCE1'] if 'DATA_SOURCE1' in report_data else '') + \
                ('|' + report_data['DATA_SOURCE2'] if 'DATA_SOURCE2' in report_data else '')
 
+    #---------------------------------------
+    def calc_dm_report_stats(self):
+        #--yields each entity's report stats rebuilt from DM_RECORD and DM_RELATION in entity id order
+        #--the stats themselves come from calc_report_stats so the report keys are the same as the incremental ones
+        sql_stmt = 'select ENTITY_ID, DATA_SOURCE, count(*) from DM_RECORD where ENTITY_ID > 0 ' \
+                   'group by ENTITY_ID, DATA_SOURCE order by ENTITY_ID, DATA_SOURCE'
+        record_cursor = self.dbo.sqlExec(sql_stmt)
+        sql_stmt = 'select ENTITY_ID, RELATED_ID, MATCH_CATEGORY, DATA_SOURCES from DM_RELATION order by ENTITY_ID, RELATED_ID'
+        relation_cursor = self.dbo.sqlExec(sql_stmt)
+
+        record_row = self.dbo.fetchRow(record_cursor)
+        relation_row = self.dbo.fetchRow(relation_cursor)
+        while record_row:
+            entity_id = record_row[0]
+
+            #--only the number of records per data source matters to the stats
+            report_summary = {'RESOLVED': {}}
+            while record_row and record_row[0] == entity_id:
+                report_summary['RESOLVED'][record_row[1]] = [None] * record_row[2]
+                record_row = self.dbo.fetchRow(record_cursor)
+
+            #--relationships of an entity with no records have no stats
+            while relation_row and relation_row[0] < entity_id:
+                relation_row = self.dbo.fetchRow(relation_cursor)
+            while relation_row and relation_row[0] == entity_id:
+                match_category = relation_row[2]
+                if match_category not in report_summary:
+                    report_summary[match_category] = {}
+                for data_source in self.parse_csv_string(relation_row[3]):
+                    if data_source not in report_summary[match_category]:
+                        report_summary[match_category][data_source] = [str(relation_row[1])]
+                    else:
+                        report_summary[match_category][data_source].append(str(relation_row[1]))
+                relation_row = self.dbo.fetchRow(relation_cursor)
+
+            yield entity_id, self.calc_report_stats(entity_id, report_summary)
+
+    #---------------------------------------
+    def sum_dm_report_stats(self, detail_callback, detail_chunk_size=10000):
+        #--totals every report key, detail rows go to the callback in entity id order along with the last entity id
+        #--they cover, the last call covers everything after with None
+        report_counts = {}
+
+        #--these two are counted straight from the tables
+        for row in self.dbo.fetchAllRows(self.dbo.sqlExec('select count(*) from DM_ENTITY')):
+            if row[0]:
+                report_counts['TOTAL|ENTITY_COUNT'] = ['TOTAL', 'ENTITY_COUNT', None, None, row[0], 0, 0]
+        for row in self.dbo.fetchAllRows(self.dbo.sqlExec('select DATA_SOURCE, count(*) from DM_RECORD group by DATA_SOURCE')):
+            report_data = {'REPORT': 'DSS', 'DATA_SOURCE1': row[0], 'STATISTIC': 'RECORD_COUNT'}
+            report_counts[self.calc_report_key(report_data)] = ['DSS', 'RECORD_COUNT', row[0], None, 0, row[1], 0]
+
+        detail_list = []
+        for entity_id, report_stats in self.calc_dm_report_stats():
+            for report_key in report_stats:
+                report_data = report_stats[report_key]
+                if report_key not in report_counts:
+                    report_counts[report_key] = [report_data['REPORT'], 
+                                                 report_data['STATISTIC'], 
+                                                 report_data['DATA_SOURCE1'] if 'DATA_SOURCE1' in report_data else None, 
+                                                 report_data['DATA_SOURCE2'] if 'DATA_SOURCE2' in report_data else None, 
+                                                 0, 0, 0]
+                report_counts[report_key][4] += self.get_stat_count(report_data, 'ENTITY_COUNT')
+                report_counts[report_key][5] += self.get_stat_count(report_data, 'RECORD_COUNT')
+                report_counts[report_key][6] += self.get_stat_count(report_data, 'RELATION_COUNT')
+                if 'RELATED_IDS' in report_data:
+                    detail_list.extend([[report_key, entity_id, int(x)] for x in report_data['RELATED_IDS']])
+                elif 'ENTITY_ID' in report_data and report_data['ENTITY_ID']:
+                    detail_list.append([report_key, entity_id, 0])
+            if len(detail_list) >= detail_chunk_size:
+                detail_callback(detail_list, entity_id)
+                detail_list = []
+        detail_callback(detail_list, None)
+
+        return report_counts
+
+    #---------------------------------------
+    def rebuild_dm_report(self):
+        #--replaces DM_REPORT and DM_REPORT_DETAIL with what the entities, records and relationships add up to
+        #--ie: after a bulk load with calculate_reports off
+        self.commit_dm_transaction()
+        self.report_deltas = {}
+        self.dbo.sqlExec(self.begin_stmt())
+        try: 
+            self.dbo.sqlExec('delete from DM_REPORT')
+            self.dbo.sqlExec('delete from DM_REPORT_DETAIL')
+            sql_stmt = 'insert into DM_REPORT_DETAIL (REPORT_KEY, ENTITY_ID, RELATED_ID) values (?, ?, ?)'
+            report_counts = self.sum_dm_report_stats(lambda detail_list, last_entity_id: self.exec_many_dm(sql_stmt, detail_list))
+            sql_stmt = 'insert into DM_REPORT (' \
+                       ' REPORT_KEY, ' \
+                       ' REPORT, ' \
+                       ' STATISTIC, ' \
+                       ' DATA_SOURCE1, ' \
+                       ' DATA_SOURCE2, ' \
+                       ' ENTITY_COUNT, ' \
+                       ' RECORD_COUNT, ' \
+                       ' RELATION_COUNT) ' \
+                       'values (?, ?, ?, ?, ?, ?, ?, ?)'
+            self.exec_many_dm(sql_stmt, [[x] + report_counts[x] for x in report_counts])
+            self.dbo.sqlExec('commit')
+        except Exception as err:
+            self.log_stat('sql_error', 'rebuild_dm_report', str(err))
+            self.dbo.sqlExec('rollback')
+            self.release_dm_connection()
+            return 2
+        self.log_stat('report', 'rebuilt', f'{len(report_counts)} keys')
+        self.release_dm_connection()
+        return 0
+
+    #---------------------------------------
+    def verify_dm_report(self, max_differences=100):
+        #--compares DM_REPORT and DM_REPORT_DETAIL to what the entities, records and relationships add up to
+        #--returns the number of differences and the first few of them, counts that are all zero are not differences
+        difference_list = []
+        difference_count = [0]
+        def add_difference(difference):
+            difference_count[0] += 1
+            if len(difference_list) < max_differences:
+                difference_list.append(difference)
+
+        #--the detail rows are compared one range of entities at a time
+        prior_entity_id = [None]
+        def check_details(detail_list, last_entity_id):
+            sql_stmt = 'select REPORT_KEY, ENTITY_ID, RELATED_ID from DM_REPORT_DETAIL where 1 = 1'
+            sql_values = []
+            if prior_entity_id[0] is not None:
+                sql_stmt += ' and ENTITY_ID > ?'
+                sql_values.append(prior_entity_id[0])
+            if last_entity_id is not None:
+                sql_stmt += ' and ENTITY_ID <= ?'
+                sql_values.append(last_entity_id)
+            dm_detail_set = set(tuple(x) for x in self.dbo.fetchAllRows(self.dbo.sqlExec(sql_stmt, sql_values if sql_values else None)))
+            calc_detail_set = set(tuple(x) for x in detail_list)
+            for detail in sorted(calc_detail_set - dm_detail_set):
+                add_difference({'DETAIL': 'missing', 'REPORT_KEY': detail[0], 'ENTITY_ID': detail[1], 'RELATED_ID': detail[2]})
+            for detail in sorted(dm_detail_set - calc_detail_set):
+                add_difference({'DETAIL': 'extra', 'REPORT_KEY': detail[0], 'ENTITY_ID': detail[1], 'RELATED_ID': detail[2]})
+            prior_entity_id[0] = last_entity_id
+
+        report_counts = self.sum_dm_report_stats(check_details)
+
+        sql_stmt = 'select REPORT_KEY, ENTITY_COUNT, RECORD_COUNT, RELATION_COUNT from DM_REPORT'
+        dm_report_counts = {x[0]: list(x[1:]) for x in self.dbo.fetchAllRows(self.dbo.sqlExec(sql_stmt))}
+        for report_key in sorted(set(report_counts) | set(dm_report_counts)):
+            calc_counts = report_counts[report_key][4:] if report_key in report_counts else [0, 0, 0]
+            dm_counts = dm_report_counts[report_key] if report_key in dm_report_counts else [0, 0, 0]
+            if [x or 0 for x in dm_counts] != calc_counts:
+                add_difference({'REPORT_KEY': report_key, 'DATAMART': dm_counts, 'CALCULATED': calc_counts})
+
+        self.log_stat('report', 'verified', f'{difference_count[0]} differences')
+        self.release_dm_connection()
+        return difference_count[0], difference_list
+
     #---------------------------------------
     #--dm_entity database calls
     #---------------------------------------
@@ -516,27 +1512,11 @@ class Replicator():
                 update_fields.extend(custom_fields)
                 update_values.extend(custom_values)
 
-        insert_success = False
-        update_success = False
-
         #--try insert first on level 0 
         #--this may or may not be worth it, but entity should already exist on all other sync types
-        if sync_type == 'affected entity 0':
-            response = self.insert_dm_entity(entity_id, insert_fields, insert_values)
-            insert_success = True if response == 0 else False
-            if response == 1: #--duplicate key 
-                update_values.append(entity_id)
-                response = self.update_dm_entity(entity_id, update_fields, update_values)
-                update_success = True if response == 0 else False
-
-        #--try update first as prior entity was changed
-        else:
-            update_values.append(entity_id)
-            response = self.update_dm_entity(entity_id, update_fields, update_values)
-            update_success = True if response == 0 else False
-            if response == 1: #--no rows updated 
-                response = self.insert_dm_entity(entity_id, insert_fields, insert_values)
-                update_success = True if response == 0 else False
+        response, upsert_action = self.upsert_dm_entity(entity_id, insert_fields, insert_values, update_fields, update_values, sync_type == 'affected entity 0')
+        insert_success = response == 0 and upsert_action == 'insert'
+        update_success = response == 0 and upsert_action == 'update'
 
         if insert_success:
             self.log_stat(sync_type, 'insert', current_entity_reference)
@@ -545,35 +1525,53 @@ class Replicator():
         elif update_success:
             self.log_stat(sync_type, 'update', current_entity_reference)
 
+        #--remember what was just written so the next change to this entity can skip the read
+        if insert_success or update_success:
+            self.set_resume_cache(entity_id, g2_entity_resume['RECORD_COUNT'], g2_entity_resume['RESUME_HASH'])
+        else:
+            self.clear_resume_cache(entity_id)
+
+    #---------------------------------------
+    def sync_dm_entity_resume(self, entity_id, g2_entity_resume, dm_entity_resume):
+        #--failures are only logged as a missing or stale resume just falls back to rebuild_resume_dm
+        if not self.entity_resume_enabled:
+            return
+        if g2_entity_resume['RECORD_COUNT'] != 0 and g2_entity_resume['RESUME_HASH'][0:5] == '~sha~' and g2_entity_resume.get('RESUME_DATA'):
+            sql_stmt = 'update DM_ENTITY_RESUME set RESUME_HASH = ?, RESUME_DATA = ? where ENTITY_ID = ?'
+            try: 
+                db_response = self.dbo.sqlExec(sql_stmt, [g2_entity_resume['RESUME_HASH'], g2_entity_resume['RESUME_DATA'], int(entity_id)])
+                if db_response['ROWS_AFFECTED'] == 0:
+                    sql_stmt = 'insert into DM_ENTITY_RESUME (ENTITY_ID, RESUME_HASH, RESUME_DATA) values (?, ?, ?)'
+                    self.dbo.sqlExec(sql_stmt, [int(entity_id), g2_entity_resume['RESUME_HASH'], g2_entity_resume['RESUME_DATA']])
+            except Exception as err:
+                self.log_stat('sql_error', 'sync_entity_resume', f'entity_id: {entity_id}')
+                self.debug_print('sql_error', str(err))
+
+        #--the entity no longer needs it
+        elif dm_entity_resume['RESUME_HASH'][0:5] == '~sha~':
+            self.delete_dm_entity_resume(entity_id)
+
     #---------------------------------------
-    def insert_dm_entity(self, entity_id, insert_fields, insert_values):
-        sql_stmt = 'insert into DM_ENTITY (' + ','.join(insert_fields) + ')'
-        sql_stmt += ' values (' + ','.join(['?'] * len(insert_fields)) + ')'
-        try: self.dbo.sqlExec(sql_stmt, insert_values)
+    def delete_dm_entity_resume(self, entity_id):
+        sql_stmt = 'delete from DM_ENTITY_RESUME where ENTITY_ID = ?'
+        try: self.dbo.sqlExec(sql_stmt, [int(entity_id)])
         except Exception as err:
-            if 'UNIQUE' in str(err).upper():
-                return 1 #--duplicate key violation
-            else:
-                self.log_stat('sql_error', 'insert_entity', f'entity_id: {entity_id}')
-                self.debug_print('\t' + str(err))
-                self.replication_status = 2 #--sql error
-                return 2
-        return 0 #--success
+            self.log_stat('sql_error', 'delete_entity_resume', f'entity_id: {entity_id}')
+            self.debug_print('sql_error', str(err))
 
     #---------------------------------------
-    def update_dm_entity(self, entity_id, update_fields, update_values):
-        sql_stmt = 'update DM_ENTITY set ' + ','.join(['%s = ?' % x for x in update_fields])
-        sql_stmt += ' where ENTITY_ID = ?'
-        try: db_response = self.dbo.sqlExec(sql_stmt, update_values)
+    def upsert_dm_entity(self, entity_id, insert_fields, insert_values, update_fields, update_values, insert_first):
+        try: response, upsert_action = self.upsert_dm_row('DM_ENTITY', ['ENTITY_ID'], insert_fields, insert_values, update_fields, update_values, insert_first)
         except Exception as err:
-            self.log_stat('sql_error', 'update_entity', f'entity_id: {entity_id}')
+            self.log_stat('sql_error', 'upsert_entity', f'entity_id: {entity_id}')
             self.debug_print('sql_error', str(err))
             self.replication_status = 2 #--sql error
-            return 2
-        return 0 if db_response['ROWS_AFFECTED'] == 1 else 1
+            return 2, None
+        return response, upsert_action
 
     #---------------------------------------
     def delete_dm_entity(self, entity_id):
+        self.clear_resume_cache(entity_id)
         sql_stmt = 'delete from DM_ENTITY where ENTITY_ID = ?'
         try: db_response = self.dbo.sqlExec(sql_stmt, entity_id)
         except Exception as err:
@@ -595,7 +1593,7 @@ class Replicator():
             response = self.delete_dm_record(current_record_reference, data_source, record_id)
             if response == 0: #--success
                 self.log_stat('record', 'delete', current_record_reference)
-                self.sync_dm_report({'REPORT': 'DSS', 'DATA_SOURCE1': data_source, 'RECORD_COUNT': -1})
+                self.sync_dm_report({'REPORT': 'DSS', 'DATA_SOURCE1': data_source, 'STATISTIC': 'RECORD_COUNT', 'RECORD_COUNT': -1})
             return
 
         insert_fields = ['DATA_SOURCE', 'RECORD_ID', 'ENTITY_ID', 'FIRST_SEEN_DT', 'LAST_SEEN_DT']
@@ -622,47 +1620,26 @@ class Replicator():
                 update_values.extend(custom_values)
 
         #--always try insert first on records
-        response = self.insert_dm_record(current_record_reference, insert_fields, insert_values)
-        if response == 0: #--success
+        response, upsert_action = self.upsert_dm_record(current_record_reference, insert_fields, insert_values, update_fields, update_values)
+        if response == 0 and upsert_action == 'insert':
             self.log_stat('record', 'insert', current_record_reference)
             self.sync_dm_report({'REPORT': 'DSS', 
                                  'DATA_SOURCE1': data_source, 
                                  'STATISTIC': 'RECORD_COUNT', 
                                  'RECORD_COUNT': 1})
 
-        elif response == 1: #--duplicate key
-            update_values.append(data_source)
-            update_values.append(record_id)
-            response = self.update_dm_record(current_record_reference, update_fields, update_values)
-            if response == 0:
-                self.log_stat('record', 'update', current_record_reference)
+        elif response == 0 and upsert_action == 'update':
+            self.log_stat('record', 'update', current_record_reference)
 
     #---------------------------------------
-    def insert_dm_record(self, current_record_reference, insert_fields, insert_values):
-        sql_stmt = 'insert into DM_RECORD (' + ','.join(insert_fields) + ')'
-        sql_stmt += ' values (' + ','.join(['?'] * len(insert_fields)) + ')'
-        try: self.dbo.sqlExec(sql_stmt, insert_values)
+    def upsert_dm_record(self, current_record_reference, insert_fields, insert_values, update_fields, update_values):
+        try: response, upsert_action = self.upsert_dm_row('DM_RECORD', ['DATA_SOURCE', 'RECORD_ID'], insert_fields, insert_values, update_fields, update_values, True)
         except Exception as err:
-            if 'UNIQUE' in str(err).upper():
-                return 1 #--duplicate key violation
-            else:
-                self.log_stat('sql_error', 'insert_record', current_record_reference)
-                self.debug_print('sql_error', str(err))
-                self.replication_status = 2 #--sql error
-                return 2
-        return 0 #--success
-
-    #---------------------------------------
-    def update_dm_record(self, current_record_reference, update_fields, update_values):
-        sql_stmt = 'update DM_RECORD set ' + ','.join(['%s = ?' % x for x in update_fields])
-        sql_stmt += ' where DATA_SOURCE = ? and RECORD_ID = ?'
-        try: db_response = self.dbo.sqlExec(sql_stmt, update_values)
-        except Exception as err:
-            self.log_stat('sql_error', 'update_record', current_record_reference)
+            self.log_stat('sql_error', 'upsert_record', current_record_reference)
             self.debug_print('sql_error', str(err))
             self.replication_status = 2 #--sql error
-            return 2
-        return 0 if db_response['ROWS_AFFECTED'] == 1 else 1
+            return 2, None
+        return response, upsert_action
 
     #---------------------------------------
     def delete_dm_record(self, current_record_reference, data_source, record_id):
@@ -704,6 +1681,107 @@ class Replicator():
             return 2
         return 0 if db_response['ROWS_AFFECTED'] == 1 else 1
 
+    #---------------------------------------
+    #--upserts
+    #---------------------------------------
+
+    #---------------------------------------
+    def get_sql_stmt(self, table_name, operation, key_fields, insert_fields=(), update_fields=()):
+        #--the field lists only vary with the custom field hooks so each statement is built once
+        #--the unchanged text also lets the driver reuse its prepared statement
+        cache_key = (table_name, operation, tuple(key_fields), tuple(insert_fields), tuple(update_fields))
+        if cache_key in self.sql_stmt_cache:
+            return self.sql_stmt_cache[cache_key]
+
+        into_clause = 'into ' + table_name + ' (' + ','.join(insert_fields) + ')' + \
+                      ' values (' + ','.join(['?'] * len(insert_fields)) + ')'
+        insert_stmt = 'insert ' + into_clause
+        set_clause = ','.join(['%s = ?' % x for x in update_fields])
+        if operation == 'insert':
+            sql_stmt = insert_stmt
+        elif operation == 'insert_skip':
+            if self.dbo.dbType == 'MYSQL':
+                sql_stmt = 'insert ignore ' + into_clause
+            else:
+                sql_stmt = insert_stmt + ' on conflict (' + ','.join(key_fields) + ') do nothing'
+        elif operation == 'select_count':
+            sql_stmt = 'select count(*) from ' + table_name + \
+                       ' where ' + ' and '.join(['%s = ?' % x for x in key_fields])
+        elif operation == 'update':
+            sql_stmt = 'update ' + table_name + ' set ' + set_clause + \
+                       ' where ' + ' and '.join(['%s = ?' % x for x in key_fields])
+        elif operation in ('upsert', 'upsert_returning'):
+            if self.dbo.dbType == 'MYSQL':
+                sql_stmt = insert_stmt + ' on duplicate key update ' + set_clause
+            else:
+                sql_stmt = insert_stmt + ' on conflict (' + ','.join(key_fields) + ') do update set ' + set_clause
+            #--xmax is only zero on a row this statement inserted
+            if operation == 'upsert_returning':
+                sql_stmt += ' returning (xmax = 0)'
+        else:
+            raise ValueError(f'unknown sql operation {operation}')
+
+        self.sql_stmt_cache[cache_key] = sql_stmt
+        return sql_stmt
+
+    #---------------------------------------
+    def upsert_dm_row(self, table_name, key_fields, insert_fields, insert_values, update_fields, update_values, insert_first):
+        #--returns the response and whether the row was inserted or updated as the report counts depend on it
+        #--sql errors are left to the caller
+        key_values = [insert_values[insert_fields.index(x)] for x in key_fields]
+
+        #--one statement that says whether it inserted
+        if self.dbo.dbType == 'POSTGRESQL':
+            sql_stmt = self.get_sql_stmt(table_name, 'upsert_returning', key_fields, insert_fields, update_fields)
+            db_response = self.dbo.sqlExec(sql_stmt, insert_values + update_values)
+            row = self.dbo.fetchRow(db_response)
+            if not row:
+                return 1, None
+            return 0, 'insert' if row[0] else 'update'
+
+        #--one statement, mysql counts an update as two rows affected
+        if self.dbo.dbType == 'MYSQL':
+            sql_stmt = self.get_sql_stmt(table_name, 'upsert', key_fields, insert_fields, update_fields)
+            db_response = self.dbo.sqlExec(sql_stmt, insert_values + update_values)
+            return 0, 'insert' if db_response['ROWS_AFFECTED'] == 1 else 'update'
+
+        update_stmt = self.get_sql_stmt(table_name, 'update', key_fields, update_fields=update_fields)
+
+        #--the insert skips an existing row instead of raising a duplicate key error
+        if self.dbo.dbType == 'SQLITE3':
+            insert_stmt = self.get_sql_stmt(table_name, 'insert_skip', key_fields, insert_fields)
+            if insert_first:
+                if self.dbo.sqlExec(insert_stmt, insert_values)['ROWS_AFFECTED'] == 1:
+                    return 0, 'insert'
+                if self.dbo.sqlExec(update_stmt, update_values + key_values)['ROWS_AFFECTED'] == 1:
+                    return 0, 'update'
+                return 1, None
+        else:
+            insert_stmt = self.get_sql_stmt(table_name, 'insert', key_fields, insert_fields)
+
+        #--any other database only inserts when there was nothing to update
+        if self.dbo.sqlExec(update_stmt, update_values + key_values)['ROWS_AFFECTED'] == 1:
+            return 0, 'update'
+        if self.dbo.sqlExec(insert_stmt, insert_values)['ROWS_AFFECTED'] == 1:
+            return 0, 'insert'
+        return 1, None
+
+    #---------------------------------------
+    def insert_skip_dm_rows(self, table_name, key_fields, insert_fields, insert_values_list):
+        #--inserts the rows that are not already there, sql errors are left to the caller
+        if self.dbo.dbType in ('SQLITE3', 'POSTGRESQL', 'MYSQL'):
+            sql_stmt = self.get_sql_stmt(table_name, 'insert_skip', key_fields, insert_fields)
+            self.exec_many_dm(sql_stmt, insert_values_list)
+            return
+
+        #--any other database checks first as a duplicate key error may fail the transaction
+        select_stmt = self.get_sql_stmt(table_name, 'select_count', key_fields)
+        insert_stmt = self.get_sql_stmt(table_name, 'insert', key_fields, insert_fields)
+        for insert_values in insert_values_list:
+            key_values = [insert_values[insert_fields.index(x)] for x in key_fields]
+            if self.dbo.fetchRow(self.dbo.sqlExec(select_stmt, key_values))[0] == 0:
+                self.dbo.sqlExec(insert_stmt, insert_values)
+
     #---------------------------------------
     #--dm_relationsip database calls
     #---------------------------------------
@@ -736,10 +1814,7 @@ class Replicator():
                          match_category, 
                          data_sources,
                          self.replication_dt]
-        sql_stmt = 'insert into DM_RELATION (' + ','.join(insert_fields) + ')' + \
-                   ' values (' + ','.join(['?'] * len(insert_fields)) + ')' + \
-                   ' on conflict (ENTITY_ID, RELATED_ID) do update set '  + \
-                   ','.join(['%s = ?' % x for x in update_fields])
+        sql_stmt = self.get_sql_stmt('DM_RELATION', 'upsert', ['ENTITY_ID', 'RELATED_ID'], insert_fields, update_fields)
         try: db_response = self.dbo.sqlExec(sql_stmt, insert_values + update_values)
         except Exception as err:
             self.log_stat('sql_error', 'upsert_relation', f'entity_id: {entity_id}, related_id: {related_id}')
@@ -770,12 +1845,22 @@ class Replicator():
         record_count = report_data['RECORD_COUNT'] if 'RECORD_COUNT' in report_data else 0
         relation_count = report_data['RELATION_COUNT'] if 'RELATION_COUNT' in report_data else 0
 
-        #--try update first as the actual statistic only needs to be added once
-        dm_report_action = 'update'
-        response = self.update_dm_report(report_key, entity_count, record_count, relation_count)
-        if response != 0:
-            dm_report_action = 'insert'
-            response = self.insert_dm_report(report_key, entity_count, record_count, relation_count, report_data)
+        #--buffered deltas are written by flush_dm_report
+        if self.buffer_reports:
+            dm_report_action = 'buffer'
+            self.add_report_delta(report_key, entity_count, record_count, relation_count, report_data)
+            response = 0
+        else:
+            #--try update first as the actual statistic only needs to be added once
+            dm_report_action = 'update'
+            response = self.update_dm_report(report_key, entity_count, record_count, relation_count)
+            if response != 0:
+                dm_report_action = 'insert'
+                response = self.insert_dm_report(report_key, entity_count, record_count, relation_count, report_data)
+                #--another replicator may have inserted it since the update
+                if response != 0:
+                    dm_report_action = 'update'
+                    response = self.update_dm_report(report_key, entity_count, record_count, relation_count)
 
         detail_updated = False
         if 'ADD_ENTITY_ID' in report_data and report_data['ADD_ENTITY_ID'] and response == 0:
@@ -788,17 +1873,11 @@ class Replicator():
 
         if 'ADD_RELATED_IDS' in report_data and report_data['ADD_RELATED_IDS'] and response == 0:
             detail_updated = True
-            for related_id in report_data['ADD_RELATED_IDS']:
-                response = self.insert_dm_report_detail(report_key, report_data['ENTITY_ID'], related_id)
-                if response != 0:
-                    break
+            response = self.insert_dm_report_details(report_key, [[report_data['ENTITY_ID'], x] for x in report_data['ADD_RELATED_IDS']])
 
         if 'DELETE_RELATED_IDS' in report_data  and report_data['DELETE_RELATED_IDS'] and response == 0:
             detail_updated = True
-            for related_id in report_data['DELETE_RELATED_IDS']:
-                response = self.delete_dm_report_detail(report_key, report_data['ENTITY_ID'], related_id)
-                if response != 0:
-                    break
+            response = self.delete_dm_report_details(report_key, [[report_data['ENTITY_ID'], x] for x in report_data['DELETE_RELATED_IDS']])
 
         #--log stat update with no detail
         if not detail_updated:
@@ -806,6 +1885,81 @@ class Replicator():
 
         return response
 
+    #---------------------------------------
+    def add_report_delta(self, report_key, entity_count, record_count, relation_count, report_data):
+        if not self.report_deltas:
+            self.report_message_count = 0
+            self.report_flush_start = time.time()
+        if report_key not in self.report_deltas:
+            self.report_deltas[report_key] = [report_data['REPORT'],
+                                              report_data['STATISTIC'],
+                                              report_data['DATA_SOURCE1'] if 'DATA_SOURCE1' in report_data else None,
+                                              report_data['DATA_SOURCE2'] if 'DATA_SOURCE2' in report_data else None,
+                                              0, 0, 0]
+        report_delta = self.report_deltas[report_key]
+        report_delta[4] += entity_count
+        report_delta[5] += record_count
+        report_delta[6] += relation_count
+
+    #---------------------------------------
+    def flush_dm_report(self):
+        #--one upsert per report key no matter how many messages changed it
+        #--in key order so replicators flushing at the same time lock the rows in the same order
+        if not self.report_deltas:
+            return 0
+
+        #--outside of group commit the flush is still applied all or nothing
+        own_transaction = not self.transaction_open
+        if own_transaction:
+            self.dbo.sqlExec(self.begin_stmt())
+
+        response = 0
+        try: 
+            if self.dbo.dbType in ('SQLITE3', 'POSTGRESQL'):
+                sql_stmt = 'insert into DM_REPORT (' \
+                           ' REPORT_KEY, ' \
+                           ' REPORT, ' \
+                           ' STATISTIC, ' \
+                           ' DATA_SOURCE1, ' \
+                           ' DATA_SOURCE2, ' \
+                           ' ENTITY_COUNT, ' \
+                           ' RECORD_COUNT, ' \
+                           ' RELATION_COUNT) ' \
+                           'values (?, ?, ?, ?, ?, ?, ?, ?) ' \
+                           'on conflict (REPORT_KEY) do update set ' \
+                           ' ENTITY_COUNT = DM_REPORT.ENTITY_COUNT + excluded.ENTITY_COUNT, ' \
+                           ' RECORD_COUNT = DM_REPORT.RECORD_COUNT + excluded.RECORD_COUNT, ' \
+                           ' RELATION_COUNT = DM_REPORT.RELATION_COUNT + excluded.RELATION_COUNT'
+                self.exec_many_dm(sql_stmt, [[x] + self.report_deltas[x] for x in sorted(self.report_deltas)])
+            else:
+                for report_key in sorted(self.report_deltas):
+                    report_delta = self.report_deltas[report_key]
+                    report_data = {'REPORT': report_delta[0], 'STATISTIC': report_delta[1], 'DATA_SOURCE1': report_delta[2], 'DATA_SOURCE2': report_delta[3]}
+                    response = self.update_dm_report(report_key, *report_delta[4:])
+                    if response != 0:
+                        response = self.insert_dm_report(report_key, *report_delta[4:], report_data)
+                    if response != 0:
+                        response = self.update_dm_report(report_key, *report_delta[4:])
+                    if response != 0:
+                        break
+        except Exception as err:
+            self.log_stat('sql_error', 'flush_dm_report', str(err))
+            response = 2
+
+        if own_transaction:
+            try: self.dbo.sqlExec('commit' if response == 0 else 'rollback')
+            except Exception as err:
+                self.log_stat('sql_error', 'flush_dm_report', str(err))
+                response = 2
+
+        #--a failed flush outside of group commit is retried with the next one
+        if response == 0:
+            self.log_stat('report', 'flush', f'{len(self.report_deltas)} keys')
+            self.report_deltas = {}
+        self.report_message_count = 0
+        self.report_flush_start = time.time()
+        return response
+
     #---------------------------------------
     def update_dm_report(self, report_key, entity_count, record_count, relation_count):
         sql_stmt = 'update DM_REPORT set ' \
@@ -814,7 +1968,7 @@ class Replicator():
                    ' RELATION_COUNT = RELATION_COUNT + ? ' \
                    'where REPORT_KEY = ?'
         try: db_response = self.dbo.sqlExec(sql_stmt, (entity_count, record_count, relation_count, report_key))
-        except: 
+        except Exception as err: 
             self.log_stat('sql_error', 'update_dm_report', report_key)
             self.debug_print('sql_error', str(err))
             return 2
@@ -841,7 +1995,7 @@ class Replicator():
                          record_count, 
                          relation_count]
         try: db_response = self.dbo.sqlExec(sql_stmt, insert_values)
-        except: 
+        except Exception as err: 
             self.log_stat('sql_error', 'insert_dm_report', report_key)
             self.debug_print('sql_error', str(err))
             return 2
@@ -849,30 +2003,38 @@ class Replicator():
 
     #---------------------------------------
     def insert_dm_report_detail(self, report_key, entity_id, related_id = 0):
-        sql_stmt = 'insert into DM_REPORT_DETAIL (REPORT_KEY, ENTITY_ID, RELATED_ID) values (?, ?, ?)'
-        sql_values = [report_key, entity_id, related_id]
-        try: db_response = self.dbo.sqlExec(sql_stmt, sql_values)
+        return self.insert_dm_report_details(report_key, [[entity_id, related_id]])
+
+    #---------------------------------------
+    def insert_dm_report_details(self, report_key, detail_list):
+        #--a detail row that is already there is skipped
+        sql_values = [[report_key, x[0], x[1]] for x in detail_list]
+        try: self.insert_skip_dm_rows('DM_REPORT_DETAIL', ['ENTITY_ID', 'RELATED_ID', 'REPORT_KEY'], ['REPORT_KEY', 'ENTITY_ID', 'RELATED_ID'], sql_values)
         except Exception as err:
-            #if 'UNIQUE' in str(err).upper():
-            #    return 1 #--duplicate key violation
-            #else:
-            self.log_stat('sql_error', 'insert_dm_report_detail', ','.join([str(x) for x in sql_values]))
+            self.log_stat('sql_error', 'insert_dm_report_detail', f'{report_key}, {len(sql_values)} rows')
             self.debug_print('\t' + str(err))
             return 2
         else:
-            self.log_stat('report_detail', 'insert', ','.join([str(x) for x in sql_values]))
-        return 0 if db_response['ROWS_AFFECTED'] == 1 else 1
+            self.log_stat('report_detail', 'insert', f'{report_key}, {len(sql_values)} rows')
+        return 0
 
     #---------------------------------------
     def delete_dm_report_detail(self, report_key, entity_id, related_id = 0):
+        return self.delete_dm_report_details(report_key, [[entity_id, related_id]])
+
+    #---------------------------------------
+    def delete_dm_report_details(self, report_key, detail_list):
+        #--a detail row that is already gone is not an error
         sql_stmt = 'delete from DM_REPORT_DETAIL where REPORT_KEY = ? and ENTITY_ID = ? and RELATED_ID = ?'
-        sql_values = [report_key, entity_id, related_id]
-        try: db_response = self.dbo.sqlExec(sql_stmt, sql_values)
+        sql_values = [[report_key, x[0], x[1]] for x in detail_list]
+        try: self.exec_many_dm(sql_stmt, sql_values)
         except Exception as err:
-            self.log_stat('sql_error', 'delete_dm_report_detail', ', '.join([str(x) for x in sql_values]))
+            self.log_stat('sql_error', 'delete_dm_report_detail', f'{report_key}, {len(sql_values)} rows')
             self.debug_print('sql_error', str(err))
             return 2
-        return 0 if db_response['ROWS_AFFECTED'] == 1 else 1
+        else:
+            self.log_stat('report_detail', 'delete', f'{report_key}, {len(sql_values)} rows')
+        return 0
 
     #---------------------------------------
     #--resume retrieval
@@ -880,6 +2042,19 @@ class Replicator():
 
     #---------------------------------------
     def get_resume_g2_api(self, entity_id):
+        #--within a batch each entity is only fetched and parsed once
+        g2_resume_memo = self.g2_resume_memo
+        if g2_resume_memo is not None:
+            if int(entity_id) in g2_resume_memo:
+                self.log_stat('resume_g2', 'memo_hit')
+                return g2_resume_memo[int(entity_id)]
+            entity_resume = self.fetch_resume_g2_api(entity_id)
+            g2_resume_memo[int(entity_id)] = entity_resume
+            return entity_resume
+        return self.fetch_resume_g2_api(entity_id)
+
+    #---------------------------------------
+    def fetch_resume_g2_api(self, entity_id):
         empty_resume = {'ENTITY_ID': entity_id, 
                         'ENTITY_NAME': 'not found!', 
                         'RECORD_COUNT': 0, 
@@ -936,37 +2111,162 @@ class Replicator():
         entity_resume['RECORD_SUMMARY'] = record_summary #--this is re-formated without json data and all that for report calculation
         entity_resume['RELATION_SUMMARY'] = relation_summary
         entity_resume['RESUME_HASH'] = self.resume_hash_encode(entity_resume)
+        if entity_resume['RESUME_HASH'][0:5] == '~sha~' and 'RESUME_DATA' not in entity_resume:
+            entity_resume['RESUME_DATA'] = self.resume_data_encode(entity_resume)
 
         return entity_resume
 
+    #---------------------------------------
+    def use_prefetch_resumes(self, prefetch_resume_list, dm_resume_list):
+        #--a resume fetched before the entity was locked is only used if the datamart has not synced the entity since,
+        #--otherwise another replicator may have applied a newer one and it is fetched again
+        for entity_id in prefetch_resume_list:
+            g2_entity_resume = dict(prefetch_resume_list[entity_id])
+            prefetch_dm_hash = g2_entity_resume.pop('DM_RESUME_HASH', None)
+            dm_entity_resume = dm_resume_list.get(int(entity_id))
+            if not dm_entity_resume or dm_entity_resume['RESUME_HASH'] != prefetch_dm_hash:
+                self.log_stat('resume_g2', 'prefetch_stale')
+                continue
+            self.g2_resume_memo[int(entity_id)] = g2_entity_resume
+
+    #---------------------------------------
+    def get_resume_g2_api_many(self, entity_id_list):
+        entity_id_list = list(dict.fromkeys(entity_id_list))
+
+        #--the engine call releases the gil so the fetches can overlap
+        if self.fetch_threads > 1 and len(entity_id_list) > 1:
+            if not self.fetch_executor:
+                self.fetch_executor = ThreadPoolExecutor(max_workers=self.fetch_threads, thread_name_prefix='G2ReplicatorFetch')
+            g2_resume_list = dict(zip(entity_id_list, self.fetch_executor.map(self.get_resume_g2_api, entity_id_list)))
+            self.log_stat('resume_g2', 'parallel_fetch', f'{len(entity_id_list)} entities')
+        else:
+            g2_resume_list = {}
+            for entity_id in entity_id_list:
+                g2_resume_list[entity_id] = self.get_resume_g2_api(entity_id)
+
+        return g2_resume_list
+
     #---------------------------------------
     def get_resume_dm(self, entity_id):
+        dm_entity_resume = self.get_resume_cache(entity_id)
+        if dm_entity_resume:
+            return dm_entity_resume
+
         sql_stmt = 'select RECORD_COUNT, RESUME_HASH from DM_ENTITY where ENTITY_ID = ?'
         dm_entity_record = self.dbo.fetchRow(self.dbo.sqlExec(sql_stmt, [int(entity_id),]))
         if dm_entity_record:
+            self.set_resume_cache(entity_id, dm_entity_record[0], dm_entity_record[1])
             return {'ENTITY_ID': entity_id,
                     'RECORD_COUNT': dm_entity_record[0], 
                     'RESUME_HASH': dm_entity_record[1]}
         else:
+            self.set_resume_cache(entity_id, 0, '')
             return {'ENTITY_ID': entity_id,
                     'RECORD_COUNT': 0, 
                     'RESUME_HASH': ''}
 
+    #---------------------------------------
+    def get_resume_dm_many(self, entity_id_list):
+        dm_resume_list = {}
+
+        #--anything not cached or found is not in the datamart yet
+        fetch_id_list = []
+        for entity_id in entity_id_list:
+            if entity_id in dm_resume_list:
+                continue
+            dm_entity_resume = self.get_resume_cache(entity_id)
+            if dm_entity_resume:
+                dm_resume_list[entity_id] = dm_entity_resume
+            else:
+                dm_resume_list[entity_id] = {'ENTITY_ID': entity_id,
+                                             'RECORD_COUNT': 0,
+                                             'RESUME_HASH': ''}
+                fetch_id_list.append(entity_id)
+
+        for i in range(0, len(fetch_id_list), self.max_in_list_size):
+            fetch_id_chunk = {int(x): x for x in fetch_id_list[i:i + self.max_in_list_size]}
+            sql_stmt = 'select ENTITY_ID, RECORD_COUNT, RESUME_HASH from DM_ENTITY ' \
+                       'where ENTITY_ID in (' + ','.join(['?'] * len(fetch_id_chunk)) + ')'
+            for row in self.dbo.fetchAllRows(self.dbo.sqlExec(sql_stmt, list(fetch_id_chunk))):
+                entity_id = fetch_id_chunk[int(row[0])]
+                dm_resume_list[entity_id]['RECORD_COUNT'] = row[1]
+                dm_resume_list[entity_id]['RESUME_HASH'] = row[2]
+            self.log_stat('resume_dm', 'bulk_query', f'{len(fetch_id_chunk)} entities')
+
+        for entity_id in fetch_id_list:
+            self.set_resume_cache(entity_id, dm_resume_list[entity_id]['RECORD_COUNT'], dm_resume_list[entity_id]['RESUME_HASH'])
+
+        return dm_resume_list
+
+    #---------------------------------------
+    def get_resume_cache(self, entity_id):
+        if not self.resume_cache_size:
+            return None
+        try: cache_data = self.resume_cache[int(entity_id)]
+        except KeyError:
+            self.log_stat('resume_cache', 'miss')
+            return None
+        self.resume_cache.move_to_end(int(entity_id))
+        self.log_stat('resume_cache', 'hit')
+        #--a copy as the caller expands it in place
+        return {'ENTITY_ID': entity_id,
+                'RECORD_COUNT': cache_data[0],
+                'RESUME_HASH': cache_data[1]}
+
+    #---------------------------------------
+    def set_resume_cache(self, entity_id, record_count, resume_hash):
+        if not self.resume_cache_size:
+            return
+        self.resume_cache[int(entity_id)] = (record_count, resume_hash)
+        self.resume_cache.move_to_end(int(entity_id))
+        if len(self.resume_cache) > self.resume_cache_size:
+            self.resume_cache.popitem(last=False)
+            self.log_stat('resume_cache', 'evict')
+
+    #---------------------------------------
+    def clear_resume_cache(self, entity_id=None):
+        if entity_id is None:
+            self.resume_cache.clear()
+        else:
+            self.resume_cache.pop(int(entity_id), None)
+
     #---------------------------------------
     def expand_resume_dm(self, dm_entity_resume):
         if dm_entity_resume['RECORD_COUNT'] == 0:
             dm_entity_resume['RECORD_SUMMARY'] = {}
             dm_entity_resume['RELATION_SUMMARY'] = {}
         else:
-            #--rebuild dm record and relations summary from hash
+            #--rebuild dm record and relations summary from hash, the resume table or the datamart itself
             if dm_entity_resume['RESUME_HASH'][0:5] != '~sha~':
-                resume_data = self.resume_hash_decode(dm_entity_resume['RESUME_HASH'])
+                try: resume_data = self.resume_hash_decode(dm_entity_resume['RESUME_HASH'])
+                except Exception:
+                    #--a damaged hash, such as one an audit found, is rebuilt from the datamart itself
+                    resume_data = self.rebuild_resume_dm(dm_entity_resume['ENTITY_ID'])
             else:
-                resume_data = self.rebuild_resume_dm(dm_entity_resume['ENTITY_ID']) 
+                resume_data = self.get_resume_data_dm(dm_entity_resume['ENTITY_ID'], dm_entity_resume['RESUME_HASH'])
+                if not resume_data:
+                    resume_data = self.rebuild_resume_dm(dm_entity_resume['ENTITY_ID']) 
             dm_entity_resume['RECORD_SUMMARY'] = resume_data['RECORD_SUMMARY']
             dm_entity_resume['RELATION_SUMMARY'] = resume_data['RELATION_SUMMARY']
         return dm_entity_resume
 
+    #---------------------------------------
+    def get_resume_data_dm(self, entity_id, resume_hash):
+        #--only trusted if written along with the current hash
+        if not self.entity_resume_enabled:
+            return None
+        sql_stmt = 'select RESUME_DATA from DM_ENTITY_RESUME where ENTITY_ID = ? and RESUME_HASH = ?'
+        try: 
+            dm_resume_record = self.dbo.fetchRow(self.dbo.sqlExec(sql_stmt, [int(entity_id), resume_hash]))
+            if dm_resume_record and dm_resume_record[0]:
+                resume_data = self.resume_hash_decode(dm_resume_record[0])
+                self.log_stat('hash_decode', 'resume_table')
+                return resume_data
+        except Exception as err:
+            self.log_stat('sql_error', 'select_entity_resume', f'entity_id: {entity_id}')
+            self.debug_print('sql_error', str(err))
+        return None
+
     #---------------------------------------
     def rebuild_resume_dm(self, entity_id):
         self.log_stat('hash_decode', 'hash(from db)', f'entity_id: {entity_id}')
@@ -993,6 +2293,140 @@ class Replicator():
 
     #----------------------------------------
     def resume_hash_encode(self, entity_resume):
+        if self.resume_hash_format == 'csv':
+            return self.resume_hash_encode_csv(entity_resume)
+        return self.resume_hash_encode_binary(entity_resume)
+
+    #----------------------------------------
+    def resume_hash_decode(self, resume_hash):
+        if isinstance(resume_hash, memoryview):
+            resume_hash = resume_hash.tobytes()
+        if isinstance(resume_hash, (bytes, bytearray)) and resume_hash[0:1] == self.binary_hash_version:
+            return self.resume_hash_decode_binary(resume_hash)
+        return self.resume_hash_decode_csv(resume_hash)
+
+    #----------------------------------------
+    #--binary hash: version byte, compression byte, then the payload
+    #--payload: int typecode, int count, the ints (each list's length and the match levels), then the strings 
+    #--as one nul separated utf-8 block, ints are the smallest unsigned type that fits them all
+    #----------------------------------------
+    def resume_hash_encode_binary(self, entity_resume):
+        payload, decodable = self.resume_binary_payload(entity_resume)
+
+        #--ensure the entity hash can fit in database, the full resume is kept aside for DM_ENTITY_RESUME if not
+        resume_hash = self.binary_hash_version + self.binary_hash_compression['none'] + payload
+        if not decodable:
+            resume_hash = '~sha~' + hashlib.sha256(resume_hash).hexdigest()
+            self.log_stat('hash_encode', 'sha')
+        elif len(resume_hash) > self.max_resume_hash_len:
+            resume_data = self.resume_binary_compress(payload)
+            if len(resume_data) <= self.max_resume_hash_len:
+                compress_method = self.resume_hash_compression
+                resume_hash = resume_data
+            else:
+                compress_method = 'sha'
+                resume_hash = '~sha~' + hashlib.sha256(resume_hash).hexdigest()
+                entity_resume['RESUME_DATA'] = resume_data
+            self.log_stat('hash_encode', compress_method)
+        else:
+            self.log_stat('hash_encode', 'binary')
+
+        return resume_hash
+
+    #----------------------------------------
+    def resume_data_encode(self, entity_resume):
+        #--the full binary resume for DM_ENTITY_RESUME whatever the hash format, None if it cannot be encoded
+        payload, decodable = self.resume_binary_payload(entity_resume)
+        return self.resume_binary_compress(payload) if decodable else None
+
+    #----------------------------------------
+    def resume_binary_compress(self, payload):
+        if self.resume_hash_compression == 'zstd':
+            zip_payload = zstandard.ZstdCompressor().compress(payload)
+        else:
+            zip_payload = zlib.compress(payload)
+        return self.binary_hash_version + self.binary_hash_compression[self.resume_hash_compression] + zip_payload
+
+    #----------------------------------------
+    def resume_binary_payload(self, entity_resume):
+        int_list = []
+        str_list = []
+
+        record_summary = entity_resume['RECORD_SUMMARY']
+        int_list.append(len(record_summary))
+        for data_source in sorted(record_summary):
+            record_list = sorted(record_summary[data_source])
+            int_list.append(len(record_list))
+            str_list.append(data_source)
+            str_list.extend(record_list)
+
+        relation_summary = entity_resume['RELATION_SUMMARY']
+        int_list.append(len(relation_summary))
+        for related_id in sorted(relation_summary):
+            relation_data = relation_summary[related_id]
+            data_source_list = sorted(relation_data['DATA_SOURCES'])
+            int_list.append(relation_data['MATCH_LEVEL'])
+            int_list.append(len(data_source_list))
+            str_list.extend([related_id, relation_data['MATCH_KEY'] or '', relation_data['MATCH_CATEGORY'] or ''])
+            str_list.extend(data_source_list)
+
+        max_int = max(int_list)
+        typecode = 'B' if max_int < 0x100 else 'H' if max_int < 0x10000 else 'I'
+        int_array = array(typecode, int_list)
+        if sys.byteorder == 'big':
+            int_array.byteswap()
+        str_data = '\x00'.join(str_list)
+        payload = typecode.encode() + struct.pack('<I', len(int_array)) + int_array.tobytes() + str_data.encode('utf-8')
+
+        #--a nul inside any of the strings means it cannot be split apart again
+        return payload, str_data.count('\x00') == max(len(str_list) - 1, 0)
+
+    #----------------------------------------
+    def resume_hash_decode_binary(self, resume_hash):
+        compression = resume_hash[1:2]
+        if compression == self.binary_hash_compression['zlib']:
+            self.log_stat('hash_decode', 'zlib')
+            payload = zlib.decompress(resume_hash[2:])
+        elif compression == self.binary_hash_compression['zstd']:
+            self.log_stat('hash_decode', 'zstd')
+            if not zstandard:
+                raise Exception('zstandard module is required to decode this resume hash')
+            payload = zstandard.ZstdDecompressor().decompress(resume_hash[2:])
+        else:
+            self.log_stat('hash_decode', 'binary')
+            payload = resume_hash[2:]
+
+        typecode = chr(payload[0])
+        int_array = array(typecode)
+        str_pos = 5 + struct.unpack_from('<I', payload, 1)[0] * int_array.itemsize
+        int_array.frombytes(payload[5:str_pos])
+        if sys.byteorder == 'big':
+            int_array.byteswap()
+        str_list = payload[str_pos:].decode('utf-8').split('\x00')
+        next_int = iter(int_array).__next__
+        str_pos = 0
+
+        resume_data = {'RECORD_SUMMARY': {},'RELATION_SUMMARY': {}}
+        for i in range(next_int()):
+            record_count = next_int()
+            resume_data['RECORD_SUMMARY'][str_list[str_pos]] = str_list[str_pos + 1:str_pos + 1 + record_count]
+            str_pos += 1 + record_count
+
+        for i in range(next_int()):
+            match_level = next_int()
+            data_source_count = next_int()
+            resume_data['RELATION_SUMMARY'][str_list[str_pos]] = {'MATCH_LEVEL': match_level,
+                                                                  'MATCH_KEY': str_list[str_pos + 1],
+                                                                  'MATCH_CATEGORY': str_list[str_pos + 2],
+                                                                  'DATA_SOURCES': str_list[str_pos + 3:str_pos + 3 + data_source_count]}
+            str_pos += 3 + data_source_count
+
+        return resume_data
+
+    #----------------------------------------
+    #--legacy csv hash: a csv row with ~d~ and ~r~ markers, zlib compressed when too long
+    #----------------------------------------
+    def resume_hash_encode_csv(self, entity_resume):
         resume_hash_items = []
 
         record_count = 0
@@ -1037,7 +2471,7 @@ class Replicator():
         return resume_hash
 
     #----------------------------------------
-    def resume_hash_decode(self, resume_hash):
+    def resume_hash_decode_csv(self, resume_hash):
 
         if resume_hash[0:1] != '~':
             self.log_stat('hash_decode', 'zip')
@@ -1199,16 +2633,24 @@ class Replicator():
 
     #----------------------------------------
     def log_stat(self, cat1, cat2, ref_data=''):
-        if cat1 not in self.stat_log:
-            self.stat_log[cat1] = {}
-        if cat2 not in self.stat_log[cat1]:
-            self.stat_log[cat1][cat2] = 1
-        else:
-            self.stat_log[cat1][cat2] += 1
+        #--the fetch threads log stats too
+        with self.stat_lock:
+            if cat1 not in self.stat_log:
+                self.stat_log[cat1] = {}
+            if cat2 not in self.stat_log[cat1]:
+                self.stat_log[cat1][cat2] = 1
+            else:
+                self.stat_log[cat1][cat2] += 1
 
         if self.debug_level or cat1 == 'sql_error':
             self.debug_print(cat1, cat2, ref_data)
 
+    #----------------------------------------
+    def debug_pause(self):
+        #--only at the interactive debug level, a replicator run by a service must never wait on a keypress
+        if self.debug_level > 2 and sys.stdin.isatty():
+            input('press any key ..')
+
     #----------------------------------------
     def debug_print(self, *argv):
         if not (self.debug_level or 'sql_error' in argv):
@@ -1231,6 +2673,190 @@ class Replicator():
 #-- custom replication class here for testing only 
 #-----------------------------
 
+#----------------------------------------
+#----------------------------------------
+def rebuild_worker_init(iniFileName, datamart_connection_uri, g2_connection_uri, replicator_kwargs, parent_replicator=None):
+    #--each rebuild process gets its own engine, datamart connection and g2 database connection
+    #--ranges run in the caller's process reuse its engine and datamart connection instead
+    global rebuild_replicator, rebuild_g2dbo
+    if parent_replicator:
+        rebuild_replicator = Replicator(iniFileName, parent_replicator.g2Engine, datamart_connection_uri, datamart_dbo=parent_replicator.dbo, **replicator_kwargs)
+    else:
+        rebuild_replicator = Replicator(iniFileName, None, datamart_connection_uri, **replicator_kwargs)
+    rebuild_g2dbo = G2Database(g2_connection_uri)
+
+#----------------------------------------
+def rebuild_entity_range(entity_range):
+    #--replicates every entity with an id in the range, committed before returning
+    #--a range without errors is checkpointed in DM_REBUILD_RANGE with its final commit so a resumed run can skip it
+    sql = 'SELECT RES_ENT_ID FROM RES_ENT WHERE RES_ENT_ID >= ? AND RES_ENT_ID < ? ORDER BY RES_ENT_ID'
+    entity_id_list = [x[0] for x in rebuild_g2dbo.fetchAllRows(rebuild_g2dbo.sqlExec(sql, list(entity_range)))]
+    error_count = 0
+    for i in range(0, len(entity_id_list), rebuild_replicator.max_in_list_size):
+        error_count += rebuild_replicator.rebuild_entities(entity_id_list[i:i + rebuild_replicator.max_in_list_size])
+
+    stat_log = rebuild_replicator.stat_log
+    rebuild_replicator.stat_log = {}
+    if error_count == 0:
+        insert_fields = ['RANGE_START', 'RANGE_END', 'ENTITY_COUNT', 'STAT_LOG', 'COMPLETED_DT']
+        insert_values = [entity_range[0], entity_range[1], len(entity_id_list), json.dumps(stat_log), datetime.strftime(datetime.now(), '%Y-%m-%d %H:%M:%S')]
+        rebuild_replicator.begin_dm_transaction()
+        try: response, upsert_action = rebuild_replicator.upsert_dm_row('DM_REBUILD_RANGE', ['RANGE_START'], insert_fields, insert_values, insert_fields[1:], insert_values[1:], True)
+        except Exception as err:
+            rebuild_replicator.log_stat('sql_error', 'rebuild_checkpoint', str(err))
+            response = 2
+        if response != 0:
+            rebuild_replicator.rollback_dm_transaction()
+            error_count = len(entity_id_list)
+    if rebuild_replicator.commit_dm_transaction() != 0:
+        error_count = len(entity_id_list)
+    if rebuild_replicator.flush_dm_report() != 0:
+        error_count = len(entity_id_list)
+    rebuild_replicator.release_dm_connection()
+
+    #--the stats go back with the range so the caller can total them
+    return len(entity_id_list), error_count, stat_log
+
+#----------------------------------------
+def audit_entity_range(entity_range):
+    #--audits every entity with an id in the range, whether it is in the engine, the datamart or both
+    sql = 'SELECT RES_ENT_ID FROM RES_ENT WHERE RES_ENT_ID >= ? AND RES_ENT_ID < ?'
+    entity_id_set = set(x[0] for x in rebuild_g2dbo.fetchAllRows(rebuild_g2dbo.sqlExec(sql, list(entity_range))))
+    sql_stmt = 'select ENTITY_ID from DM_ENTITY where ENTITY_ID >= ? and ENTITY_ID < ?'
+    entity_id_set.update(x[0] for x in rebuild_replicator.dbo.fetchAllRows(rebuild_replicator.dbo.sqlExec(sql_stmt, list(entity_range))))
+    entity_id_list = sorted(entity_id_set)
+    mismatch_list = []
+    for i in range(0, len(entity_id_list), rebuild_replicator.max_in_list_size):
+        mismatch_list.extend(rebuild_replicator.audit_entities(entity_id_list[i:i + rebuild_replicator.max_in_list_size]))
+
+    stat_log = rebuild_replicator.stat_log
+    rebuild_replicator.stat_log = {}
+    return len(entity_id_list), mismatch_list, stat_log
+
+#----------------------------------------
+def map_entity_ranges(range_function, entity_range_list, workers, worker_init_args, parent_replicator=None):
+    #--workers = 0 runs the ranges in this process, otherwise results come back as each range completes
+    #--workers are spawned rather than forked so they don't inherit the caller's engine and database connections
+    if workers > 0:
+        range_pool = multiprocessing.get_context('spawn').Pool(workers, rebuild_worker_init, worker_init_args)
+        try: yield from range_pool.imap_unordered(range_function, entity_range_list)
+        finally: range_pool.terminate()
+    else:
+        rebuild_worker_init(*worker_init_args, parent_replicator)
+        try: yield from map(range_function, entity_range_list)
+        finally: 
+            rebuild_replicator.close()
+            rebuild_g2dbo.close()
+
+#----------------------------------------
+def merge_stat_log(stat_log, range_stat_log):
+    for cat1 in range_stat_log:
+        if cat1 not in stat_log:
+            stat_log[cat1] = {}
+        for cat2 in range_stat_log[cat1]:
+            stat_log[cat1][cat2] = stat_log[cat1].get(cat2, 0) + range_stat_log[cat1][cat2]
+
+#----------------------------------------
+def rebuild_datamart(iniFileName, datamart_connection_uri, g2_connection_uri, workers, range_size, replicator_kwargs, stat_log, resume=False, parent_replicator=None):
+    #--workers = 0 runs the ranges in this process, with the parent replicator's engine and datamart connection if supplied
+    g2dbo = G2Database(g2_connection_uri)
+    min_entity_id, max_entity_id, total_count = g2dbo.fetchRow(g2dbo.sqlExec('SELECT MIN(RES_ENT_ID), MAX(RES_ENT_ID), COUNT(*) FROM RES_ENT'))
+    g2dbo.close()
+    if not total_count:
+        print('no entities to replicate')
+        return 0
+    #--ranges start on multiples of the range size so they line up with the checkpoints whatever the lowest id is now
+    range_start = min_entity_id // range_size * range_size
+    entity_range_list = [(x, x + range_size) for x in range(range_start, max_entity_id + 1, range_size)]
+    range_total = len(entity_range_list)
+
+    #--a resumed run skips the ranges already checkpointed, a new one starts the checkpoints over
+    #--datamarts created before the checkpoints get their table here
+    resumed_count = 0
+    dm_replicator = parent_replicator if parent_replicator else Replicator(iniFileName, None, datamart_connection_uri, **replicator_kwargs)
+    if not dm_replicator.check_dm_rebuild_range():
+        if not parent_replicator:
+            dm_replicator.close()
+        raise Exception('cannot rebuild without DM_REBUILD_RANGE to checkpoint the ranges in')
+    dm_dbo = dm_replicator.dbo
+    if resume:
+        checkpoint_list = dm_dbo.fetchAllRows(dm_dbo.sqlExec('select RANGE_START, RANGE_END, ENTITY_COUNT, STAT_LOG from DM_REBUILD_RANGE'))
+        checkpoint_range_size_list = sorted(set(row[1] - row[0] for row in checkpoint_list))
+        if checkpoint_range_size_list and checkpoint_range_size_list != [range_size]:
+            if not parent_replicator:
+                dm_replicator.close()
+            raise Exception(f'cannot resume, the rebuild was started with a range size of {checkpoint_range_size_list[0]:,}, not {range_size:,}')
+        #--only the checkpoints of ranges actually skipped count towards the totals
+        pending_range_list = set(entity_range_list)
+        for row in checkpoint_list:
+            if (row[0], row[1]) not in pending_range_list:
+                continue
+            pending_range_list.remove((row[0], row[1]))
+            resumed_count += row[2]
+            merge_stat_log(stat_log, json.loads(row[3]))
+        entity_range_list = [x for x in entity_range_list if x in pending_range_list]
+        print(f'resuming with {range_total - len(entity_range_list):,} of {range_total:,} ranges already completed')
+    else:
+        dm_dbo.sqlExec('delete from DM_REBUILD_RANGE')
+    dm_replicator.release_dm_connection()
+    if not parent_replicator:
+        dm_replicator.close()
+    print(f'replicating {total_count:,} entities in {range_total:,} ranges of {range_size:,} ids with {max(workers, 1)} processes\n')
+
+    started = time.time()
+    entity_count = 0
+    error_count = 0
+    range_count = range_total - len(entity_range_list)
+    worker_init_args = (iniFileName, datamart_connection_uri, g2_connection_uri, replicator_kwargs)
+    for range_entity_count, range_error_count, range_stat_log in map_entity_ranges(rebuild_entity_range, entity_range_list, workers, worker_init_args, parent_replicator):
+        range_count += 1
+        entity_count += range_entity_count
+        error_count += range_error_count
+        merge_stat_log(stat_log, range_stat_log)
+        elapsed = time.time() - started
+        entities_per_second = entity_count / elapsed if elapsed else 0
+        eta = max((total_count - resumed_count - entity_count) / entities_per_second if entities_per_second else 0, 0)
+        print(f'{resumed_count + entity_count:,} of {total_count:,} entities replicated, {range_count:,} of {range_total:,} ranges, '
+              f'{entities_per_second:,.0f} per second, eta {int(eta // 86400)}d {time.strftime("%H:%M:%S", time.gmtime(eta % 86400))}' + 
+              (f', {error_count:,} errors' if error_count else ''))
+    if error_count:
+        print('\nranges with errors were not checkpointed, run again with --resume to retry them')
+    return error_count
+
+#----------------------------------------
+def audit_datamart(iniFileName, datamart_connection_uri, g2_connection_uri, workers, range_size, replicator_kwargs, stat_log, parent_replicator=None):
+    #--returns the ids of the entities out of sync, deleted entities still in the datamart included
+    #--workers = 0 runs the ranges in this process, with the parent replicator's engine and datamart connection if supplied
+    g2dbo = G2Database(g2_connection_uri)
+    g2_min_entity_id, g2_max_entity_id, g2_count = g2dbo.fetchRow(g2dbo.sqlExec('SELECT MIN(RES_ENT_ID), MAX(RES_ENT_ID), COUNT(*) FROM RES_ENT'))
+    g2dbo.close()
+    dm_dbo = G2Database(datamart_connection_uri)
+    dm_min_entity_id, dm_max_entity_id, dm_count = dm_dbo.fetchRow(dm_dbo.sqlExec('select MIN(ENTITY_ID), MAX(ENTITY_ID), COUNT(*) from DM_ENTITY'))
+    dm_dbo.close()
+    if not g2_count and not dm_count:
+        print('no entities to audit')
+        return []
+    min_entity_id = min(x for x in [g2_min_entity_id, dm_min_entity_id] if x is not None)
+    max_entity_id = max(x for x in [g2_max_entity_id, dm_max_entity_id] if x is not None)
+    entity_range_list = [(x, x + range_size) for x in range(min_entity_id, max_entity_id + 1, range_size)]
+    range_total = len(entity_range_list)
+    print(f'auditing {g2_count:,} entities against {dm_count:,} in the datamart in {range_total:,} ranges of {range_size:,} ids with {max(workers, 1)} processes\n')
+
+    started = time.time()
+    entity_count = 0
+    range_count = 0
+    mismatch_list = []
+    worker_init_args = (iniFileName, datamart_connection_uri, g2_connection_uri, replicator_kwargs)
+    for range_entity_count, range_mismatch_list, range_stat_log in map_entity_ranges(audit_entity_range, entity_range_list, workers, worker_init_args, parent_replicator):
+        range_count += 1
+        entity_count += range_entity_count
+        mismatch_list.extend(range_mismatch_list)
+        merge_stat_log(stat_log, range_stat_log)
+        elapsed = time.time() - started
+        print(f'{entity_count:,} entities audited, {range_count:,} of {range_total:,} ranges, '
+              f'{entity_count / elapsed if elapsed else 0:,.0f} per second, {len(mismatch_list):,} out of sync')
+    return sorted(mismatch_list)
+
 #----------------------------------------
 if __name__ == "__main__":
 
@@ -1244,7 +2870,15 @@ if __name__ == "__main__":
     arg_parser.add_argument('-e', '--entity_list', dest='entity_list', help='list of entity_ids to test or all')
     arg_parser.add_argument('-d', '--data_source', dest='data_source', default=None, help='data_source to use for all')
     arg_parser.add_argument('-P', '--purge', dest='purge', action='store_true', default=False, help='purge datamart first')
-    arg_parser.add_argument('-D', '--debug', dest='debug', type=int, default=0, help='debug level 1=normal 2 includes json')
+    arg_parser.add_argument('--resume', dest='resume', action='store_true', default=False, help='resume a rebuild of all entities from its last checkpoint')
+    arg_parser.add_argument('-w', '--workers', dest='workers', type=int, default=0, help='processes to rebuild all entities with, defaults to 0 for just this one')
+    arg_parser.add_argument('-r', '--range_size', dest='range_size', type=int, default=100000, help='entity ids per range for the workers, defaults to 100000')
+    arg_parser.add_argument('-R', '--report', dest='report', choices=['rebuild', 'verify'], help='rebuild or verify the report tables from the entities, records and relationships')
+    arg_parser.add_argument('-A', '--audit', dest='audit', action='store_true', default=False, help='audit all entities against the engine and queue the ones out of sync for the stream replicator to resync')
+    arg_parser.add_argument('-o', '--audit_file', dest='audit_file', default=None, help='write the entity ids out of sync to this file instead of queuing them')
+    arg_parser.add_argument('-t', '--fetch_threads', dest='fetch_threads', type=int, default=0, help='threads per process to fetch entities from the engine with')
+    arg_parser.add_argument('-p', '--profile', dest='profile', default='default', choices=sorted(datamart_profiles), help='sqlite datamart performance profile, bulk is fastest but a crash can corrupt the datamart, only use it for a rebuild that can be redone')
+    arg_parser.add_argument('-D', '--debug', dest='debug', type=int, default=0, help='debug level 1=normal 2 includes json 3 also pauses on report errors')
     args = arg_parser.parse_args()
 
     #--get parameters from ini file
@@ -1256,7 +2890,7 @@ if __name__ == "__main__":
     iniParamCreator = G2IniParams()
     g2module_params = iniParamCreator.getJsonINIParams(args.iniFileName)
     datamart_connection_uri = json.loads(g2module_params)['DATAMART']['CONNECTION']
-    try: dm_replicator = Replicator(args.iniFileName, None, datamart_connection_uri, debug_level=args.debug)
+    try: dm_replicator = Replicator(args.iniFileName, None, datamart_connection_uri, debug_level=args.debug, datamart_profile=args.profile)
     except Exception as err:
         print('\n%s\n' % err)
         sys.exit(1)
@@ -1264,15 +2898,37 @@ if __name__ == "__main__":
     print('\nsuccessfully initialized!')
 
     if args.entity_list:
-        if args.purge:
+        if args.purge and args.resume:
+            print('\n** not purging data mart as resuming **\n')
+        elif args.purge:
             print('\n** purging data mart first **\n')
             dm_replicator.dbo.sqlExec('delete from DM_ENTITY')
+            if dm_replicator.entity_resume_enabled:
+                dm_replicator.dbo.sqlExec('delete from DM_ENTITY_RESUME')
             dm_replicator.dbo.sqlExec('delete from DM_RECORD')
             dm_replicator.dbo.sqlExec('delete from DM_RELATION')
             dm_replicator.dbo.sqlExec('delete from DM_REPORT')
             dm_replicator.dbo.sqlExec('delete from DM_REPORT_DETAIL')
 
-        if args.entity_list.upper().startswith('ALL'):
+        #--rebuild of all entities by ranges of entity ids, written in group commits with buffered report counts
+        if args.entity_list.upper() == 'ALL' and not args.data_source:
+            dbUri = json.loads(g2module_params)['SQL']['CONNECTION']
+            started = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            replicator_kwargs = {'debug_level': args.debug, 
+                                 'calculate_reports': args.report != 'rebuild', #--rebuilt in one pass afterwards
+                                 'datamart_profile': args.profile,
+                                 'fetch_threads': args.fetch_threads,
+                                 'commit_message_count': 1000,
+                                 'report_flush_message_count': 1000}
+            try: rebuild_datamart(args.iniFileName, datamart_connection_uri, dbUri, args.workers, args.range_size, replicator_kwargs, dm_replicator.stat_log, args.resume, dm_replicator)
+            except Exception as err:
+                print(err)
+                sys.exit(1)
+            ended = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            print(f'\nStarted: {started}')
+            print(f'  Ended: {ended}\n')
+
+        elif args.entity_list.upper().startswith('ALL'):
             dbUri = json.loads(g2module_params)['SQL']['CONNECTION']
             try: 
                 g2dbo = G2Database(dbUri)
@@ -1311,8 +2967,6 @@ if __name__ == "__main__":
                 if cnt % 1000 == 0 or not row:
                     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                     print(('%s entities replicated at %s' % (cnt, now)) + (', complete!' if not row else ''))
-                if cnt == 1000000:
-                    break
 
             ended = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             print(f'\nStarted: {started}')
@@ -1323,6 +2977,51 @@ if __name__ == "__main__":
             for entity_id in args.entity_list.split(','):
                 dm_replicator.replicate_entity(int(entity_id), 'user-request')
 
+    #--read only check of every entity, the ones out of sync are left for a resync
+    if args.audit:
+        dbUri = json.loads(g2module_params)['SQL']['CONNECTION']
+        started = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        replicator_kwargs = {'debug_level': args.debug, 
+                             'datamart_profile': args.profile,
+                             'fetch_threads': args.fetch_threads}
+        try: mismatch_list = audit_datamart(args.iniFileName, datamart_connection_uri, dbUri, args.workers, args.range_size, replicator_kwargs, dm_replicator.stat_log, dm_replicator)
+        except Exception as err:
+            print(err)
+            sys.exit(1)
+        if args.audit_file:
+            with open(args.audit_file, 'w') as f:
+                for entity_id in mismatch_list:
+                    f.write(f'{entity_id}\n')
+            print(f'\n{len(mismatch_list):,} entity ids out of sync written to {args.audit_file}')
+        elif mismatch_list:
+            dm_replicator.replication_dt = datetime.strftime(datetime.now(), '%Y-%m-%d %H:%M:%S')
+            for i in range(0, len(mismatch_list), 10000):
+                dm_replicator.defer_resync(mismatch_list[i:i + 10000], 'audit')
+            print(f'\n{len(mismatch_list):,} entity ids out of sync queued for resync')
+        else:
+            print('\nno entities out of sync')
+        ended = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        print(f'\nStarted: {started}')
+        print(f'  Ended: {ended}\n')
+        print('\n-- AUDIT STATS -------------------------------------')
+        print(json.dumps(dm_replicator.stat_log, indent=4))
+        if 'sql_error' in dm_replicator.stat_log:
+            sys.exit(1)
+
+    #--set based report rebuild or check
+    if args.report == 'rebuild':
+        print('\nrebuilding reports ...')
+        if dm_replicator.rebuild_dm_report() != 0:
+            print('\nreport rebuild failed\n')
+            sys.exit(1)
+    elif args.report == 'verify':
+        print('\nverifying reports ...')
+        difference_count, difference_list = dm_replicator.verify_dm_report()
+        for difference in difference_list:
+            print(json.dumps(difference))
+        print(f'\n{difference_count} differences found' + (f', first {len(difference_list)} shown' if difference_count > len(difference_list) else ''))
+
+    if args.entity_list or args.report == 'rebuild':
         print('\n-- PROCESSING STATS ---------------------------------')
         print(json.dumps(dm_replicator.stat_log, indent=4))
 
@@ -8,6 +8,12 @@ CREATE TABLE DM_ENTITY (
     LAST_SEEN_DT TIMESTAMP, 
 PRIMARY KEY(ENTITY_ID));
 
+CREATE TABLE DM_ENTITY_RESUME (
+    ENTITY_ID BIGINT NOT NULL,
+    RESUME_HASH VARCHAR(500),
+    RESUME_DATA BLOB,
+PRIMARY KEY(ENTITY_ID));
+
 CREATE TABLE DM_RECORD (
     DATA_SOURCE VARCHAR(25) NOT NULL, 
     RECORD_ID VARCHAR(250) NOT NULL, 
@@ -57,6 +63,20 @@ CREATE TABLE DM_ALERT (
     LAST_SEEN_DT TIMESTAMP);
 CREATE INDEX IX_DM_ALERT on DM_ALERT (ENTITY_ID);
 
+CREATE TABLE DM_RESYNC_QUEUE (
+    ENTITY_ID BIGINT NOT NULL,
+    QUEUED_DT TIMESTAMP,
+PRIMARY KEY(ENTITY_ID));
+CREATE INDEX IX_DM_RESYNC_QUEUE on DM_RESYNC_QUEUE (QUEUED_DT);
+
+CREATE TABLE DM_REBUILD_RANGE (
+    RANGE_START BIGINT NOT NULL,
+    RANGE_END BIGINT NOT NULL,
+    ENTITY_COUNT BIGINT,
+    STAT_LOG TEXT,
+    COMPLETED_DT TIMESTAMP,
+PRIMARY KEY(RANGE_START));
+
 CREATE TABLE ER_FEEDBACK (
     DATA_SOURCE1 VARCHAR(25),
     RECORD_ID1 VARCHAR(250),
@@ -0,0 +1,159 @@
+#! /usr/bin/env python3
+
+import os
+import argparse
+import sys
+import json
+import random
+import time
+import copy
+import tempfile
+
+import G2Paths
+from G2IniParams import G2IniParams
+
+from G2Replicator import Replicator
+
+#----------------------------------------
+def make_entity_resume(record_count, relation_count):
+    data_sources = ['CUSTOMER', 'WATCHLIST', 'REFERENCE', 'EMPLOYEE', 'VENDOR']
+    match_keys = ['+NAME+DOB+ADDRESS', '+NAME+ADDRESS-DOB', '+SURNAME+PHONE', '+NAME+DRLIC-SSN', '+ADDRESS+EMAIL']
+
+    record_summary = {}
+    for i in range(record_count):
+        data_source = random.choice(data_sources[0:3])
+        if data_source not in record_summary:
+            record_summary[data_source] = []
+        record_summary[data_source].append(str(random.randint(1000000, 99999999)))
+
+    relation_summary = {}
+    for i in range(relation_count):
+        match_level = random.choice([2, 3, 11])
+        match_category = 'DR' if match_level == 11 else random.choice(['AM', 'PM' if match_level == 2 else 'PR'])
+        relation_summary[str(random.randint(1, 999999999))] = {'MATCH_LEVEL': match_level,
+                                                               'MATCH_KEY': random.choice(match_keys),
+                                                               'MATCH_CATEGORY': match_category,
+                                                               'DATA_SOURCES': random.sample(data_sources, random.randint(1, 2))}
+
+    return {'ENTITY_ID': 1,
+            'RECORD_COUNT': record_count,
+            'RELATION_COUNT': relation_count,
+            'RECORD_SUMMARY': record_summary,
+            'RELATION_SUMMARY': relation_summary}
+
+#----------------------------------------
+def make_prior_resume(entity_resume):
+    #--the datamart's view: one record and one relationship that have since gone away
+    prior_resume = copy.deepcopy(entity_resume)
+    data_source = sorted(prior_resume['RECORD_SUMMARY'])[0]
+    prior_resume['RECORD_SUMMARY'][data_source].append('0')
+    prior_resume['RECORD_COUNT'] += 1
+    related_id = sorted(prior_resume['RELATION_SUMMARY'])[0]
+    prior_resume['RELATION_SUMMARY']['0'] = copy.deepcopy(prior_resume['RELATION_SUMMARY'][related_id])
+    prior_resume['RELATION_COUNT'] += 1
+    return prior_resume
+
+#----------------------------------------
+def prime_datamart(dm_replicator, entity_id, dm_entity_resume):
+    #--the report rows the prior resume would have written
+    nc_entity_resume = dm_replicator.net_change_resume(entity_id, dm_entity_resume, dm_entity_resume)
+    nc_entity_resume['DM_REPORT_SUMMARY'] = {'RESOLVED': {}}
+    dm_replicator.net_change_report(entity_id, nc_entity_resume)
+
+#----------------------------------------
+def net_change(dm_replicator, entity_id, g2_entity_resume, dm_entity_resume):
+    #--rolled back so every pass applies the same change
+    dm_replicator.dbo.sqlExec('begin')
+    nc_entity_resume = dm_replicator.net_change_resume(entity_id, g2_entity_resume, dm_entity_resume)
+    dm_replicator.net_change_report(entity_id, nc_entity_resume)
+    dm_replicator.dbo.sqlExec('rollback')
+
+#----------------------------------------
+def time_it(function, argument, min_seconds):
+    iterations = 0
+    started = time.perf_counter()
+    while True:
+        function(*argument) if type(argument) == tuple else function(argument)
+        iterations += 1
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_seconds:
+            return elapsed / iterations * 1000000
+
+#----------------------------------------
+if __name__ == "__main__":
+
+    #--defaults
+    try: iniFileName = G2Paths.get_G2Module_ini_path()
+    except: iniFileName = ''
+
+    #--capture the command line arguments
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('-c', '--config_file_name', dest='iniFileName', default=iniFileName, help='name of the g2.ini file, defaults to %s' % iniFileName)
+    arg_parser.add_argument('-r', '--record_counts', dest='record_counts', default='1,2,5,10,50,250,1000', help='comma separated records per entity to test')
+    arg_parser.add_argument('-n', '--net_change_counts', dest='net_change_counts', default='10,100,1000,10000,100000', help='comma separated records per entity to diff')
+    arg_parser.add_argument('-s', '--seconds', dest='seconds', type=float, default=0.5, help='minimum seconds to time each case')
+    args = arg_parser.parse_args()
+
+    #--get parameters from ini file
+    if not os.path.exists(args.iniFileName):
+        print('\nAn ini file was not found, please supply with the -c parameter\n')
+        sys.exit(1)
+
+    #--the net change writes go to a scratch datamart, not the one in the ini file
+    datamart_dir = tempfile.TemporaryDirectory()
+    datamart_file = os.path.join(datamart_dir.name, 'G2Mart.db')
+    schema_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'g2mart-schema-sqlite-create.sql')
+    try: 
+        import sqlite3
+        datamart_con = sqlite3.connect(datamart_file)
+        datamart_con.executescript(open(schema_file).read())
+        datamart_con.close()
+        dm_replicator = Replicator(args.iniFileName, None, 'sqlite3://na:na@' + datamart_file)
+    except Exception as err:
+        print('\n%s\n' % err)
+        sys.exit(1)
+
+    #--time the raw encodings, the stored size still reflects the database limit
+    max_resume_hash_len = dm_replicator.max_resume_hash_len
+
+    random.seed(1)
+    print()
+    print(f'{"records":>8} {"relations":>9} {"format":>7} {"encode us":>10} {"decode us":>10} {"raw bytes":>10} {"stored":>7} {"method":>7}')
+    for record_count in [int(x) for x in args.record_counts.split(',')]:
+        relation_count = max(int(record_count / 5), 1)
+        entity_resume = make_entity_resume(record_count, relation_count)
+        for resume_hash_format in ['csv', 'binary']:
+            dm_replicator.resume_hash_format = resume_hash_format
+
+            dm_replicator.max_resume_hash_len = sys.maxsize
+            raw_resume_hash = dm_replicator.resume_hash_encode(entity_resume)
+            encode_us = time_it(dm_replicator.resume_hash_encode, entity_resume, args.seconds)
+            decode_us = time_it(dm_replicator.resume_hash_decode, raw_resume_hash, args.seconds)
+
+            dm_replicator.max_resume_hash_len = max_resume_hash_len
+            resume_hash = dm_replicator.resume_hash_encode(entity_resume)
+            if resume_hash[0:5] == '~sha~':
+                method = 'sha'
+            elif len(resume_hash) == len(raw_resume_hash):
+                method = 'none'
+            else:
+                method = 'zip'
+
+            raw_len = len(raw_resume_hash.encode('utf-8') if type(raw_resume_hash) == str else raw_resume_hash)
+            print(f'{record_count:>8} {relation_count:>9} {resume_hash_format:>7} {encode_us:>10.1f} {decode_us:>10.1f} {raw_len:>10} {len(resume_hash):>7} {method:>7}')
+    print()
+
+    #--net change of a large entity that lost a record and a relationship
+    print(f'{"records":>8} {"relations":>9} {"net change ms":>14} {"us/record":>10}')
+    for record_count in [int(x) for x in args.net_change_counts.split(',')]:
+        relation_count = max(int(record_count / 2), 1)
+        g2_entity_resume = make_entity_resume(record_count, relation_count)
+        dm_entity_resume = make_prior_resume(g2_entity_resume)
+        prime_datamart(dm_replicator, record_count, dm_entity_resume)
+        net_change_us = time_it(net_change, (dm_replicator, record_count, g2_entity_resume, dm_entity_resume), args.seconds)
+        print(f'{record_count:>8} {relation_count:>9} {net_change_us / 1000:>14.2f} {net_change_us / record_count:>10.2f}')
+    print()
+
+    dm_replicator.close()
+    datamart_dir.cleanup()
+    sys.exit(0)
@@ -8,9 +8,12 @@ from urllib.parse import urlparse, urlunparse
 from urllib.request import urlopen
 import argparse
 import boto3
+import collections
+import concurrent.futures
 import configparser
 import confluent_kafka
 import datetime
+import functools
 import importlib
 import json
 import linecache
@@ -61,6 +64,14 @@ GIGABYTES = 1024 * MEGABYTES
 MINIMUM_TOTAL_MEMORY_IN_GIGABYTES = 8
 MINIMUM_AVAILABLE_MEMORY_IN_GIGABYTES = 6
 
+#-- BEGIN REPLICATOR CHANGE --------------------------
+# Datamart connections and entity locks shared by the replicator threads.
+
+datamart_connection_pool = None
+datamart_connection_pool_lock = threading.Lock()
+datamart_entity_locks = None
+#-- END REPLICATOR CHANGE --------------------------
+
 # Lists from https://www.ietf.org/rfc/rfc1738.txt
 
 safe_character_list = ['$', '-', '_', '.', '+', '!', '*', '(', ')', ',', '"'] + list(string.ascii_letters)
@@ -91,6 +102,81 @@ configuration_locator = {
         "env": "SENZING_DATAMART_REPLICATOR",
         "cli": "datamart-replicator"
     },
+    "datamart_commit_interval_ms": {
+        "default": 0,
+        "env": "SENZING_DATAMART_COMMIT_INTERVAL_MS",
+        "cli": "datamart-commit-interval-ms"
+    },
+    "datamart_commit_message_count": {
+        "default": 0,
+        "env": "SENZING_DATAMART_COMMIT_MESSAGE_COUNT",
+        "cli": "datamart-commit-message-count"
+    },
+    "datamart_fetch_threads": {
+        "default": 0,
+        "env": "SENZING_DATAMART_FETCH_THREADS",
+        "cli": "datamart-fetch-threads"
+    },
+    "datamart_profile": {
+        "default": None,
+        "env": "SENZING_DATAMART_PROFILE",
+        "cli": "datamart-profile"
+    },
+    "datamart_pool_idle_seconds": {
+        "default": 300,
+        "env": "SENZING_DATAMART_POOL_IDLE_SECONDS",
+        "cli": "datamart-pool-idle-seconds"
+    },
+    "datamart_pool_size": {
+        "default": 0,
+        "env": "SENZING_DATAMART_POOL_SIZE",
+        "cli": "datamart-pool-size"
+    },
+    "datamart_report_flush_interval_ms": {
+        "default": 0,
+        "env": "SENZING_DATAMART_REPORT_FLUSH_INTERVAL_MS",
+        "cli": "datamart-report-flush-interval-ms"
+    },
+    "datamart_report_flush_message_count": {
+        "default": 0,
+        "env": "SENZING_DATAMART_REPORT_FLUSH_MESSAGE_COUNT",
+        "cli": "datamart-report-flush-message-count"
+    },
+    "datamart_resume_cache_size": {
+        "default": 0,
+        "env": "SENZING_DATAMART_RESUME_CACHE_SIZE",
+        "cli": "datamart-resume-cache-size"
+    },
+    "datamart_resync_entity_budget": {
+        "default": 0,
+        "env": "SENZING_DATAMART_RESYNC_ENTITY_BUDGET",
+        "cli": "datamart-resync-entity-budget"
+    },
+    "datamart_resync_idle_seconds": {
+        "default": 10,
+        "env": "SENZING_DATAMART_RESYNC_IDLE_SECONDS",
+        "cli": "datamart-resync-idle-seconds"
+    },
+    "datamart_resync_max_depth": {
+        "default": 1,
+        "env": "SENZING_DATAMART_RESYNC_MAX_DEPTH",
+        "cli": "datamart-resync-max-depth"
+    },
+    "datamart_retry_delay_seconds": {
+        "default": 1,
+        "env": "SENZING_DATAMART_RETRY_DELAY_SECONDS",
+        "cli": "datamart-retry-delay-seconds"
+    },
+    "datamart_retry_max_attempts": {
+        "default": 5,
+        "env": "SENZING_DATAMART_RETRY_MAX_ATTEMPTS",
+        "cli": "datamart-retry-max-attempts"
+    },
+    "datamart_sqlite_pragmas": {
+        "default": None,
+        "env": "SENZING_DATAMART_SQLITE_PRAGMAS",
+        "cli": "datamart-sqlite-pragmas"
+    },
     "data_source": {
         "default": None,
         "env": "SENZING_DATA_SOURCE",
@@ -146,6 +232,11 @@ configuration_locator = {
         "env": "SENZING_KAFKA_BOOTSTRAP_SERVER",
         "cli": "kafka-bootstrap-server",
     },
+    "kafka_consume_num_messages": {
+        "default": 100,
+        "env": "SENZING_KAFKA_CONSUME_NUM_MESSAGES",
+        "cli": "kafka-consume-num-messages"
+    },
     "kafka_failure_bootstrap_server": {
         "default": None,
         "env": "SENZING_KAFKA_FAILURE_BOOTSTRAP_SERVER",
@@ -376,6 +467,11 @@ configuration_locator = {
         "env": "SENZING_SQS_QUEUE_URL",
         "cli": "sqs-queue-url"
     },
+    "sqs_visibility_timeout_seconds": {
+        "default": 30,
+        "env": "SENZING_SQS_VISIBILITY_TIMEOUT_SECONDS",
+        "cli": "sqs-visibility-timeout-seconds"
+    },
     "sqs_wait_time_seconds": {
         "default": 20,
         "env": "SENZING_SQS_WAIT_TIME_SECONDS",
@@ -453,6 +549,19 @@ def get_parser():
                 },
             },
         },
+#-- BEGIN REPLICATOR CHANGE --------------------------
+        'kafka-replicate': {
+            "help": 'Replicate withinfo messages from Apache Kafka topic into the datamart.',
+            "argument_aspects": ["common", "kafka_base"],
+            "arguments": {
+                "--kafka-consume-num-messages": {
+                    "dest": "kafka_consume_num_messages",
+                    "metavar": "SENZING_KAFKA_CONSUME_NUM_MESSAGES",
+                    "help": "Messages read and replicated as one batch. Default: 100"
+                },
+            },
+        },
+#-- END REPLICATOR CHANGE --------------------------
         'rabbitmq': {
             "help": 'Read JSON Lines from RabbitMQ queue.',
             "argument_aspects": ["common", "rabbitmq_base"],
@@ -568,6 +677,24 @@ def get_parser():
                 },
             },
         },
+#-- BEGIN REPLICATOR CHANGE --------------------------
+        'sqs-replicate': {
+            "help": 'Replicate withinfo messages from AWS SQS queue into the datamart.',
+            "argument_aspects": ["common", "sqs_base"],
+            "arguments": {
+                "--sqs-failure-queue-url": {
+                    "dest": "sqs_failure_queue_url",
+                    "metavar": "SENZING_SQS_FAILURE_QUEUE_URL",
+                    "help": "AWS SQS URL for failures. Default: none"
+                },
+                "--sqs-visibility-timeout-seconds": {
+                    "dest": "sqs_visibility_timeout_seconds",
+                    "metavar": "SENZING_SQS_VISIBILITY_TIMEOUT_SECONDS",
+                    "help": "AWS SQS visibility timeout, extended while a batch is still replicating. Default: 30"
+                },
+            },
+        },
+#-- END REPLICATOR CHANGE --------------------------
         'url': {
             "help": 'Read JSON Lines from URL-addressable file.',
             "argument_aspects": ["common"],
@@ -601,6 +728,81 @@ def get_parser():
                 "metavar": "SENZING_DATAMART_REPLICATOR",
                 "help": "Custom replicator class."
             },
+            "--datamart-commit-interval-ms": {
+                "dest": "datamart_commit_interval_ms",
+                "metavar": "SENZING_DATAMART_COMMIT_INTERVAL_MS",
+                "help": "Longest a replicate thread holds a datamart transaction open before committing. Default: 0 (no limit)"
+            },
+            "--datamart-commit-message-count": {
+                "dest": "datamart_commit_message_count",
+                "metavar": "SENZING_DATAMART_COMMIT_MESSAGE_COUNT",
+                "help": "Messages a replicate thread commits to the datamart in one transaction. Default: 0 (commit each message)"
+            },
+            "--datamart-fetch-threads": {
+                "dest": "datamart_fetch_threads",
+                "metavar": "SENZING_DATAMART_FETCH_THREADS",
+                "help": "Threads fetching entities from the engine ahead of the replicate threads. Default: 0 (replicate threads fetch their own)"
+            },
+            "--datamart-profile": {
+                "dest": "datamart_profile",
+                "metavar": "SENZING_DATAMART_PROFILE",
+                "help": "SQLite datamart performance profile: default, wal or bulk (a crash can corrupt the datamart, only for rebuilds that can be redone). Default: default"
+            },
+            "--datamart-pool-idle-seconds": {
+                "dest": "datamart_pool_idle_seconds",
+                "metavar": "SENZING_DATAMART_POOL_IDLE_SECONDS",
+                "help": "Seconds before an idle pooled datamart connection is closed. Default: 300"
+            },
+            "--datamart-pool-size": {
+                "dest": "datamart_pool_size",
+                "metavar": "SENZING_DATAMART_POOL_SIZE",
+                "help": "Datamart connections shared by all threads. Default: 0 (one per thread)"
+            },
+            "--datamart-report-flush-interval-ms": {
+                "dest": "datamart_report_flush_interval_ms",
+                "metavar": "SENZING_DATAMART_REPORT_FLUSH_INTERVAL_MS",
+                "help": "Longest a replicate thread sums datamart report counts in memory before writing them. Group commits at least this often. Default: 0 (no limit)"
+            },
+            "--datamart-report-flush-message-count": {
+                "dest": "datamart_report_flush_message_count",
+                "metavar": "SENZING_DATAMART_REPORT_FLUSH_MESSAGE_COUNT",
+                "help": "Messages a replicate thread sums datamart report counts over before writing them. Group commits at least this often. Default: 0 (write each)"
+            },
+            "--datamart-resume-cache-size": {
+                "dest": "datamart_resume_cache_size",
+                "metavar": "SENZING_DATAMART_RESUME_CACHE_SIZE",
+                "help": "Datamart entity resumes a replicate thread keeps in memory. Only safe with one replicate thread and no other replicator on the datamart. Default: 0 (off)"
+            },
+            "--datamart-resync-entity-budget": {
+                "dest": "datamart_resync_entity_budget",
+                "metavar": "SENZING_DATAMART_RESYNC_ENTITY_BUDGET",
+                "help": "Related entities to resync per message before deferring the rest. Default: 0 (no limit)"
+            },
+            "--datamart-resync-idle-seconds": {
+                "dest": "datamart_resync_idle_seconds",
+                "metavar": "SENZING_DATAMART_RESYNC_IDLE_SECONDS",
+                "help": "Idle seconds before draining deferred resyncs. Default: 10"
+            },
+            "--datamart-resync-max-depth": {
+                "dest": "datamart_resync_max_depth",
+                "metavar": "SENZING_DATAMART_RESYNC_MAX_DEPTH",
+                "help": "Levels of newly related entities to resync per message. Default: 1"
+            },
+            "--datamart-retry-delay-seconds": {
+                "dest": "datamart_retry_delay_seconds",
+                "metavar": "SENZING_DATAMART_RETRY_DELAY_SECONDS",
+                "help": "Seconds before a message that hit a datamart error is retried, doubled for each retry up to a minute. Default: 1"
+            },
+            "--datamart-retry-max-attempts": {
+                "dest": "datamart_retry_max_attempts",
+                "metavar": "SENZING_DATAMART_RETRY_MAX_ATTEMPTS",
+                "help": "Datamart errors on a message before it goes to the failure queue. Default: 5"
+            },
+            "--datamart-sqlite-pragmas": {
+                "dest": "datamart_sqlite_pragmas",
+                "metavar": "SENZING_DATAMART_SQLITE_PRAGMAS",
+                "help": "Semicolon separated pragmas for each sqlite datamart connection. Example: 'journal_mode = WAL; synchronous = NORMAL'"
+            },
             "--data-source": {
                 "dest": "data_source",
                 "metavar": "SENZING_DATA_SOURCE",
@@ -774,6 +976,8 @@ message_dictionary = {
     "128": "Adding JSON to info queue: {0}",
     "129": "{0} is running.",
     "130": "RabbitMQ channel closed by the broker. Shutting down thread {0}. Error: {1}",
+    "131": "Thread: {0} Kafka partitions assigned: {1}",
+    "132": "Thread: {0} Kafka partitions revoked: {1}",
     "140": "System Resources:",
     "141": "    Physical cores: {0}",
     "142": "     Logical cores: {0}",
@@ -806,6 +1010,13 @@ message_dictionary = {
     "202": "Non-fatal exception on Line {0}: {1} Error: {2}",
     "203": "          WARNING: License will expire soon. Only {0} days left.",
     "221": "AWS SQS redrive: {0}",
+    "222": "Datamart deferred resync failed. Error: {0}",
+    "223": "Datamart replication failed. Error: {0} Message: {1}",
+    "224": "Datamart entity fetch failed, left for the replicate thread. Error: {0} Message: {1}",
+    "225": "Kafka seek failed for partition {0} offset {1}, it is read again after a restart. Error: {2}",
+    "226": "AWS SQS delete failed for {0}, the messages are received again. Error: {1}",
+    "227": "AWS SQS visibility change failed for {0}. Error: {1}",
+    "228": "Datamart replication failed {0} times, sending the message to the failure queue. Message: {1}",
     "292": "Configuration change detected.  Old: {0} New: {1}",
     "293": "For information on warnings and errors, see https://github.com/Senzing/stream-loader#errors",
     "294": "Version: {0}  Updated: {1}",
@@ -843,6 +1054,7 @@ message_dictionary = {
     "557": "Invalid JSON received: {0} Error: {1}",
     "558": "LD_LIBRARY_PATH environment variable not set.",
     "559": "PYTHONPATH environment variable not set.",
+    "560": "SENZING_DATAMART_RESUME_CACHE_SIZE is only safe with one replicate thread, not caching for {0} threads.",
     "561": "Unknown RabbitMQ error when connecting: {0}.",
     "563": "Could not perform database performance test.",
     "564": "Database performance of {0:.2f}ms per insert is slower than the recommended minimum performance of {1:.2f}ms per insert",
@@ -1138,8 +1350,22 @@ def get_configuration(args):
 
     integers = [
         'configuration_check_frequency_in_seconds',
+        'datamart_commit_interval_ms',
+        'datamart_commit_message_count',
+        'datamart_fetch_threads',
+        'datamart_pool_idle_seconds',
+        'datamart_pool_size',
+        'datamart_report_flush_interval_ms',
+        'datamart_report_flush_message_count',
+        'datamart_resume_cache_size',
+        'datamart_resync_entity_budget',
+        'datamart_resync_idle_seconds',
+        'datamart_resync_max_depth',
+        'datamart_retry_delay_seconds',
+        'datamart_retry_max_attempts',
         'delay_in_seconds',
         'expiration_warning_in_days',
+        'kafka_consume_num_messages',
         'log_license_period_in_seconds',
         'monitoring_period_in_seconds',
         'queue_maxsize',
@@ -1149,6 +1375,7 @@ def get_configuration(args):
         'rabbitmq_reconnect_delay_in_seconds',
         'sleep_time_in_seconds',
         'sqs_info_queue_delay_seconds',
+        'sqs_visibility_timeout_seconds',
         'sqs_wait_time_seconds',
         'threads_per_process',
     ]
@@ -1186,7 +1413,7 @@ def validate_configuration(config):
 
     subcommand = config.get('subcommand')
 
-    if subcommand in ['kafka', 'stdin', 'url']:
+    if subcommand in ['kafka', 'kafka-replicate', 'stdin', 'url']:
 
         if not config.get('ld_library_path'):
             user_error_messages.append(message_error(558))
@@ -1202,11 +1429,18 @@ def validate_configuration(config):
         if not config.get('entity_type'):
             user_warning_messages.append(message_warning(553))
 
-    if subcommand in ['kafka']:
+    if subcommand in ['kafka', 'kafka-replicate']:
 
         if not config.get('kafka_bootstrap_server'):
             user_error_messages.append(message_error(556))
 
+#-- BEGIN REPLICATOR CHANGE --------------------------
+    # Each replicate thread has its own cache, so one thread would miss another's datamart writes.
+
+    if config.get('datamart_resume_cache_size') and config.get('threads_per_process') > 1:
+        user_warning_messages.append(message_warning(560, config.get('threads_per_process')))
+#-- END REPLICATOR CHANGE --------------------------
+
     # Log warning messages.
 
     for user_warning_message in user_warning_messages:
@@ -1752,91 +1986,274 @@ class ReadKafkaWriteG2WithInfoThread(WriteG2Thread):
 
         consumer.close()
 
+#-- BEGIN REPLICATOR CHANGE --------------------------
 # -----------------------------------------------------------------------------
-# Class: ReadRabbitMQWriteG2Thread
+# Class: ReplicateThread
 # -----------------------------------------------------------------------------
 
 
-class ReadRabbitMQWriteG2Thread(WriteG2Thread):
-
-    def __init__(self, config, g2_engine, g2_configuration_manager, governor):
-        super().__init__(config, g2_engine, g2_configuration_manager, governor)
+class ReplicateThread(WriteG2Thread):
+    '''Base for the threads replicating withinfo messages into the datamart through their own replicator.'''
 
-    def callback(self, channel, method, header, body):
-        logging.debug(message_debug(903, threading.current_thread().name, body))
+    def commit(self):
+        try:
+            self.dm_replicator.commit_dm_transaction()
+            self.dm_replicator.release_dm_connection()
+        except Exception as err:
+            logging.warning(message_warning(223, err, "commit"))
 
-        message_str = body.decode("utf-8")
+    def drain_resync_queue(self):
         try:
-            rabbitmq_message_list = json.loads(message_str)
+            self.dm_replicator.check_dm_commit()
+            self.dm_replicator.drain_resync_queue()
+            self.dm_replicator.check_dm_maintenance()
+            self.dm_replicator.release_dm_connection()
         except Exception as err:
-            logging.info(message_debug(557, message_str, err))
-            if self.add_to_failure_queue(message_str):
-                channel.basic_ack(delivery_tag=method.delivery_tag)
+            logging.warning(message_warning(222, err))
+
+    def replicate_batch(self, message_list, message_str_list, on_commit):
+        '''Replicate the messages as one batch, on_commit(message_list, batch_status) is called once they are durable or have failed.'''
+        try:
+            self.dm_replicator.replicate_batch(message_str_list, on_commit=functools.partial(on_commit, message_list))
+            self.config['counter_processed_records'] += len(message_list)
             return
+        except Exception as err:
+            logging.warning(message_warning(223, err, message_str_list))
 
-#-- BEGIN REPLICATOR CHANGE --------------------------
-        # Verify that message is valid JSON.
-        print("-->executing callback thread: {0}".format(threading.current_thread().name))
-        success = self.dm_replicator.replicate(message_str)
-        #try: success = self.dm_replicator.replicate(message_str)
-        #except: success = False
+        # Replicated one at a time so only the message that fails goes to the failure queue.
 
-        # After replicating into datamart, tell RabbitMQ we're done with message. All the records are loaded or moved to the failure queue
-        #if success:
-        #    channel.basic_ack(delivery_tag=method.delivery_tag)
-        #else:
-        #    pass #--write to failure queue!
+        self.commit()
+        for message, message_str in zip(message_list, message_str_list):
+            try:
+                self.dm_replicator.replicate(message_str, on_commit=functools.partial(on_commit, [message]))
+                self.config['counter_processed_records'] += 1
+            except Exception as err:
+                logging.warning(message_warning(223, err, message_str))
+                self.commit()
+                on_commit([message], [3])
 
-        return
-#-- END REPLICATOR CHANGE --------------------------
+# -----------------------------------------------------------------------------
+# Class: ReadKafkaReplicateThread
+# -----------------------------------------------------------------------------
 
-        # Invoke Governor.
 
-        self.govern()
+class ReadKafkaReplicateThread(ReplicateThread):
+    '''Thread for replicating the withinfo messages of a Kafka topic into the datamart.
+       Each thread is a consumer in the group, so the topic's partitions are spread across threads and processes.
+       Offsets are only committed once the datamart transaction holding their messages has committed.
+    '''
 
-        # if this is a dict, it's a single record. Throw it in an array so it works with the code below
+    def __init__(self, config, g2_engine, g2_configuration_manager, governor):
+        super().__init__(config, g2_engine, g2_configuration_manager, governor)
+        self.consumer = None
+        self.seek_offsets = {}  # (topic, partition): offset to read again from
+        self.retry_times = {}  # (topic, partition): time a paused partition is read again
+        self.retry_tracker = RetryTracker(config)
 
-        if isinstance(rabbitmq_message_list, dict):
-            rabbitmq_message_list = [rabbitmq_message_list]
+    def on_assign(self, consumer, partitions):
+        logging.info(message_info(131, threading.current_thread().name, [x.partition for x in partitions]))
 
-        for rabbitmq_message_dictionary in rabbitmq_message_list:
-            self.config['counter_queued_records'] += 1
+    def on_revoke(self, consumer, partitions):
+        logging.info(message_info(132, threading.current_thread().name, [x.partition for x in partitions]))
 
-            # If needed, modify JSON message.
+        # Commit what has been replicated so the next owner of the partitions starts after it.
 
-            if 'DATA_SOURCE' not in rabbitmq_message_dictionary:
-                rabbitmq_message_dictionary['DATA_SOURCE'] = self.data_source
-            if 'ENTITY_TYPE' not in rabbitmq_message_dictionary:
-                rabbitmq_message_dictionary['ENTITY_TYPE'] = self.entity_type
-            rabbitmq_message_string = json.dumps(rabbitmq_message_dictionary, sort_keys=True)
+        self.commit()
+        for partition in partitions:
+            self.seek_offsets.pop((partition.topic, partition.partition), None)
+            self.retry_times.pop((partition.topic, partition.partition), None)
 
-            # Send valid JSON to Senzing.
+    def commit_offsets(self, kafka_message_list, batch_status):
+        '''Called by the replicator once the messages are durable in the datamart or have failed.'''
 
-            if self.send_jsonline_to_g2_engine(rabbitmq_message_string):
+        # A datamart error is read again along with the rest of its partition once the partition has waited out the retry delay.
+        # One out of attempts, or an invalid message, goes to the failure queue.
 
-                # Record successful transfer to Senzing.
+        offsets = {}
+        for kafka_message, replication_status in zip(kafka_message_list, batch_status):
+            topic_partition = (kafka_message.topic(), kafka_message.partition())
+            if topic_partition in self.seek_offsets and kafka_message.offset() >= self.seek_offsets[topic_partition]:
+                continue
+            retry_key = topic_partition + (kafka_message.offset(),)
+            if replication_status == 2:
+                retry_delay = self.retry_tracker.retry(retry_key)
+                if retry_delay is not None:
+                    self.seek_offsets[topic_partition] = kafka_message.offset()
+                    self.retry_times[topic_partition] = time.time() + retry_delay
+                    continue
+                logging.warning(message_warning(228, self.retry_tracker.max_attempts, kafka_message.value().decode("utf-8")))
+                replication_status = 3
+            else:
+                self.retry_tracker.done(retry_key)
+            if replication_status == 3 and not self.add_to_failure_queue(kafka_message.value().decode("utf-8")):
+                self.seek_offsets[topic_partition] = kafka_message.offset()
+                continue
+            offsets[topic_partition] = kafka_message.offset() + 1
 
-                self.config['counter_processed_records'] += 1
+        if offsets:
+            try:
+                self.consumer.commit(offsets=[confluent_kafka.TopicPartition(topic, partition, offset) for (topic, partition), offset in offsets.items()], asynchronous=False)
+            except Exception as err:
+                logging.error(message_error(722, offsets, err))
 
-        # After importing into Senzing, tell RabbitMQ we're done with message. All the records are loaded or moved to the failure queue
+    def seek(self):
 
-        channel.basic_ack(delivery_tag=method.delivery_tag)
+        # The seek drops what was already fetched after the message, a partition waiting to retry is paused until its time.
+
+        for (topic, partition), offset in self.seek_offsets.items():
+            try:
+                self.consumer.seek(confluent_kafka.TopicPartition(topic, partition, offset))
+                if (topic, partition) in self.retry_times:
+                    self.consumer.pause([confluent_kafka.TopicPartition(topic, partition)])
+            except Exception as err:
+                logging.warning(message_warning(225, partition, offset, err))
+        self.seek_offsets = {}
+
+        retry_time = time.time()
+        for (topic, partition) in [x for x in self.retry_times if self.retry_times[x] <= retry_time]:
+            del self.retry_times[(topic, partition)]
+            self.consumer.resume([confluent_kafka.TopicPartition(topic, partition)])
 
     def run(self):
-        '''Process for reading lines from RabbitMQ and feeding them to a process_function() function'''
+        '''Process for reading batches of withinfo messages from Kafka and replicating them into the datamart'''
 
         logging.info(message_info(129, threading.current_thread().name))
 
+        # Each thread has its own replicator, the entity locks keep related entity resyncs apart.
+
+        self.dm_replicator = get_datamart_replicator(self.config, self.g2_engine)
+        resync_idle_seconds = self.config.get('datamart_resync_idle_seconds')
+        consume_num_messages = self.config.get('kafka_consume_num_messages')
+
+        # Create Kafka client.
+
+        consumer_configuration = {
+            'bootstrap.servers': self.config.get('kafka_bootstrap_server'),
+            'group.id': self.config.get("kafka_group"),
+            'enable.auto.commit': False,
+            'auto.offset.reset': 'earliest'
+            }
+        self.consumer = confluent_kafka.Consumer(consumer_configuration)
+        self.consumer.subscribe([self.config.get("kafka_topic")], on_assign=self.on_assign, on_revoke=self.on_revoke)
+
+        # In a loop, get batches of messages from Kafka.
+        # On the way out the open group commit goes first, as committing it commits its offsets through the consumer.
+
+        try:
+            idle_since = time.time()
+            while True:
+                self.seek()
+                kafka_message_list = self.consumer.consume(num_messages=consume_num_messages, timeout=1.0)
+
+                # Handle non-standard Kafka output.
+
+                message_list = []
+                for kafka_message in kafka_message_list:
+                    if kafka_message.error():
+                        if kafka_message.error().code() != confluent_kafka.KafkaError._PARTITION_EOF:
+                            logging.error(message_error(723, kafka_message.error()))
+                        continue
+                    if kafka_message.value() and kafka_message.value().strip():
+                        message_list.append(kafka_message)
+
+                # Drain deferred resyncs whenever this thread is idle.
+
+                if not message_list:
+                    if self.dm_replicator.transaction_open:
+                        self.commit()
+                    elif resync_idle_seconds > 0 and time.time() - idle_since >= resync_idle_seconds:
+                        self.drain_resync_queue()
+                        idle_since = time.time()
+                    continue
+                idle_since = time.time()
+
+                self.config['counter_queued_records'] += len(message_list)
+                self.replicate_batch(message_list, [x.value().decode("utf-8") for x in message_list], self.commit_offsets)
+
+                # A group commit is not held open once the consumer has caught up, its offsets wait on it.
+
+                if self.dm_replicator.transaction_open and len(kafka_message_list) < consume_num_messages:
+                    self.commit()
+        finally:
+            try:
+                self.dm_replicator.close()
+            finally:
+                self.consumer.close()
+#-- END REPLICATOR CHANGE --------------------------
+
+# -----------------------------------------------------------------------------
+# Class: ReadRabbitMQWriteG2Thread
+# -----------------------------------------------------------------------------
+
+
+class ReadRabbitMQWriteG2Thread(WriteG2Thread):
+
+    def __init__(self, config, g2_engine, g2_configuration_manager, governor, dispatcher):
+        super().__init__(config, g2_engine, g2_configuration_manager, governor)
+        self.dispatcher = dispatcher
+        self.retry_tracker = RetryTracker(config)
+
+        # Never full, the prefetch count limits how many unacked messages can be waiting in it.
+
+        self.dispatch_queue = queue.Queue()
+
+    def callback(self, channel, method, header, body):
+        logging.debug(message_debug(903, threading.current_thread().name, body))
+
 #-- BEGIN REPLICATOR CHANGE --------------------------
-        print("-->Initializing replicator in thread: {0}".format(threading.current_thread().name))
-        g2_configuration_json = get_g2_configuration_json(self.config)
-        datamart_replicator = self.config.get('datamart_replicator')
-        datamart_connection = self.config.get('datamart_connection')
-        datamart_library = SourceFileLoader(datamart_replicator, datamart_replicator).load_module()            
-        #self.dm_replicator = datamart_library.Replicator(g2_configuration_json, None, datamart_connection, debug_level=1)
-        self.dm_replicator = datamart_library.Replicator(g2_configuration_json, self.g2_engine, datamart_connection, debug_level=1)
+        # Every delivery goes through the ack tracker so the multiple acks never cover a message still replicating.
+
+        self.ack_tracker.add(method.delivery_tag)
+
+        message_str = body.decode("utf-8")
+        try:
+            json.loads(message_str)
+        except Exception as err:
+            logging.info(message_debug(557, message_str, err))
+            self.ack_tracker.done(method.delivery_tag, requeue=not self.add_to_failure_queue(message_str))
+            return
+
+        # Hand the message to the dispatch thread, as waiting for a replicate thread here would stop the heartbeats and acks.
+        # It is acked once the replicate thread has committed it to the datamart.
+
+        self.config['counter_queued_records'] += 1
+        self.dispatch_queue.put((message_str, functools.partial(self.on_commit, message_str, method.delivery_tag)))
+
+    def dispatch_messages(self):
+        '''Passes the messages to the replicate threads for their entities, waiting while a thread's queue is full.'''
+        while True:
+            message_str, on_commit = self.dispatch_queue.get()
+            self.dispatcher.dispatch(message_str, on_commit=on_commit)
+
+    def on_commit(self, message_str, delivery_tag, batch_status):
+        '''Called by the replicate thread once the message is durable in the datamart or has failed.'''
+
+        # A datamart error is redelivered after a delay until it runs out of attempts, an invalid message goes to the failure queue.
+        # The delivery stays unacked while it waits so the prefetch count still holds back the reader.
+
+        replication_status = batch_status[0]
+        if replication_status == 2:
+            retry_delay = self.retry_tracker.retry(message_str)
+            if retry_delay is not None:
+                retry_timer = threading.Timer(retry_delay, self.ack_tracker.done, [delivery_tag], {'requeue': True})
+                retry_timer.daemon = True
+                retry_timer.start()
+                return
+            logging.warning(message_warning(228, self.retry_tracker.max_attempts, message_str))
+            replication_status = 3
+        else:
+            self.retry_tracker.done(message_str)
+        if replication_status == 3:
+            self.ack_tracker.done(delivery_tag, requeue=not self.add_to_failure_queue(message_str))
+        else:
+            self.ack_tracker.done(delivery_tag)
 #-- END REPLICATOR CHANGE --------------------------
 
+    def run(self):
+        '''Process for reading lines from RabbitMQ and feeding them to a process_function() function'''
+
+        logging.info(message_info(129, threading.current_thread().name))
+
         # Get config parameters.
 
         rabbitmq_queue = self.config.get("rabbitmq_queue")
@@ -1857,7 +2274,17 @@ class ReadRabbitMQWriteG2Thread(WriteG2Thread):
             connection = pika.BlockingConnection(pika.ConnectionParameters(host=rabbitmq_host, port=rabbitmq_port, credentials=credentials, heartbeat=rabbitmq_heartbeat))
             channel = connection.channel()
             channel.queue_declare(queue=rabbitmq_queue, passive=rabbitmq_passive_declare)
+#-- BEGIN REPLICATOR CHANGE --------------------------
+            # Enough unacked messages for every replicate thread to fill a group commit, buffered reports also group commit.
+
+            threads_per_process = self.config.get("threads_per_process")
+            commit_message_count = self.config.get("datamart_commit_message_count") or self.config.get("datamart_report_flush_message_count")
+            rabbitmq_prefetch_count = max(rabbitmq_prefetch_count, threads_per_process * commit_message_count)
             channel.basic_qos(prefetch_count=rabbitmq_prefetch_count)
+            self.ack_tracker = AckTracker(connection, channel)
+            dispatch_thread = threading.Thread(target=self.dispatch_messages, name="{0}-dispatch".format(threading.current_thread().name), daemon=True)
+            dispatch_thread.start()
+#-- END REPLICATOR CHANGE --------------------------
             channel.basic_consume(on_message_callback=self.callback, queue=rabbitmq_queue)
         except pika.exceptions.AMQPConnectionError as err:
             exit_error(412, "No exchange, consumer", rabbitmq_queue, "No routing key, consumer", err, rabbitmq_host)
@@ -1875,6 +2302,285 @@ class ReadRabbitMQWriteG2Thread(WriteG2Thread):
         except Exception as err:
             exit_error(880, err, "channel.start_consuming()")
 
+#-- BEGIN REPLICATOR CHANGE --------------------------
+# -----------------------------------------------------------------------------
+# Class: AckTracker
+# -----------------------------------------------------------------------------
+
+
+class AckTracker:
+    '''Acknowledge RabbitMQ deliveries once the replicate threads are done with them.
+       The replicate threads finish out of order, so a multiple ack is only sent up to
+       the oldest delivery still replicating. The acks are sent on the connection's own thread.
+    '''
+
+    def __init__(self, connection, channel):
+        self.connection = connection
+        self.channel = channel
+        self.delivery_tags = collections.deque()
+        self.outcomes = {}  # delivery_tag: None while replicating, else 'ack' or 'requeue'
+        self.lock = threading.Lock()
+
+    def add(self, delivery_tag):
+        with self.lock:
+            self.delivery_tags.append(delivery_tag)
+            self.outcomes[delivery_tag] = None
+
+    def done(self, delivery_tag, requeue=False):
+        '''Called by any thread, requeue sends the delivery back to the queue instead.'''
+        actions = []
+        with self.lock:
+            if delivery_tag not in self.outcomes:
+                return
+            self.outcomes[delivery_tag] = 'requeue' if requeue else 'ack'
+
+            # Ack the run of finished deliveries at the front with one multiple ack, requeue failures one at a time.
+
+            ack_tag = None
+            while self.delivery_tags and self.outcomes[self.delivery_tags[0]]:
+                tag = self.delivery_tags.popleft()
+                if self.outcomes.pop(tag) == 'ack':
+                    ack_tag = tag
+                    continue
+                if ack_tag:
+                    actions.append(('ack', ack_tag))
+                    ack_tag = None
+                actions.append(('requeue', tag))
+            if ack_tag:
+                actions.append(('ack', ack_tag))
+
+            # Scheduled under the lock, an older multiple ack sent after a newer one would close the channel.
+
+            if actions:
+                self.connection.add_callback_threadsafe(functools.partial(self.send, actions))
+
+    def send(self, actions):
+        for action, delivery_tag in actions:
+            if action == 'ack':
+                self.channel.basic_ack(delivery_tag=delivery_tag, multiple=True)
+            else:
+                self.channel.basic_nack(delivery_tag=delivery_tag, multiple=False, requeue=True)
+
+# -----------------------------------------------------------------------------
+# Class: RetryTracker
+# -----------------------------------------------------------------------------
+
+
+class RetryTracker:
+    '''Count the datamart errors of each message so one that keeps failing goes to the failure queue
+       instead of being retried forever. Each retry waits twice as long as the one before, up to a minute.
+    '''
+
+    max_delay_seconds = 60
+
+    def __init__(self, config):
+        self.max_attempts = config.get('datamart_retry_max_attempts')
+        self.delay_seconds = config.get('datamart_retry_delay_seconds')
+        self.attempts = {}  # message key: datamart errors so far
+        self.lock = threading.Lock()
+
+    def retry(self, key, attempts=None):
+        '''Returns the seconds to wait before replicating the message again, None once it is out of attempts.
+           A broker that counts the deliveries itself passes its count as the attempts.
+        '''
+        with self.lock:
+            if attempts is None:
+                attempts = self.attempts[key] = self.attempts.get(key, 0) + 1
+            if attempts >= self.max_attempts:
+                self.attempts.pop(key, None)
+                return None
+        return min(self.delay_seconds * 2 ** (attempts - 1), self.max_delay_seconds)
+
+    def done(self, key):
+        with self.lock:
+            self.attempts.pop(key, None)
+
+# -----------------------------------------------------------------------------
+# Class: EntityDispatcher
+# -----------------------------------------------------------------------------
+
+
+class EntityDispatcher:
+    '''Route each message to a replicate thread by its affected entities.
+       While an entity has messages queued or replicating they all go to the same thread,
+       so its messages are replicated in order and never by two threads at once.
+    '''
+
+    def __init__(self, thread_count, queue_maxsize):
+        self.work_queues = [queue.Queue(queue_maxsize) for i in range(thread_count)]
+        self.in_flight = {}  # entity_id: [queue index, messages]
+        self.condition = threading.Condition()
+        self.next_queue_index = 0
+        self.stage = PipelineStage("replicate", self.work_queues)
+
+    def get_entity_ids(self, message_str):
+        try:
+            message_dictionary = json.loads(message_str)
+            return sorted(set(int(x['ENTITY_ID']) for x in message_dictionary.get('AFFECTED_ENTITIES', [])))
+        except Exception:
+            return []  # The replicator logs it as invalid.
+
+    def dispatch(self, message_str, g2_resume_list=None, on_commit=None):
+        entity_id_list = self.get_entity_ids(message_str)
+        with self.condition:
+
+            # A message whose entities are in flight on different threads waits for one of them to finish.
+
+            while True:
+                owners = set(self.in_flight[x][0] for x in entity_id_list if x in self.in_flight)
+                if len(owners) <= 1:
+                    break
+                self.condition.wait()
+            if owners:
+                queue_index = owners.pop()
+            elif entity_id_list:
+                queue_index = entity_id_list[0] % len(self.work_queues)
+            else:
+                queue_index = self.next_queue_index
+                self.next_queue_index = (self.next_queue_index + 1) % len(self.work_queues)
+            for entity_id in entity_id_list:
+                if entity_id not in self.in_flight:
+                    self.in_flight[entity_id] = [queue_index, 0]
+                self.in_flight[entity_id][1] += 1
+        self.work_queues[queue_index].put((message_str, entity_id_list, g2_resume_list, on_commit))
+
+    def done(self, entity_id_list):
+        self.stage.add_processed()
+        with self.condition:
+            for entity_id in entity_id_list:
+                self.in_flight[entity_id][1] -= 1
+                if self.in_flight[entity_id][1] == 0:
+                    del self.in_flight[entity_id]
+            self.condition.notify_all()
+
+# -----------------------------------------------------------------------------
+# Class: PipelineStage
+# -----------------------------------------------------------------------------
+
+
+class PipelineStage:
+    '''Queue depth and throughput of one stage of the replication pipeline, logged by the MonitorThread.'''
+
+    def __init__(self, name, work_queues):
+        self.name = name
+        self.work_queues = work_queues
+        self.processed = 0
+        self.lock = threading.Lock()
+
+    def add_processed(self, count=1):
+        with self.lock:
+            self.processed += count
+
+    def get_queue_depth(self):
+        return sum(work_queue.qsize() for work_queue in self.work_queues)
+
+# -----------------------------------------------------------------------------
+# Class: FetchStageThread
+# -----------------------------------------------------------------------------
+
+
+class FetchStageThread(threading.Thread):
+    '''Fetch the affected entities of each message from the engine ahead of the replicate threads.
+       Many fetches run at once, but messages are passed on in the order they arrived
+       as the replicate threads would otherwise apply an older fetch over a newer one.
+    '''
+
+    def __init__(self, config, g2_engine, dispatcher, fetch_threads, queue_maxsize):
+        threading.Thread.__init__(self)
+        self.config = config
+        self.dispatcher = dispatcher
+        self.fetch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=fetch_threads, thread_name_prefix="FetchStage")
+        self.fetch_queue = queue.Queue(queue_maxsize)
+        self.fetch_replicator = get_datamart_replicator(config, g2_engine, resume_cache=False)
+        self.fetch_replicator_lock = threading.Lock()
+        self.stage = PipelineStage("fetch", [self.fetch_queue])
+
+    def dispatch(self, message_str, on_commit=None):
+        '''Called by the reader, waits while the queue of fetches is full.'''
+        self.fetch_queue.put((message_str, self.fetch_executor.submit(self.fetch, message_str), on_commit))
+
+    def fetch(self, message_str):
+        entity_id_list = self.dispatcher.get_entity_ids(message_str)
+
+        # The datamart's hashes are read before the engine's entities, the replicate thread
+        # fetches an entity again if another sync changed its hash in between.
+
+        with self.fetch_replicator_lock:
+            try:
+                dm_resume_list = self.fetch_replicator.get_resume_dm_many(entity_id_list)
+            finally:
+                self.fetch_replicator.release_dm_connection()
+        g2_resume_list = {}
+        for entity_id in entity_id_list:
+            g2_resume_list[entity_id] = self.fetch_replicator.fetch_resume_g2_api(entity_id)
+            g2_resume_list[entity_id]['DM_RESUME_HASH'] = dm_resume_list[entity_id]['RESUME_HASH']
+        return g2_resume_list
+
+    def run(self):
+
+        logging.info(message_info(129, threading.current_thread().name))
+
+        while True:
+            message_str, future, on_commit = self.fetch_queue.get()
+
+            # A failed fetch is left for the replicate thread to retry.
+
+            try:
+                g2_resume_list = future.result()
+            except Exception as err:
+                logging.warning(message_warning(224, err, message_str))
+                g2_resume_list = None
+            self.stage.add_processed()
+            self.dispatcher.dispatch(message_str, g2_resume_list, on_commit)
+
+# -----------------------------------------------------------------------------
+# Class: ReadQueueReplicateThread
+# -----------------------------------------------------------------------------
+
+
+class ReadQueueReplicateThread(ReplicateThread):
+    '''Thread for replicating the messages dispatched to its queue into the datamart.'''
+
+    def __init__(self, config, g2_engine, g2_configuration_manager, governor, dispatcher, queue_index):
+        super().__init__(config, g2_engine, g2_configuration_manager, governor)
+        self.dispatcher = dispatcher
+        self.work_queue = dispatcher.work_queues[queue_index]
+
+    def run(self):
+
+        logging.info(message_info(129, threading.current_thread().name))
+
+        # Each thread has its own replicator, the entity locks keep related entity resyncs apart.
+
+        self.dm_replicator = get_datamart_replicator(self.config, self.g2_engine)
+        resync_idle_seconds = self.config.get('datamart_resync_idle_seconds')
+
+        while True:
+
+            # A group commit is not held open waiting for more messages, the source only acks what is committed.
+
+            if self.dm_replicator.transaction_open and self.work_queue.empty():
+                self.commit()
+
+            # Drain deferred resyncs whenever this thread is idle.
+
+            try:
+                message_str, entity_id_list, g2_resume_list, on_commit = self.work_queue.get(timeout=resync_idle_seconds if resync_idle_seconds > 0 else None)
+            except queue.Empty:
+                self.drain_resync_queue()
+                continue
+
+            try:
+                self.dm_replicator.replicate(message_str, on_commit=on_commit, g2_resume_list=g2_resume_list)
+                self.config['counter_processed_records'] += 1
+            except Exception as err:
+                logging.warning(message_warning(223, err, message_str))
+                if on_commit:
+                    on_commit([3])  # Would fail again if redelivered.
+            finally:
+                self.dispatcher.done(entity_id_list)
+#-- END REPLICATOR CHANGE --------------------------
+
 # -----------------------------------------------------------------------------
 # Class: ReadRabbitMQWriteG2WithInfoThread
 # -----------------------------------------------------------------------------
@@ -2242,6 +2948,143 @@ class ReadSqsWriteG2Thread(WriteG2Thread):
                 ReceiptHandle=sqs_message_receipt_handle
             )
 
+#-- BEGIN REPLICATOR CHANGE --------------------------
+# -----------------------------------------------------------------------------
+# Class: ReadSqsReplicateThread
+# -----------------------------------------------------------------------------
+
+
+class ReadSqsReplicateThread(ReplicateThread, ReadSqsWriteG2Thread):
+    '''Thread for replicating the withinfo messages of an AWS SQS queue into the datamart.
+       Up to 10 messages are received and replicated as a batch, then deleted with one call
+       once the datamart transaction holding them has committed.
+    '''
+
+    def __init__(self, config, g2_engine, g2_configuration_manager, governor):
+        super().__init__(config, g2_engine, g2_configuration_manager, governor)
+        self.visibility_timeout = config.get('sqs_visibility_timeout_seconds')
+        self.pending_messages = {}  # ReceiptHandle: time its visibility timeout was last set
+        self.pending_lock = threading.Lock()
+        self.retry_tracker = RetryTracker(config)
+
+    def delete_messages(self, sqs_message_list, batch_status):
+        '''Called by the replicator once the messages are durable in the datamart or have failed.'''
+
+        # A datamart error is received again once its visibility timeout is set to the retry delay, the receive count
+        # is the attempts so far across every consumer. One out of attempts, or an invalid message, goes to the failure queue
+        # or is left for the dead-letter queue.
+
+        delete_list = []
+        retry_lists = {}  # retry delay: ReceiptHandles
+        for sqs_message, replication_status in zip(sqs_message_list, batch_status):
+            if replication_status == 2:
+                receive_count = int(sqs_message.get("Attributes", {}).get("ApproximateReceiveCount", 1))
+                retry_delay = self.retry_tracker.retry(sqs_message.get("MessageId"), receive_count)
+                if retry_delay is not None:
+                    retry_lists.setdefault(retry_delay, []).append(sqs_message.get("ReceiptHandle"))
+                    continue
+                logging.warning(message_warning(228, receive_count, sqs_message.get("Body")))
+                replication_status = 3
+            if replication_status != 3 or self.add_to_failure_queue(sqs_message.get("Body")):
+                delete_list.append(sqs_message)
+        with self.pending_lock:
+            for sqs_message in sqs_message_list:
+                self.pending_messages.pop(sqs_message.get("ReceiptHandle"), None)
+
+        if delete_list:
+            try:
+                sqs_response = self.sqs.delete_message_batch(
+                    QueueUrl=self.queue_url,
+                    Entries=[{'Id': str(i), 'ReceiptHandle': x.get("ReceiptHandle")} for i, x in enumerate(delete_list)]
+                )
+                if sqs_response.get("Failed"):
+                    logging.warning(message_warning(226, self.queue_url, sqs_response.get("Failed")))
+            except Exception as err:
+                logging.warning(message_warning(226, self.queue_url, err))
+        for retry_delay, receipt_handle_list in retry_lists.items():
+            self.change_visibility(receipt_handle_list, retry_delay)
+
+    def change_visibility(self, receipt_handle_list, visibility_timeout):
+        for i in range(0, len(receipt_handle_list), 10):
+            try:
+                sqs_response = self.sqs.change_message_visibility_batch(
+                    QueueUrl=self.queue_url,
+                    Entries=[{'Id': str(j), 'ReceiptHandle': x, 'VisibilityTimeout': visibility_timeout} for j, x in enumerate(receipt_handle_list[i:i + 10])]
+                )
+                if sqs_response.get("Failed"):
+                    logging.warning(message_warning(227, self.queue_url, sqs_response.get("Failed")))
+            except Exception as err:
+                logging.warning(message_warning(227, self.queue_url, err))
+
+    def extend_visibility(self):
+        '''Keeps the messages of a slow batch or group commit from being received again before they are deleted.'''
+        while True:
+            time.sleep(self.visibility_timeout / 3)
+            extend_before = time.time() - self.visibility_timeout / 2
+            with self.pending_lock:
+                receipt_handle_list = [x for x in self.pending_messages if self.pending_messages[x] < extend_before]
+                for receipt_handle in receipt_handle_list:
+                    self.pending_messages[receipt_handle] = time.time()
+            if receipt_handle_list:
+                self.change_visibility(receipt_handle_list, self.visibility_timeout)
+
+    def run(self):
+        '''Process for reading batches of withinfo messages from AWS SQS and replicating them into the datamart'''
+
+        logging.info(message_info(129, threading.current_thread().name))
+
+        # Each thread has its own replicator, the entity locks keep related entity resyncs apart.
+
+        self.dm_replicator = get_datamart_replicator(self.config, self.g2_engine)
+        resync_idle_seconds = self.config.get('datamart_resync_idle_seconds')
+        visibility_thread = threading.Thread(target=self.extend_visibility, name="{0}-visibility".format(threading.current_thread().name), daemon=True)
+        visibility_thread.start()
+
+        # In a loop, get batches of messages from AWS SQS.
+
+        idle_since = time.time()
+        while True:
+
+            sqs_response = self.sqs.receive_message(
+                QueueUrl=self.queue_url,
+                AttributeNames=['ApproximateReceiveCount'],
+                MaxNumberOfMessages=10,
+                MessageAttributeNames=[],
+                VisibilityTimeout=self.visibility_timeout,
+                WaitTimeSeconds=self.sqs_wait_time_seconds
+            )
+
+            # If non-standard SQS output or empty messages, commit and drain deferred resyncs while idle.
+
+            sqs_messages = sqs_response.get("Messages", []) if sqs_response else []
+            if not sqs_messages:
+                if self.dm_replicator.transaction_open:
+                    self.commit()
+                elif self.exit_on_empty_queue:
+                    logging.info(message_info(191, threading.current_thread().name, self.queue_url))
+                    break
+                elif resync_idle_seconds > 0 and time.time() - idle_since >= resync_idle_seconds:
+                    logging.info(message_info(190, threading.current_thread().name, self.queue_url))
+                    self.drain_resync_queue()
+                    idle_since = time.time()
+                continue
+            idle_since = time.time()
+
+            with self.pending_lock:
+                for sqs_message in sqs_messages:
+                    self.pending_messages[sqs_message.get("ReceiptHandle")] = time.time()
+
+            self.config['counter_queued_records'] += len(sqs_messages)
+            self.replicate_batch(sqs_messages, [x.get("Body") for x in sqs_messages], self.delete_messages)
+
+            # A group commit is not held open once the queue has been caught up with, the deletes wait on it.
+
+            if self.dm_replicator.transaction_open and len(sqs_messages) < 10:
+                self.commit()
+
+        self.dm_replicator.close()
+#-- END REPLICATOR CHANGE --------------------------
+
 # -----------------------------------------------------------------------------
 # Class: ReadSqsWriteG2WithInfoThread
 # -----------------------------------------------------------------------------
@@ -2622,7 +3465,7 @@ class ReadQueueWriteG2Thread(WriteG2Thread):
 
 class MonitorThread(threading.Thread):
 
-    def __init__(self, config, g2_engine, workers):
+    def __init__(self, config, g2_engine, workers, stages=None):
         threading.Thread.__init__(self)
         self.config = config
         self.digits_regex_pattern = re.compile(':\d+$')
@@ -2633,6 +3476,7 @@ class MonitorThread(threading.Thread):
         self.pstack_pid = config.get("pstack_pid")
         self.sleep_time_in_seconds = config.get('monitoring_period_in_seconds')
         self.workers = workers
+        self.stages = stages or []
 
     def run(self):
         '''Periodically monitor what is happening.'''
@@ -2641,6 +3485,7 @@ class MonitorThread(threading.Thread):
         last_queued_records = 0
         last_time = time.time()
         last_log_license = time.time()
+        last_stage_processed = {stage.name: 0 for stage in self.stages}
 
         # Sleep-monitor loop.
 
@@ -2696,6 +3541,23 @@ class MonitorThread(threading.Thread):
                 "workers_total": len(self.workers),
                 "workers_active": active_workers,
             }
+
+#-- BEGIN REPLICATOR CHANGE --------------------------
+            # Each pipeline stage shows where messages are backing up.
+
+            if self.stages:
+                stats["stages"] = {}
+                for stage in self.stages:
+                    stage_processed = stage.processed
+                    stats["stages"][stage.name] = {
+                        "processed_interval": stage_processed - last_stage_processed[stage.name],
+                        "processed_total": stage_processed,
+                        "queue_depth": stage.get_queue_depth(),
+                        "rate_processed_interval": int((stage_processed - last_stage_processed[stage.name]) / elapsed_time),
+                    }
+                    last_stage_processed[stage.name] = stage_processed
+#-- END REPLICATOR CHANGE --------------------------
+
             logging.info(message_info(127, json.dumps(stats, sort_keys=True)))
 
             # Log engine statistics with sorted JSON keys.
@@ -2971,6 +3833,62 @@ def get_g2_diagnostic(config, g2_diagnostic_name="loader-G2-diagnostic"):
     return result
 
 
+#-- BEGIN REPLICATOR CHANGE --------------------------
+def get_datamart_connection_pool(config, datamart_library):
+    '''Get the datamart connection pool shared by all threads, None for a connection per thread.'''
+    global datamart_connection_pool
+    if config.get('datamart_pool_size') <= 0:
+        return None
+    with datamart_connection_pool_lock:
+        if not datamart_connection_pool:
+            datamart_connection_pool = datamart_library.DatamartConnectionPool(
+                config.get('datamart_connection'),
+                pool_size=config.get('datamart_pool_size'),
+                idle_seconds=config.get('datamart_pool_idle_seconds'),
+                datamart_profile=config.get('datamart_profile'),
+                sqlite_pragmas=get_datamart_sqlite_pragmas(config))
+    return datamart_connection_pool
+
+
+def get_datamart_sqlite_pragmas(config):
+    '''Get the list of pragmas from the semicolon separated datamart_sqlite_pragmas.'''
+    sqlite_pragmas = config.get('datamart_sqlite_pragmas')
+    return [x.strip() for x in sqlite_pragmas.split(';') if x.strip()] if sqlite_pragmas else []
+
+
+def get_datamart_replicator(config, g2_engine, resume_cache=True):
+    '''Get a replicator for the calling thread, sharing the engine, the connection pool and the entity locks.
+       Only a replicator that writes the datamart can keep a resume cache, as nothing else updates it.
+    '''
+    g2_configuration_json = get_g2_configuration_json(config)
+    datamart_replicator = config.get('datamart_replicator')
+    datamart_connection = config.get('datamart_connection')
+    datamart_library = SourceFileLoader(datamart_replicator, datamart_replicator).load_module()
+    resume_cache_size = config.get('datamart_resume_cache_size') if resume_cache and config.get('threads_per_process') == 1 else 0
+    return datamart_library.Replicator(g2_configuration_json, g2_engine, datamart_connection, debug_level=1,
+                                       resync_max_depth=config.get('datamart_resync_max_depth'),
+                                       resync_entity_budget=config.get('datamart_resync_entity_budget'),
+                                       connection_pool=get_datamart_connection_pool(config, datamart_library),
+                                       datamart_profile=config.get('datamart_profile'),
+                                       sqlite_pragmas=get_datamart_sqlite_pragmas(config),
+                                       entity_locks=get_datamart_entity_locks(config, datamart_library),
+                                       commit_message_count=config.get('datamart_commit_message_count'),
+                                       commit_interval_ms=config.get('datamart_commit_interval_ms'),
+                                       report_flush_message_count=config.get('datamart_report_flush_message_count'),
+                                       report_flush_interval_ms=config.get('datamart_report_flush_interval_ms'),
+                                       resume_cache_size=resume_cache_size)
+
+
+def get_datamart_entity_locks(config, datamart_library):
+    '''Get the entity locks shared by all replicate threads.'''
+    global datamart_entity_locks
+    with datamart_connection_pool_lock:
+        if not datamart_entity_locks:
+            datamart_entity_locks = datamart_library.EntityLocks()
+    return datamart_entity_locks
+#-- END REPLICATOR CHANGE --------------------------
+
+
 def get_g2_engine(config, g2_engine_name="loader-G2-engine"):
     '''Get the G2Engine resource.'''
     try:
@@ -3357,6 +4275,75 @@ def do_kafka(args):
     logging.info(exit_template(config))
 
 
+#-- BEGIN REPLICATOR CHANGE --------------------------
+def do_kafka_replicate(args):
+    ''' Replicate from Kafka. '''
+
+    # Get context from CLI, environment variables, and ini files.
+
+    config = get_configuration(args)
+
+    # Perform common initialization tasks.
+
+    common_prolog(config)
+
+    # Pull values from configuration.
+
+    sleep_time_in_seconds = config.get('sleep_time_in_seconds')
+    threads_per_process = config.get('threads_per_process')
+
+    # Get the Senzing G2 resources.
+
+    g2_engine = get_g2_engine(config)
+    g2_configuration_manager = get_g2_configuration_manager(config)
+    governor = Governor(g2_engine=g2_engine, hint="stream-loader")
+
+    # Create kafka replicate threads for master process, each is a consumer in the group.
+
+    threads = []
+    for i in range(0, threads_per_process):
+        thread = ReadKafkaReplicateThread(config, g2_engine, g2_configuration_manager, governor)
+        thread.name = "KafkaProcess-0-thread-{0}".format(i)
+        threads.append(thread)
+
+    # Create monitor thread for master process.
+
+    adminThreads = []
+    thread = MonitorThread(config, g2_engine, threads)
+    thread.name = "KafkaProcess-0-thread-monitor"
+    adminThreads.append(thread)
+
+    # Start threads for master process.
+
+    for thread in threads:
+        thread.start()
+
+    # Sleep, if requested.
+
+    if sleep_time_in_seconds > 0:
+        logging.info(message_info(152, sleep_time_in_seconds))
+        time.sleep(sleep_time_in_seconds)
+
+    # Start administrative threads for master process.
+
+    for thread in adminThreads:
+        thread.start()
+
+    # Collect inactive threads from master process.
+
+    for thread in threads:
+        thread.join()
+
+    # Cleanup.
+
+    g2_engine.destroy()
+
+    # Epilog.
+
+    logging.info(exit_template(config))
+#-- END REPLICATOR CHANGE --------------------------
+
+
 def do_kafka_withinfo(args):
     ''' Read from Kafka. '''
 
@@ -3450,7 +4437,8 @@ def do_rabbitmq(args):
 
     sleep_time_in_seconds = config.get('sleep_time_in_seconds')
     threads_per_process = config.get('threads_per_process')
-    threads_per_process = 1
+    queue_maxsize = config.get('queue_maxsize')
+    fetch_threads = config.get('datamart_fetch_threads')
 
     # Get the Senzing G2 resources.
     #----dm_replicator = get_dm_replicator(config)
@@ -3465,19 +4453,35 @@ def do_rabbitmq(args):
     # dm_replicator = datamart_library.Replicator(g2_configuration_json, None, datamart_connection, debug_level=1)
 
 
-    # Create RabbitMQ reader threads for master process.
+#-- BEGIN REPLICATOR CHANGE --------------------------
+    # One RabbitMQ reader thread routes messages to the replicate threads by the entities they affect,
+    # through a stage fetching their entities from the engine first if requested.
+
+    dispatcher = EntityDispatcher(threads_per_process, queue_maxsize)
+    stages = [dispatcher.stage]
 
     threads = []
+    if fetch_threads > 0:
+        thread = FetchStageThread(config, g2_engine, dispatcher, fetch_threads, queue_maxsize)
+        thread.name = "RabbitMQProcess-0-thread-fetch"
+        threads.append(thread)
+        stages.insert(0, thread.stage)
+    thread = ReadRabbitMQWriteG2Thread(config, g2_engine, g2_configuration_manager, governor, threads[0] if threads else dispatcher)
+    thread.name = "RabbitMQProcess-0-thread-reader"
+    threads.append(thread)
+
+    # Create replicate threads for master process.
+
     for i in range(0, threads_per_process):
-        thread = ReadRabbitMQWriteG2Thread(config, g2_engine, g2_configuration_manager, governor)
+        thread = ReadQueueReplicateThread(config, g2_engine, g2_configuration_manager, governor, dispatcher, i)
         thread.name = "RabbitMQProcess-0-thread-{0}".format(i)
-        print('-->instantiated', thread.name)
         threads.append(thread)
+#-- END REPLICATOR CHANGE --------------------------
 
     # Create monitor thread for master process.
 
     adminThreads = []
-    thread = MonitorThread(config, g2_engine, threads)
+    thread = MonitorThread(config, g2_engine, threads, stages)
     thread.name = "RabbitMQProcess-0-thread-monitor"
     adminThreads.append(thread)
 
@@ -3641,6 +4645,14 @@ def do_sqs_withinfo(args):
     dohelper_thread_runner(args, ReadSqsWriteG2WithInfoThread, {})
 
 
+#-- BEGIN REPLICATOR CHANGE --------------------------
+def do_sqs_replicate(args):
+    ''' Replicate from SQS. '''
+
+    dohelper_thread_runner(args, ReadSqsReplicateThread, {})
+#-- END REPLICATOR CHANGE --------------------------
+
+
 def do_url(args):
     '''Read from URL-addressable file.'''
 
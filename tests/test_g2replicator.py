@@ -0,0 +1,712 @@
+'''G2Replicator.py run against a sqlite datamart and a fake engine.'''
+
+import importlib.util
+import json
+import os
+import random
+import sqlite3
+import sys
+import threading
+import time
+import types
+from unittest import mock
+
+import pytest
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+G2REPLICATOR_PATH = os.path.join(REPO_PATH, 'G2Replicator.py')
+SCHEMA_PATH = os.path.join(REPO_PATH, 'g2mart-schema-sqlite-create.sql')
+
+
+class G2Exception(Exception):
+    pass
+
+
+class FakeG2Database:
+    '''Just the G2Database calls the replicator makes, on a sqlite connection left in autocommit like the real one.'''
+
+    def __init__(self, connection_str):
+        self.dbType = 'SQLITE3'
+        self.dbo = sqlite3.connect(connection_str.split('@', 1)[1], isolation_level=None, check_same_thread=False)
+
+    def sqlExec(self, sql, parmList=None):
+        if parmList is not None and not isinstance(parmList, (list, tuple)):
+            parmList = [parmList]
+        cursor = self.dbo.cursor()
+        cursor.execute(sql, parmList or [])
+        return {'CURSOR': cursor, 'ROWS_AFFECTED': cursor.rowcount}
+
+    def execMany(self, sql, parmList):
+        cursor = self.dbo.cursor()
+        cursor.executemany(sql, parmList)
+        return {'CURSOR': cursor, 'ROWS_AFFECTED': cursor.rowcount}
+
+    def fetchRow(self, cursorData):
+        return cursorData['CURSOR'].fetchone()
+
+    def fetchAllRows(self, cursorData):
+        return cursorData['CURSOR'].fetchall()
+
+    def fetchManyRows(self, cursorData, rowCount):
+        return cursorData['CURSOR'].fetchmany(rowCount)
+
+    def close(self):
+        self.dbo.close()
+
+
+class FakeG2Engine:
+    '''Entities are {entity_id: {'records': [(data_source, record_id)], 'relations': {related_id: (match_level, match_key, is_disclosed, is_ambiguous)}}}.'''
+
+    G2_ENTITY_INCLUDE_ENTITY_NAME = 1
+    G2_ENTITY_INCLUDE_RECORD_DATA = 2
+    G2_ENTITY_INCLUDE_ALL_RELATIONS = 4
+    G2_ENTITY_INCLUDE_RELATED_MATCHING_INFO = 8
+    G2_ENTITY_INCLUDE_RELATED_RECORD_SUMMARY = 16
+    G2_ENTITY_INCLUDE_RECORD_JSON_DATA = 32
+
+    def __init__(self, entities=None):
+        self.entities = entities if entities is not None else {}
+
+    def initV2(self, module_name, ini_params, verbose_logging):
+        pass
+
+    def getEntityByEntityIDV2(self, entity_id, flags, response):
+        entity = self.entities.get(entity_id)
+        if not entity or not entity['records']:
+            raise G2Exception('0037E Unknown resolved entity value')
+        related_entities = []
+        for related_id in sorted(entity['relations']):
+            match_level, match_key, is_disclosed, is_ambiguous = entity['relations'][related_id]
+            data_sources = sorted(set(x[0] for x in self.entities[related_id]['records']))
+            related_entities.append({'ENTITY_ID': related_id,
+                                     'MATCH_LEVEL': match_level,
+                                     'MATCH_KEY': match_key,
+                                     'IS_DISCLOSED': is_disclosed,
+                                     'IS_AMBIGUOUS': is_ambiguous,
+                                     'RECORD_SUMMARY': [{'DATA_SOURCE': x, 'RECORD_COUNT': 1} for x in data_sources]})
+        response.extend(json.dumps({'RESOLVED_ENTITY': {'ENTITY_ID': entity_id,
+                                                        'ENTITY_NAME': 'entity %s' % entity_id,
+                                                        'RECORDS': [{'DATA_SOURCE': x, 'RECORD_ID': y} for x, y in entity['records']]},
+                                    'RELATED_ENTITIES': related_entities}).encode('utf-8'))
+
+
+@pytest.fixture
+def g2replicator():
+    '''The engine's python modules are only touched through these names, so the fakes replace them.'''
+    fake_modules = {
+        'G2Paths': types.SimpleNamespace(get_G2Module_ini_path=lambda: ''),
+        'G2Database': types.SimpleNamespace(G2Database=FakeG2Database),
+        'G2Product': types.SimpleNamespace(G2Product=None),
+        'G2Engine': types.SimpleNamespace(G2Engine=FakeG2Engine),
+        'G2IniParams': types.SimpleNamespace(G2IniParams=lambda: types.SimpleNamespace(getJsonINIParams=lambda ini_file_name: '{}')),
+        'G2ConfigMgr': types.SimpleNamespace(G2ConfigMgr=None),
+        'G2Exception': types.SimpleNamespace(G2Exception=G2Exception),
+    }
+    with mock.patch.dict(sys.modules, fake_modules):
+        spec = importlib.util.spec_from_file_location('G2Replicator', G2REPLICATOR_PATH)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def datamart(tmp_path):
+    '''A new datamart from the schema script, returns its connection string.'''
+    database_path = str(tmp_path / 'g2mart.db')
+    connection = sqlite3.connect(database_path)
+    with open(SCHEMA_PATH) as schema_file:
+        connection.executescript(schema_file.read())
+    connection.close()
+    return 'sqlite3://na:na@' + database_path
+
+
+def query(datamart, sql):
+    '''Through a connection of its own, so only what was committed is seen.'''
+    connection = sqlite3.connect(datamart.split('@', 1)[1])
+    try:
+        result = connection.execute(sql).fetchall()
+        connection.commit()
+        return result
+    finally:
+        connection.close()
+
+
+def get_message(data_source, record_id, entity_id_list):
+    return json.dumps({'DATA_SOURCE': data_source,
+                       'RECORD_ID': record_id,
+                       'AFFECTED_ENTITIES': [{'ENTITY_ID': x, 'LENS_CODE': 'DEFAULT'} for x in entity_id_list],
+                       'INTERESTING_ENTITIES': []})
+
+# -----------------------------------------------------------------------------
+# group commit
+# -----------------------------------------------------------------------------
+
+
+def test_group_commit(g2replicator, datamart):
+    g2_engine = FakeG2Engine({1: {'records': [('CUSTOMER', '1')], 'relations': {}},
+                              2: {'records': [('CUSTOMER', '2')], 'relations': {}},
+                              3: {'records': [('CUSTOMER', '3')], 'relations': {}}})
+    replicator = g2replicator.Replicator('', g2_engine, datamart, commit_message_count=10)
+
+    # Writing entity 2 fails after its record was written.
+
+    sql_exec = replicator.dbo.sqlExec
+
+    def failing_sql_exec(sql, parmList=None):
+        if sql.startswith('insert into DM_ENTITY ') and parmList[0] == 2:
+            raise sqlite3.OperationalError('disk I/O error')
+        return sql_exec(sql, parmList)
+
+    commits = []
+    with mock.patch.object(replicator.dbo, 'sqlExec', failing_sql_exec):
+        replicator.replicate(get_message('CUSTOMER', '1', [1]), commits.append)
+        replicator.replicate(get_message('CUSTOMER', '2', [2]), commits.append)
+        replicator.replicate('not json', commits.append)
+        replicator.replicate(get_message('CUSTOMER', '3', [3]), commits.append)
+
+    # Nothing is acknowledged or visible to other connections until the group commits.
+
+    assert commits == []
+    assert replicator.transaction_open
+    assert query(datamart, 'select count(*) from DM_RECORD') == [(0,)]
+
+    replicator.close()
+
+    # Only the failed message's own savepoint was rolled back, its record with it.
+
+    assert commits == [[0], [2], [3], [0]]
+    assert query(datamart, 'select RECORD_ID, ENTITY_ID from DM_RECORD order by RECORD_ID') == [('1', 1), ('3', 3)]
+    assert query(datamart, 'select ENTITY_ID from DM_ENTITY order by ENTITY_ID') == [(1,), (3,)]
+    assert query(datamart, "select ENTITY_COUNT, RECORD_COUNT from DM_REPORT where REPORT = 'TOTAL' and STATISTIC = 'ENTITY_COUNT'") == [(2, 0)]
+
+# -----------------------------------------------------------------------------
+# resume hashes
+# -----------------------------------------------------------------------------
+
+
+def get_resume(record_count=2, relation_count=2, match_key='+NAME+DOB', record_id_prefix=''):
+    return {'ENTITY_ID': 1,
+            'RECORD_SUMMARY': {'CUSTOMER': ['%s%04d' % (record_id_prefix, x) for x in range(record_count)]} if record_count else {},
+            'RELATION_SUMMARY': {str(x + 2): {'MATCH_LEVEL': 2 + x % 2,
+                                              'MATCH_KEY': match_key,
+                                              'MATCH_CATEGORY': 'PM' if x % 2 == 0 else 'PR',
+                                              'DATA_SOURCES': ['WATCHLIST', 'CUSTOMER']} for x in range(relation_count)}}
+
+
+def get_resume_data(resume):
+    '''What decoding a hash gives back, lists sorted and a missing match key as an empty one.'''
+    return {'RECORD_SUMMARY': {x: sorted(y) for x, y in resume['RECORD_SUMMARY'].items()},
+            'RELATION_SUMMARY': {x: dict(y, MATCH_KEY=y['MATCH_KEY'] or '', DATA_SOURCES=sorted(y['DATA_SOURCES'])) for x, y in resume['RELATION_SUMMARY'].items()}}
+
+
+@pytest.mark.parametrize('resume', [
+    get_resume(),
+    get_resume(relation_count=0),
+    get_resume(match_key=None),
+    get_resume(record_id_prefix='ÄÖÜ-記録-'),
+    get_resume(record_count=1, relation_count=300),
+    get_resume(record_count=70000, relation_count=0),
+], ids=['small', 'no_relations', 'no_match_key', 'unicode', 'two_byte_ints', 'four_byte_ints'])
+def test_binary_hash(g2replicator, datamart, resume):
+    replicator = g2replicator.Replicator('', FakeG2Engine(), datamart)
+    replicator.max_resume_hash_len = 1000000
+    assert replicator.resume_hash_format == 'binary'
+
+    resume_hash = replicator.resume_hash_encode(resume)
+    assert resume_hash[0:2] == b'\x02\x00'
+    assert replicator.resume_hash_decode(resume_hash) == get_resume_data(resume)
+    assert replicator.resume_hash_decode(memoryview(resume_hash)) == get_resume_data(resume)
+
+    # The same resume in any order gives the same hash.
+
+    shuffled_resume = get_resume_data(resume)
+    for data_source in shuffled_resume['RECORD_SUMMARY']:
+        shuffled_resume['RECORD_SUMMARY'][data_source].reverse()
+    shuffled_resume['RELATION_SUMMARY'] = dict(reversed(list(shuffled_resume['RELATION_SUMMARY'].items())))
+    assert replicator.resume_hash_encode(shuffled_resume) == resume_hash
+
+
+@pytest.mark.parametrize('compression', ['zlib', 'zstd'])
+def test_binary_hash_compression(g2replicator, datamart, compression):
+    if compression == 'zstd':
+        pytest.importorskip('zstandard')
+    replicator = g2replicator.Replicator('', FakeG2Engine(), datamart, resume_hash_compression=compression)
+    resume = get_resume(record_count=40, relation_count=5)
+
+    resume_hash = replicator.resume_hash_encode(resume)
+    assert resume_hash[0:2] == b'\x02' + replicator.binary_hash_compression[compression]
+    assert len(resume_hash) <= replicator.max_resume_hash_len
+    assert replicator.resume_hash_decode(resume_hash) == get_resume_data(resume)
+    assert replicator.stat_log['hash_decode'][compression] == 1
+
+
+def test_legacy_hash(g2replicator, datamart):
+    csv_replicator = g2replicator.Replicator('', FakeG2Engine(), datamart, resume_hash_format='csv')
+    replicator = g2replicator.Replicator('', FakeG2Engine(), datamart)
+
+    # Plain and zlib compressed csv hashes written before the binary format still decode.
+
+    for resume, hash_type in [(get_resume(), str), (get_resume(record_count=40, relation_count=5), bytes)]:
+        resume_hash = csv_replicator.resume_hash_encode(resume)
+        assert isinstance(resume_hash, hash_type)
+        assert replicator.resume_hash_decode(resume_hash) == get_resume_data(resume)
+        if hash_type is bytes:
+            assert replicator.resume_hash_decode(memoryview(resume_hash)) == get_resume_data(resume)
+    assert replicator.stat_log['hash_decode'] == {'str': 1, 'zip': 2}
+
+
+def test_sha_hash(g2replicator, datamart):
+    replicator = g2replicator.Replicator('', FakeG2Engine(), datamart)
+
+    # Too long even compressed, the full resume is kept aside for DM_ENTITY_RESUME.
+
+    resume = get_resume(record_count=400, relation_count=50)
+    resume_hash = replicator.resume_hash_encode(resume)
+    assert resume_hash.startswith('~sha~')
+    assert replicator.resume_hash_decode(resume['RESUME_DATA']) == get_resume_data(resume)
+
+    # A nul in a string cannot be split apart again, so nothing is kept aside.
+
+    resume = get_resume(record_id_prefix='\x00')
+    resume_hash = replicator.resume_hash_encode(resume)
+    assert resume_hash.startswith('~sha~')
+    assert 'RESUME_DATA' not in resume
+    assert replicator.resume_data_encode(resume) is None
+
+
+def test_sha_hash_replicate(g2replicator, datamart):
+    g2_engine = FakeG2Engine({1: {'records': [('CUSTOMER', '%04d' % x) for x in range(400)], 'relations': {}}})
+    replicator = g2replicator.Replicator('', g2_engine, datamart)
+    replicator.replicate(get_message('CUSTOMER', '0000', [1]))
+    resume_hash = query(datamart, 'select RESUME_HASH from DM_ENTITY where ENTITY_ID = 1')[0][0]
+    assert resume_hash.startswith('~sha~')
+    assert query(datamart, 'select RESUME_HASH from DM_ENTITY_RESUME where ENTITY_ID = 1') == [(resume_hash,)]
+
+    # The next change reads the prior resume from DM_ENTITY_RESUME.
+
+    g2_engine.entities[1]['records'].append(('CUSTOMER', '0400'))
+    replicator.replicate(get_message('CUSTOMER', '0400', [1]))
+    assert replicator.stat_log['hash_decode']['resume_table'] == 1
+    assert 'hash(from db)' not in replicator.stat_log['hash_decode']
+
+    # Without it, the prior resume is rebuilt from the datamart itself.
+
+    query(datamart, 'delete from DM_ENTITY_RESUME')
+    g2_engine.entities[1]['records'].append(('CUSTOMER', '0401'))
+    replicator.replicate(get_message('CUSTOMER', '0401', [1]))
+    assert replicator.stat_log['hash_decode']['hash(from db)'] == 1
+    assert query(datamart, 'select count(*) from DM_RECORD where ENTITY_ID = 1') == [(402,)]
+
+    # Once the entity fits in its hash again, the resume kept aside is deleted.
+
+    g2_engine.entities[1]['records'] = [('CUSTOMER', '0000')]
+    replicator.replicate(get_message('CUSTOMER', '0000', [1]))
+    assert query(datamart, 'select count(*) from DM_ENTITY_RESUME') == [(0,)]
+    assert query(datamart, 'select RECORD_COUNT from DM_ENTITY where ENTITY_ID = 1') == [(1,)]
+
+# -----------------------------------------------------------------------------
+# datamart connections
+# -----------------------------------------------------------------------------
+
+
+def test_sqlite_pragmas(g2replicator, datamart):
+    replicator = g2replicator.Replicator('', FakeG2Engine(), datamart, datamart_profile='wal', sqlite_pragmas=['synchronous = NORMAL', 'user_version = 7'])
+
+    # Run after the profile's, so they can override it.
+
+    assert replicator.dbo.fetchRow(replicator.dbo.sqlExec('pragma journal_mode')) == ('wal',)
+    assert replicator.dbo.fetchRow(replicator.dbo.sqlExec('pragma synchronous')) == (1,)
+    assert query(datamart, 'pragma user_version') == [(7,)]
+    replicator.close()
+
+# -----------------------------------------------------------------------------
+# datamarts created before a table was added
+# -----------------------------------------------------------------------------
+
+
+def test_create_entity_resume(g2replicator, datamart):
+    query(datamart, 'drop table DM_ENTITY_RESUME')
+    g2_engine = FakeG2Engine({1: {'records': [('CUSTOMER', '%04d' % x) for x in range(400)], 'relations': {}}})
+    replicator = g2replicator.Replicator('', g2_engine, datamart, commit_message_count=10)
+    assert replicator.entity_resume_enabled
+    assert replicator.stat_log['table_created'] == {'DM_ENTITY_RESUME': 1}
+
+    commits = []
+    replicator.replicate(get_message('CUSTOMER', '0000', [1]), commits.append)
+    replicator.close()
+    assert commits == [[0]]
+    assert 'sql_error' not in replicator.stat_log
+    assert query(datamart, 'select count(*) from DM_ENTITY_RESUME') == [(1,)]
+
+
+def test_buffered_reports(g2replicator, datamart):
+    g2_engine = FakeG2Engine({1: {'records': [('CUSTOMER', '1')], 'relations': {}},
+                              2: {'records': [('CUSTOMER', '2')], 'relations': {}}})
+    replicator = g2replicator.Replicator('', g2_engine, datamart, report_flush_message_count=2)
+
+    # Buffered report counts commit along with the entities they came from.
+
+    assert replicator.group_commit
+    commits = []
+    replicator.replicate(get_message('CUSTOMER', '1', [1]), commits.append)
+    assert commits == []
+    assert query(datamart, 'select count(*) from DM_ENTITY') == [(0,)]
+    assert query(datamart, 'select count(*) from DM_REPORT') == [(0,)]
+
+    replicator.replicate(get_message('CUSTOMER', '2', [2]), commits.append)
+    assert commits == [[0], [0]]
+    assert query(datamart, 'select count(*) from DM_ENTITY') == [(2,)]
+    assert query(datamart, "select ENTITY_COUNT from DM_REPORT where REPORT = 'TOTAL' and STATISTIC = 'ENTITY_COUNT'") == [(2,)]
+    replicator.close()
+
+# -----------------------------------------------------------------------------
+# datamart statements
+# -----------------------------------------------------------------------------
+
+
+@pytest.mark.parametrize('db_type', ['SQLITE3', 'DB2'])
+def test_insert_report_details(g2replicator, datamart, db_type):
+    replicator = g2replicator.Replicator('', FakeG2Engine(), datamart)
+
+    # Any other database gets plain statements, which sqlite also takes.
+
+    replicator.dbo.dbType = db_type
+    assert replicator.insert_dm_report_details('DSS|CUSTOMER', [[1, 2], [1, 3]]) == 0
+    assert replicator.insert_dm_report_details('DSS|CUSTOMER', [[1, 3], [1, 4]]) == 0
+    assert replicator.insert_dm_report_detail('DSS|CUSTOMER', 1, 4) == 0
+    assert 'sql_error' not in replicator.stat_log
+    assert query(datamart, 'select ENTITY_ID, RELATED_ID from DM_REPORT_DETAIL order by RELATED_ID') == [(1, 2), (1, 3), (1, 4)]
+
+
+def test_get_sql_stmt(g2replicator, datamart):
+    replicator = g2replicator.Replicator('', FakeG2Engine(), datamart)
+    key_fields = ['ENTITY_ID']
+    insert_fields = ['ENTITY_ID', 'ENTITY_NAME']
+    update_fields = ['ENTITY_NAME']
+
+    assert replicator.get_sql_stmt('DM_ENTITY', 'insert', key_fields, insert_fields) == 'insert into DM_ENTITY (ENTITY_ID,ENTITY_NAME) values (?,?)'
+    assert replicator.get_sql_stmt('DM_ENTITY', 'insert_skip', key_fields, insert_fields) == 'insert into DM_ENTITY (ENTITY_ID,ENTITY_NAME) values (?,?) on conflict (ENTITY_ID) do nothing'
+    assert replicator.get_sql_stmt('DM_ENTITY', 'select_count', key_fields) == 'select count(*) from DM_ENTITY where ENTITY_ID = ?'
+    assert replicator.get_sql_stmt('DM_ENTITY', 'update', key_fields, update_fields=update_fields) == 'update DM_ENTITY set ENTITY_NAME = ? where ENTITY_ID = ?'
+    assert replicator.get_sql_stmt('DM_ENTITY', 'upsert', key_fields, insert_fields, update_fields) == 'insert into DM_ENTITY (ENTITY_ID,ENTITY_NAME) values (?,?) on conflict (ENTITY_ID) do update set ENTITY_NAME = ?'
+    with pytest.raises(ValueError):
+        replicator.get_sql_stmt('DM_ENTITY', 'merge', key_fields, insert_fields, update_fields)
+
+    # Each statement is built once.
+
+    replicator.dbo.dbType = 'MYSQL'
+    assert replicator.get_sql_stmt('DM_ENTITY', 'insert_skip', key_fields, insert_fields).endswith('on conflict (ENTITY_ID) do nothing')
+    replicator.sql_stmt_cache.clear()
+    assert replicator.get_sql_stmt('DM_ENTITY', 'insert_skip', key_fields, insert_fields) == 'insert ignore into DM_ENTITY (ENTITY_ID,ENTITY_NAME) values (?,?)'
+    assert replicator.get_sql_stmt('DM_ENTITY', 'upsert', key_fields, insert_fields, update_fields) == 'insert into DM_ENTITY (ENTITY_ID,ENTITY_NAME) values (?,?) on duplicate key update ENTITY_NAME = ?'
+
+
+@pytest.mark.parametrize('insert_first', [True, False])
+def test_upsert_dm_row(g2replicator, datamart, insert_first):
+    replicator = g2replicator.Replicator('', FakeG2Engine(), datamart)
+    key_fields = ['ENTITY_ID']
+    insert_fields = ['ENTITY_ID', 'ENTITY_NAME', 'RECORD_COUNT']
+    update_fields = ['ENTITY_NAME', 'RECORD_COUNT']
+
+    assert replicator.upsert_dm_row('DM_ENTITY', key_fields, insert_fields, [1, 'first', 1], update_fields, ['first', 1], insert_first) == (0, 'insert')
+    assert replicator.upsert_dm_row('DM_ENTITY', key_fields, insert_fields, [1, 'second', 2], update_fields, ['second', 2], insert_first) == (0, 'update')
+    assert replicator.upsert_dm_row('DM_ENTITY', key_fields, insert_fields, [2, 'other', 1], update_fields, ['other', 1], insert_first) == (0, 'insert')
+    assert query(datamart, 'select ENTITY_ID, ENTITY_NAME, RECORD_COUNT from DM_ENTITY order by ENTITY_ID') == [(1, 'second', 2), (2, 'other', 1)]
+
+
+def test_upsert_report_counts(g2replicator, datamart):
+    '''The entity count only goes up when upsert_dm_row says the entity was inserted.'''
+    g2_engine = FakeG2Engine({1: {'records': [('CUSTOMER', '1')], 'relations': {}}})
+    replicator = g2replicator.Replicator('', g2_engine, datamart)
+    total_entity_count = "select ENTITY_COUNT from DM_REPORT where REPORT = 'TOTAL' and STATISTIC = 'ENTITY_COUNT'"
+
+    # A level 0 entity tries the insert first, any other the update.
+
+    replicator.replicate(get_message('CUSTOMER', '1', [1]))
+    assert replicator.stat_log['affected entity 0']['insert'] == 1
+    assert query(datamart, total_entity_count) == [(1,)]
+
+    g2_engine.entities[1]['records'].append(('CUSTOMER', '2'))
+    replicator.replicate(get_message('CUSTOMER', '2', [1]))
+    assert replicator.stat_log['affected entity 0']['update'] == 1
+    assert query(datamart, total_entity_count) == [(1,)]
+
+    g2_engine.entities[2] = {'records': [('CUSTOMER', '3')], 'relations': {}}
+    g2_engine.entities[1]['records'].append(('CUSTOMER', '4'))
+    replicator.replicate(get_message('CUSTOMER', '4', [1, 2]))
+    assert replicator.stat_log['affected entity 1']['insert'] == 1
+    assert query(datamart, total_entity_count) == [(2,)]
+    assert query(datamart, 'select ENTITY_ID, RECORD_COUNT from DM_ENTITY order by ENTITY_ID') == [(1, 3), (2, 1)]
+
+# -----------------------------------------------------------------------------
+# reports
+# -----------------------------------------------------------------------------
+
+
+def resolve_records(g2_engine, step_count, seed=1):
+    '''Yields the message for each record the fake engine resolves, adding, merging, splitting and relating entities as it goes.'''
+    entities = g2_engine.entities
+    random_numbers = random.Random(seed)
+
+    def new_entity():
+        entity_id = max(entities, default=0) + 1
+        entities[entity_id] = {'records': [], 'relations': {}}
+        return entity_id
+
+    def relate(entity_id, related_id):
+        match_level = random_numbers.choice([2, 3, 11])
+        is_disclosed, is_ambiguous = (1, 0) if match_level == 11 else (0, random_numbers.choice([0, 0, 1]))
+        relation = (match_level, random_numbers.choice(['+NAME+DOB', '+ADDRESS', '+PHONE-DOB']), is_disclosed, is_ambiguous)
+        entities[entity_id]['relations'][related_id] = relation
+        entities[related_id]['relations'][entity_id] = relation
+
+    def unrelate(entity_id, related_id):
+        entities[entity_id]['relations'].pop(related_id, None)
+        entities[related_id]['relations'].pop(entity_id, None)
+
+    for step in range(step_count):
+        live_entities = [x for x in entities if entities[x]['records']]
+        record = (random_numbers.choice(['CUSTOMER', 'WATCHLIST', 'REFERENCE']), str(step))
+        action = random_numbers.random()
+        if action < 0.35 or len(live_entities) < 3:
+            entity_id = new_entity()
+            entities[entity_id]['records'].append(record)
+            if live_entities and random_numbers.random() < 0.5:
+                relate(entity_id, random_numbers.choice(live_entities))
+            affected_entities = [entity_id]
+        elif action < 0.6:
+            entity_id = random_numbers.choice(live_entities)
+            entities[entity_id]['records'].append(record)
+            affected_entities = [entity_id]
+        elif action < 0.75:
+            entity_id, merged_id = random_numbers.sample(live_entities, 2)
+            entities[entity_id]['records'].extend([record] + entities[merged_id]['records'])
+            entities[merged_id]['records'] = []
+            for related_id in list(entities[merged_id]['relations']):
+                relation = entities[merged_id]['relations'][related_id]
+                unrelate(merged_id, related_id)
+                if related_id != entity_id:
+                    entities[entity_id]['relations'][related_id] = relation
+                    entities[related_id]['relations'][entity_id] = relation
+            affected_entities = [entity_id, merged_id]
+        elif action < 0.85 and any(len(entities[x]['records']) > 1 for x in live_entities):
+            entity_id = random_numbers.choice([x for x in live_entities if len(entities[x]['records']) > 1])
+            split_record = entities[entity_id]['records'].pop(random_numbers.randrange(len(entities[entity_id]['records'])))
+            split_id = new_entity()
+            entities[split_id]['records'].extend([split_record, record])
+            relate(entity_id, split_id)
+            affected_entities = [entity_id, split_id]
+        else:
+            entity_id, related_id = random_numbers.sample(live_entities, 2)
+            entities[entity_id]['records'].append(record)
+            if related_id in entities[entity_id]['relations']:
+                unrelate(entity_id, related_id)
+            else:
+                relate(entity_id, related_id)
+            affected_entities = [entity_id]
+        yield get_message(record[0], record[1], affected_entities)
+
+
+def get_reports(datamart):
+    '''Report counts that are all zero are the same as no row at all.'''
+    report_list = query(datamart, 'select REPORT_KEY, REPORT, STATISTIC, DATA_SOURCE1, DATA_SOURCE2, ENTITY_COUNT, RECORD_COUNT, RELATION_COUNT from DM_REPORT order by REPORT_KEY')
+    detail_list = query(datamart, 'select REPORT_KEY, ENTITY_ID, RELATED_ID from DM_REPORT_DETAIL order by REPORT_KEY, ENTITY_ID, RELATED_ID')
+    return [x for x in report_list if any(x[5:])], detail_list
+
+
+@pytest.mark.parametrize('commit_message_count, batch_size', [(0, 1), (10, 5)])
+def test_rebuild_reports(g2replicator, datamart, commit_message_count, batch_size):
+    g2_engine = FakeG2Engine()
+    replicator = g2replicator.Replicator('', g2_engine, datamart, commit_message_count=commit_message_count, resync_max_depth=99, sqlite_pragmas=['synchronous = OFF'])
+    message_list = []
+    for message in resolve_records(g2_engine, 300):
+        message_list.append(message)
+        if len(message_list) == batch_size:
+            replicator.replicate_batch(message_list)
+            message_list = []
+    replicator.close()
+    assert 'sql_error' not in replicator.stat_log
+
+    # The incremental reports are what the entities, records and relationships add up to (-R verify).
+
+    replicator = g2replicator.Replicator('', g2_engine, datamart)
+    assert replicator.audit_entities(sorted(g2_engine.entities)) == []
+    assert replicator.verify_dm_report() == (0, [])
+
+    # Rebuilding them gives the same rows (-R rebuild).
+
+    report_list, detail_list = get_reports(datamart)
+    assert len(report_list) > 20 and len(detail_list) > 50
+    assert replicator.rebuild_dm_report() == 0
+    assert get_reports(datamart) == (report_list, detail_list)
+    assert replicator.verify_dm_report() == (0, [])
+    replicator.close()
+
+# -----------------------------------------------------------------------------
+# rebuild
+# -----------------------------------------------------------------------------
+
+
+def test_rebuild_datamart(g2replicator, datamart, tmp_path):
+    query(datamart, 'drop table DM_REBUILD_RANGE')
+    g2_engine = FakeG2Engine()
+    for message in resolve_records(g2_engine, 200):
+        pass
+    g2_database = 'sqlite3://na:na@' + str(tmp_path / 'g2.db')
+    query(g2_database, 'create table RES_ENT (RES_ENT_ID BIGINT NOT NULL PRIMARY KEY)')
+    for entity_id in g2_engine.entities:
+        if g2_engine.entities[entity_id]['records']:
+            query(g2_database, f'insert into RES_ENT values ({entity_id})')
+    replicator = g2replicator.Replicator('', g2_engine, datamart)
+    replicator_kwargs = {'calculate_reports': True, 'commit_message_count': 1000, 'report_flush_message_count': 1000}
+
+    # In this process with the replicator's engine, each range checkpointed in a new DM_REBUILD_RANGE.
+
+    stat_log = {}
+    assert g2replicator.rebuild_datamart('', datamart, g2_database, 0, 25, replicator_kwargs, stat_log, False, replicator) == 0
+    assert 'sql_error' not in stat_log
+    checkpoint_list = query(datamart, 'select RANGE_START, RANGE_END from DM_REBUILD_RANGE order by RANGE_START')
+    assert checkpoint_list == [(x, x + 25) for x in range(0, max(g2_engine.entities) + 1, 25)]
+    assert replicator.audit_entities(sorted(g2_engine.entities)) == []
+    assert replicator.verify_dm_report() == (0, [])
+
+    # A resumed run skips the checkpointed ranges, a checkpoint written again is updated.
+
+    query(datamart, 'delete from DM_REBUILD_RANGE where RANGE_START = 25')
+    query(datamart, "update DM_REBUILD_RANGE set COMPLETED_DT = 'then', STAT_LOG = '{}' where RANGE_START = 50")
+    with mock.patch.object(g2replicator, 'rebuild_entity_range', wraps=g2replicator.rebuild_entity_range) as rebuild_entity_range:
+        assert g2replicator.rebuild_datamart('', datamart, g2_database, 0, 25, replicator_kwargs, {}, True, replicator) == 0
+    assert [x.args[0] for x in rebuild_entity_range.call_args_list] == [(25, 50)]
+    assert query(datamart, 'select RANGE_START, RANGE_END from DM_REBUILD_RANGE order by RANGE_START') == checkpoint_list
+
+    g2replicator.rebuild_worker_init('', datamart, g2_database, replicator_kwargs, replicator)
+    assert g2replicator.rebuild_entity_range((50, 75))[1] == 0
+    g2replicator.rebuild_g2dbo.close()
+    assert query(datamart, "select count(*) from DM_REBUILD_RANGE where RANGE_START = 50 and COMPLETED_DT != 'then'") == [(1,)]
+    replicator.close()
+
+# -----------------------------------------------------------------------------
+# entity locks
+# -----------------------------------------------------------------------------
+
+
+def test_entity_locks(g2replicator):
+    entity_locks = g2replicator.EntityLocks()
+    owner_1, owner_2 = object(), object()
+
+    # All or nothing for acquire, only the free ones for try_acquire.
+
+    entity_locks.acquire(owner_1, [1, 2])
+    assert entity_locks.try_acquire(owner_2, [2, 3]) == [2]
+    assert entity_locks.owner_list == {1: owner_1, 2: owner_1, 3: owner_2}
+    assert entity_locks.try_acquire(owner_1, [1, 2]) == []
+    assert not entity_locks.is_wanted(owner_1)
+
+    # A waiting owner marks the one holding its entities as wanted, so it knows to commit.
+
+    acquired = threading.Event()
+    waiter = threading.Thread(target=lambda: entity_locks.acquire(owner_2, [1, 3]) or acquired.set())
+    waiter.start()
+    for i in range(100):
+        if entity_locks.is_wanted(owner_1):
+            break
+        time.sleep(0.01)
+    assert entity_locks.is_wanted(owner_1)
+    assert not acquired.is_set()
+
+    entity_locks.release(owner_1)
+    waiter.join(5)
+    assert acquired.is_set()
+    assert not entity_locks.is_wanted(owner_1)
+    assert entity_locks.owner_list == {1: owner_2, 3: owner_2}
+    entity_locks.release(owner_2)
+    assert entity_locks.owner_list == {} and entity_locks.held_list == {}
+
+
+def test_entity_locks_order(g2replicator):
+    '''Owners taking the same entities in opposite orders give up their own locks before waiting instead of deadlocking.'''
+    entity_locks = g2replicator.EntityLocks()
+    barrier = threading.Barrier(2)
+    held_together = []
+    errors = []
+
+    def lock_entities(first_id, second_id):
+        owner = object()
+        try:
+            for i in range(200):
+                entity_locks.acquire(owner, [first_id])
+                if i == 0:
+                    barrier.wait(5)
+                entity_locks.acquire(owner, [first_id, second_id], lambda: entity_locks.release(owner))
+                held_together.append(set(entity_locks.held_list[owner]))
+                entity_locks.release(owner)
+        except Exception as err:
+            errors.append(err)
+
+    threads = [threading.Thread(target=lock_entities, args=(1, 2)), threading.Thread(target=lock_entities, args=(2, 1))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    assert not any(thread.is_alive() for thread in threads)
+    assert errors == []
+    assert held_together == [{1, 2}] * 400
+    assert entity_locks.owner_list == {}
+
+
+def test_shared_entity_locks(g2replicator, datamart):
+    '''A replicator waiting on an entity another holds in an open group commit gets it once that one commits.'''
+    g2_engine = FakeG2Engine({1: {'records': [('CUSTOMER', '1')], 'relations': {}}})
+    entity_locks = g2replicator.EntityLocks()
+    replicator_1 = g2replicator.Replicator('', g2_engine, datamart, commit_message_count=10, entity_locks=entity_locks, datamart_profile='wal')
+    replicator_2 = g2replicator.Replicator('', g2_engine, datamart, commit_message_count=10, entity_locks=entity_locks, datamart_profile='wal')
+
+    commits = []
+    replicator_1.replicate(get_message('CUSTOMER', '1', [1]), lambda batch_status: commits.append((1, batch_status)))
+    assert entity_locks.owner_list == {1: replicator_1}
+
+    g2_engine.entities[1]['records'].append(('CUSTOMER', '2'))
+    replicator = threading.Thread(target=replicator_2.replicate, args=(get_message('CUSTOMER', '2', [1]), lambda batch_status: commits.append((2, batch_status))))
+    replicator.start()
+    for i in range(100):
+        if entity_locks.is_wanted(replicator_1):
+            break
+        time.sleep(0.01)
+    assert replicator_1.check_dm_commit()
+    replicator.join(10)
+    replicator_2.close()
+    replicator_1.close()
+
+    assert commits == [(1, [0]), (2, [0])]
+    assert query(datamart, 'select RECORD_ID from DM_RECORD order by RECORD_ID') == [('1',), ('2',)]
+    assert query(datamart, 'select RECORD_COUNT from DM_ENTITY') == [(2,)]
+
+
+def test_prefetch_resumes(g2replicator, datamart):
+    '''A resume fetched ahead of the entity locks is fetched again if the entity was synced in between.'''
+    g2_engine = FakeG2Engine({1: {'records': [('CUSTOMER', '1')], 'relations': {}}})
+    replicator_1 = g2replicator.Replicator('', g2_engine, datamart)
+    replicator_2 = g2replicator.Replicator('', g2_engine, datamart)
+    replicator_1.replicate(get_message('CUSTOMER', '1', [1]))
+
+    def prefetch():
+        dm_resume_hash = replicator_2.get_resume_dm_many([1])[1]['RESUME_HASH']
+        return {1: dict(replicator_2.fetch_resume_g2_api(1), DM_RESUME_HASH=dm_resume_hash)}
+
+    # Replicator 1 syncs a newer entity after replicator 2 prefetched it.
+
+    g2_resume_list = prefetch()
+    g2_engine.entities[1]['records'].append(('CUSTOMER', '2'))
+    replicator_1.replicate(get_message('CUSTOMER', '2', [1]))
+    replicator_2.replicate(get_message('CUSTOMER', '1', [1]), g2_resume_list=g2_resume_list)
+    assert replicator_2.stat_log['resume_g2']['prefetch_stale'] == 1
+    assert query(datamart, 'select RECORD_COUNT from DM_ENTITY where ENTITY_ID = 1') == [(2,)]
+
+    # Otherwise the prefetched resume is used.
+
+    g2_resume_list = prefetch()
+    replicator_2.replicate(get_message('CUSTOMER', '2', [1]), g2_resume_list=g2_resume_list)
+    assert replicator_2.stat_log['resume_g2']['memo_hit'] == 1
+    assert replicator_2.stat_log['resume_g2']['prefetch_stale'] == 1
+    replicator_2.close()
+    replicator_1.close()
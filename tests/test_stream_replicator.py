@@ -0,0 +1,487 @@
+'''Replicate threads of stream-replicator.py run against fake brokers and a fake datamart replicator.'''
+
+import collections
+import importlib.util
+import json
+import os
+import random
+import sys
+import threading
+import time
+import types
+from unittest import mock
+
+import pytest
+
+STREAM_REPLICATOR_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'stream-replicator.py')
+
+
+class TopicPartition:
+
+    def __init__(self, topic, partition, offset=-1):
+        self.topic = topic
+        self.partition = partition
+        self.offset = offset
+
+
+@pytest.fixture
+def stream_replicator():
+    '''The brokers' client libraries are only touched through these names, so the fakes replace them.'''
+    fake_modules = {
+        'boto3': types.SimpleNamespace(client=None),
+        'confluent_kafka': types.SimpleNamespace(Consumer=None, TopicPartition=TopicPartition, KafkaError=types.SimpleNamespace(_PARTITION_EOF=-191)),
+        'pika': types.SimpleNamespace(),
+    }
+    with mock.patch.dict(sys.modules, fake_modules):
+        spec = importlib.util.spec_from_file_location('stream_replicator', STREAM_REPLICATOR_PATH)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    return module
+
+
+class Finished(Exception):
+    '''Raised by a fake broker once every message is done, as the replicate threads never stop on their own.'''
+
+
+class FakeReplicator:
+    '''Group commits like the datamart replicator, on_commit is called once the transaction holding its batch has committed.
+       A message starting with "invalid" gets status 3, one in sql_errors gets status 2 that many times.
+    '''
+
+    def __init__(self, commit_message_count, sql_errors):
+        self.commit_message_count = commit_message_count
+        self.sql_errors = sql_errors
+        self.transaction_open = False
+        self.pending_batches = []
+        self.pending_message_count = 0
+        self.replicated = collections.Counter()
+        self.durable = set()
+        self.batch_count = 0
+        self.commit_count = 0
+        self.closed = False
+
+    def replicate_batch(self, message_str_list, on_commit=None, g2_resume_list=None):
+        batch_status = []
+        for message_str in message_str_list:
+            self.replicated[message_str] += 1
+            if message_str.startswith('invalid'):
+                batch_status.append(3)
+            elif self.sql_errors.get(message_str):
+                self.sql_errors[message_str] -= 1
+                batch_status.append(2)
+            else:
+                batch_status.append(0)
+        self.batch_count += 1
+        self.transaction_open = True
+        self.pending_batches.append((message_str_list, batch_status, on_commit))
+        self.pending_message_count += len(message_str_list)
+        if self.pending_message_count >= self.commit_message_count:
+            self.commit_dm_transaction()
+
+    def commit_dm_transaction(self):
+        pending_batches = self.pending_batches
+        self.pending_batches = []
+        self.pending_message_count = 0
+        self.transaction_open = False
+        if pending_batches:
+            self.commit_count += 1
+        for message_str_list, batch_status, on_commit in pending_batches:
+            self.durable.update(x for x, y in zip(message_str_list, batch_status) if y == 0)
+            on_commit(batch_status)
+        return 0
+
+    def release_dm_connection(self):
+        pass
+
+    def check_dm_commit(self):
+        pass
+
+    def check_dm_maintenance(self):
+        pass
+
+    def drain_resync_queue(self):
+        return 0
+
+    def close(self):
+        self.commit_dm_transaction()
+        self.closed = True
+
+
+def get_config(**kwargs):
+    config = {
+        'counter_processed_records': 0,
+        'counter_queued_records': 0,
+        'datamart_resync_idle_seconds': 0,
+        'datamart_retry_delay_seconds': 0,
+        'datamart_retry_max_attempts': 3,
+    }
+    config.update(kwargs)
+    return config
+
+
+def get_messages(count):
+    messages = ['{{"MESSAGE": {0}}}'.format(i) for i in range(count)]
+    messages[3] = 'invalid 3'
+    return messages
+
+# -----------------------------------------------------------------------------
+# EntityDispatcher
+# -----------------------------------------------------------------------------
+
+
+def test_entity_dispatcher(stream_replicator):
+    dispatcher = stream_replicator.EntityDispatcher(4, 0)
+    random_numbers = random.Random(1)
+    messages = [json.dumps({'MESSAGE': i, 'AFFECTED_ENTITIES': [{'ENTITY_ID': x} for x in random_numbers.sample(range(10), random_numbers.randint(1, 3))]}) for i in range(300)]
+    messages[3] = 'invalid 3'
+    lock = threading.Lock()
+    replicating = collections.Counter()
+    replicated = collections.defaultdict(list)
+    overlaps = []
+
+    def replicate(work_queue):
+        while True:
+            message_str, entity_id_list, g2_resume_list, on_commit = work_queue.get()
+            if message_str is None:
+                return
+            with lock:
+                overlaps.extend(x for x in entity_id_list if replicating[x])
+                replicating.update(entity_id_list)
+            time.sleep(random_numbers.random() / 1000)
+            with lock:
+                replicating.subtract(entity_id_list)
+                for entity_id in entity_id_list:
+                    replicated[entity_id].append(json.loads(message_str)['MESSAGE'])
+            dispatcher.done(entity_id_list)
+
+    threads = [threading.Thread(target=replicate, args=(x,)) for x in dispatcher.work_queues]
+    for thread in threads:
+        thread.start()
+    for message in messages:
+        dispatcher.dispatch(message)
+    for work_queue in dispatcher.work_queues:
+        work_queue.put((None, None, None, None))
+    for thread in threads:
+        thread.join(30)
+
+    # An entity is never replicated by two threads at once, and its messages are replicated in the order they arrived.
+
+    assert overlaps == []
+    for entity_id in range(10):
+        expected = [i for i, x in enumerate(messages) if x != 'invalid 3' and entity_id in [y['ENTITY_ID'] for y in json.loads(x)['AFFECTED_ENTITIES']]]
+        assert replicated[entity_id] == expected
+    assert dispatcher.in_flight == {}
+    assert dispatcher.stage.processed == len(messages)
+
+# -----------------------------------------------------------------------------
+# rabbitmq-replicate
+# -----------------------------------------------------------------------------
+
+
+class FakeRabbitMQ:
+    '''The connection and its channel, the deliveries are all made by start_consuming.
+       What the ack tracker schedules on the connection's thread only runs when the test calls send_scheduled.
+    '''
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.scheduled = []
+        self.acks = []
+        self.requeues = []
+
+    def channel(self):
+        return self
+
+    def queue_declare(self, queue, passive):
+        pass
+
+    def basic_qos(self, prefetch_count):
+        self.prefetch_count = prefetch_count
+
+    def basic_consume(self, on_message_callback, queue):
+        self.on_message_callback = on_message_callback
+
+    def start_consuming(self):
+        for delivery_tag, message in enumerate(self.messages, 1):
+            self.on_message_callback(self, types.SimpleNamespace(delivery_tag=delivery_tag), None, message.encode('utf-8'))
+
+    def add_callback_threadsafe(self, callback):
+        self.scheduled.append(callback)
+
+    def send_scheduled(self):
+        scheduled = self.scheduled
+        self.scheduled = []
+        for callback in scheduled:
+            callback()
+
+    def basic_ack(self, delivery_tag, multiple):
+        assert multiple is True
+        self.acks.append(delivery_tag)
+
+    def basic_nack(self, delivery_tag, multiple, requeue):
+        assert multiple is False and requeue is True
+        self.requeues.append(delivery_tag)
+
+
+class FakeDispatcher:
+
+    def __init__(self):
+        self.on_commits = {}
+
+    def dispatch(self, message_str, g2_resume_list=None, on_commit=None):
+        self.on_commits[message_str] = on_commit
+
+
+def test_rabbitmq_replicate(stream_replicator):
+    messages = get_messages(8)
+    rabbitmq = FakeRabbitMQ(messages)
+    dispatcher = FakeDispatcher()
+    failures = []
+    config = get_config(datamart_commit_message_count=4, rabbitmq_prefetch_count=1, threads_per_process=2)
+
+    thread = stream_replicator.ReadRabbitMQWriteG2Thread(config, None, None, None, dispatcher)
+    thread.add_to_failure_queue = lambda jsonline: failures.append(jsonline) or True
+    with mock.patch.multiple(stream_replicator.pika, create=True,
+                             PlainCredentials=mock.Mock(),
+                             ConnectionParameters=mock.Mock(),
+                             BlockingConnection=mock.Mock(return_value=rabbitmq)):
+        thread.run()
+    for i in range(100):
+        if len(dispatcher.on_commits) == len(messages) - 1:
+            break
+        time.sleep(0.01)
+
+    def commit(message_index, replication_status=0):
+        dispatcher.on_commits[messages[message_index]]([replication_status])
+        rabbitmq.send_scheduled()
+
+    # Enough prefetched for each replicate thread to fill a group commit, the invalid message went to the failure queue.
+
+    assert rabbitmq.prefetch_count == 8
+    assert failures == [messages[3]]
+    rabbitmq.send_scheduled()
+    assert rabbitmq.acks == []
+
+    # Nothing is acked past a delivery that has not committed.
+
+    commit(1)
+    commit(2)
+    assert rabbitmq.acks == []
+    commit(0)
+    assert rabbitmq.acks == [4]
+
+    # A datamart error is requeued after its retry delay, the deliveries behind it are acked once it is.
+
+    commit(5)
+    commit(4, 2)
+    for i in range(100):
+        rabbitmq.send_scheduled()
+        if rabbitmq.requeues:
+            break
+        time.sleep(0.01)
+    assert rabbitmq.requeues == [5]
+    assert rabbitmq.acks == [4, 6]
+
+    commit(7)
+    assert rabbitmq.acks == [4, 6]
+    commit(6)
+    assert rabbitmq.acks == [4, 6, 8]
+    assert rabbitmq.requeues == [5]
+
+# -----------------------------------------------------------------------------
+# kafka-replicate
+# -----------------------------------------------------------------------------
+
+
+class FakeKafkaMessage:
+
+    def __init__(self, offset, value):
+        self._offset = offset
+        self._value = value
+
+    def error(self):
+        return None
+
+    def topic(self):
+        return 'topic'
+
+    def partition(self):
+        return 0
+
+    def offset(self):
+        return self._offset
+
+    def value(self):
+        return self._value.encode('utf-8')
+
+
+class FakeConsumer:
+    '''One partition, its committed offset is checked against what the replicator has made durable.'''
+
+    def __init__(self, messages, replicator, failures):
+        self.messages = messages
+        self.replicator = replicator
+        self.failures = failures
+        self.position = 0
+        self.committed = 0
+        self.paused = False
+        self.closed = False
+
+    def subscribe(self, topics, on_assign=None, on_revoke=None):
+        on_assign(self, [TopicPartition('topic', 0)])
+
+    def consume(self, num_messages, timeout):
+        if self.committed == len(self.messages):
+            raise Finished()
+        if self.paused:
+            return []
+        kafka_message_list = [FakeKafkaMessage(x, self.messages[x]) for x in range(self.position, min(self.position + num_messages, len(self.messages)))]
+        self.position += len(kafka_message_list)
+        return kafka_message_list
+
+    def commit(self, offsets, asynchronous=True):
+        assert asynchronous is False
+        assert not self.closed
+        for topic_partition in offsets:
+            assert topic_partition.offset > self.committed
+            for message in self.messages[self.committed:topic_partition.offset]:
+                assert message in self.replicator.durable or message in self.failures
+            self.committed = topic_partition.offset
+
+    def seek(self, topic_partition):
+        self.position = topic_partition.offset
+
+    def pause(self, topic_partitions):
+        self.paused = True
+
+    def resume(self, topic_partitions):
+        self.paused = False
+
+    def close(self):
+        assert self.replicator.closed
+        self.closed = True
+
+
+def test_kafka_replicate(stream_replicator):
+    messages = get_messages(20)
+    replicator = FakeReplicator(commit_message_count=6, sql_errors={messages[4]: 1, messages[12]: 99})
+    failures = []
+    consumer = FakeConsumer(messages, replicator, failures)
+    config = get_config(kafka_consume_num_messages=2, kafka_bootstrap_server='localhost:9092', kafka_group='group', kafka_topic='topic')
+
+    thread = stream_replicator.ReadKafkaReplicateThread(config, None, None, None)
+    thread.add_to_failure_queue = lambda jsonline: failures.append(jsonline) or True
+    with mock.patch.object(stream_replicator, 'get_datamart_replicator', return_value=replicator), \
+         mock.patch.object(stream_replicator.confluent_kafka, 'Consumer', return_value=consumer):
+        with pytest.raises(Finished):
+            thread.run()
+
+    # Every offset is committed, each only once its message was durable or in the failure queue.
+
+    assert consumer.committed == len(messages)
+    assert replicator.durable | set(failures) == set(messages)
+
+    # The thread closed the replicator, then the consumer its last offsets were committed through.
+
+    assert replicator.closed
+    assert consumer.closed
+
+    # The status 2 message is read again with the rest of its partition, and passes the second time.
+
+    assert replicator.replicated[messages[4]] == 2
+    assert replicator.replicated[messages[5]] == 2
+    assert messages[4] in replicator.durable
+
+    # The status 3 message and the one out of attempts go to the failure queue.
+
+    assert replicator.replicated[messages[3]] == 1
+    assert replicator.replicated[messages[12]] == config['datamart_retry_max_attempts']
+    assert failures == [messages[3], messages[12]]
+
+    # Group commits span several batches.
+
+    assert replicator.commit_count < replicator.batch_count
+
+# -----------------------------------------------------------------------------
+# sqs-replicate
+# -----------------------------------------------------------------------------
+
+
+class FakeSqs:
+    '''A queue whose deletes are checked against what the replicator has made durable.
+       A message with a visibility timeout of 0 can be received again straight away.
+    '''
+
+    def __init__(self, messages, replicator, failures):
+        self.messages = messages
+        self.replicator = replicator
+        self.failures = failures
+        self.receive_counts = [0] * len(messages)
+        self.in_flight = set()
+        self.deleted = set()
+
+    def receive_message(self, QueueUrl, AttributeNames, MaxNumberOfMessages, MessageAttributeNames, VisibilityTimeout, WaitTimeSeconds):
+        assert 'ApproximateReceiveCount' in AttributeNames
+        sqs_messages = []
+        for i, message in enumerate(self.messages):
+            if len(sqs_messages) == MaxNumberOfMessages:
+                break
+            if i in self.deleted or i in self.in_flight:
+                continue
+            self.in_flight.add(i)
+            self.receive_counts[i] += 1
+            sqs_messages.append({'MessageId': str(i),
+                                 'ReceiptHandle': '{0}-{1}'.format(i, self.receive_counts[i]),
+                                 'Body': message,
+                                 'Attributes': {'ApproximateReceiveCount': str(self.receive_counts[i])}})
+        return {'Messages': sqs_messages} if sqs_messages else {}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        assert len(Entries) <= 10
+        for entry in Entries:
+            i = int(entry['ReceiptHandle'].split('-')[0])
+            assert self.messages[i] in self.replicator.durable or self.messages[i] in self.failures
+            self.in_flight.discard(i)
+            self.deleted.add(i)
+        return {}
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        assert len(Entries) <= 10
+        for entry in Entries:
+            if entry['VisibilityTimeout'] == 0:
+                self.in_flight.discard(int(entry['ReceiptHandle'].split('-')[0]))
+        return {}
+
+
+def test_sqs_replicate(stream_replicator):
+    messages = get_messages(45)
+    replicator = FakeReplicator(commit_message_count=25, sql_errors={messages[4]: 1, messages[12]: 99})
+    failures = []
+    sqs = FakeSqs(messages, replicator, failures)
+    config = get_config(exit_on_empty_queue=True, sqs_queue_url='http://localhost:4566/000000000000/queue', sqs_visibility_timeout_seconds=30, sqs_wait_time_seconds=0)
+
+    with mock.patch.object(stream_replicator.boto3, 'client', return_value=sqs):
+        thread = stream_replicator.ReadSqsReplicateThread(config, None, None, None)
+    thread.add_to_failure_queue = lambda jsonline: failures.append(jsonline) or True
+    with mock.patch.object(stream_replicator, 'get_datamart_replicator', return_value=replicator):
+        thread.run()
+
+    # Every message is deleted, each only once it was durable or in the failure queue.
+
+    assert sqs.deleted == set(range(len(messages)))
+    assert replicator.durable | set(failures) == set(messages)
+
+    # The status 2 message is received again and passes the second time.
+
+    assert sqs.receive_counts[4] == 2
+    assert messages[4] in replicator.durable
+
+    # The status 3 message and the one out of attempts go to the failure queue.
+
+    assert sqs.receive_counts[3] == 1
+    assert sqs.receive_counts[12] == config['datamart_retry_max_attempts']
+    assert failures == [messages[3], messages[12]]
+
+    # Group commits span several batches.
+
+    assert replicator.commit_count < replicator.batch_count